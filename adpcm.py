@@ -0,0 +1,219 @@
+# Contains a decoder for the YM2608's ADPCM-B sample format, for pulling the
+# samples out of MDTs with ADPCM channels (or out of raw sample banks) and
+# saving them as WAV files.
+
+# ADPCM-B stores each sample as a 4-bit difference from the last one, scaled
+# by a step size that grows or shrinks depending on the previous difference.
+# Both the step size and the output are running sums that stop at a minimum
+# and maximum, which normally means one sample at a time in a Python loop.
+
+# The chip truncates the step size to an integer after every sample, so the
+# step sizes can't be summed up any faster than one at a time without drifting
+# away from what the chip plays. They're looked up in a table of every step
+# size's next step size instead, which is about as cheap as a Python loop
+# gets. The output only depends on the step sizes, so it's summed (and
+# clamped) with a vectorized trick, a whole chunk of samples at a time.
+
+# Sample data is read through memoryviews of an mmapped file, so nothing gets
+# copied until it's been decoded.
+
+
+from mmap import mmap, ACCESS_READ
+from sys import argv as CMD_ARGS, exit
+from wave import open as open_wave
+
+import numpy as np
+
+from mdt_decomp_rip import Song, atomic_open, parse_mdt
+
+
+# Constants
+# The step size is multiplied by (factor / 64) after each sample, depending on
+# the magnitude of that sample's difference
+STEP_FACTORS = [57, 57, 57, 57, 77, 102, 128, 153]
+STEP_MIN = 127
+STEP_MAX = 24576
+SAMPLE_MIN = -32768
+SAMPLE_MAX = 32767
+# PC-98 software usually plays ADPCM at 16 kHz, but it can be anything, since
+# the playback rate is set per note
+DEFAULT_SAMPLE_RATE = 16000
+CHUNK_SIZE = 0x10000  # Bytes decoded at a time
+CLAMP_WINDOW = 0x1000  # Samples summed at a time in clamped_cumsum()
+SHORT_SWING = 0x40
+SLOW_RUN = 0x200
+
+# The step size after each step size and magnitude, at index
+# (step size << 3) | magnitude
+NEXT_STEPS = np.clip(
+    (np.arange(STEP_MAX + 1)[:, None] * STEP_FACTORS) >> 6, STEP_MIN, STEP_MAX
+).ravel().tolist()
+
+
+# Helper functions
+def clamped_cumsum(
+    start: float,
+    deltas: np.ndarray,
+    low: float,
+    high: float
+) -> np.ndarray:
+    '''
+    Returns the running sum of `deltas` starting from `start`, where the sum
+    is clamped between `low` and `high` at every step, i.e.
+    `x[i] = min(max(x[i - 1] + deltas[i], low), high)`.
+    Clamping at just ONE bound has a closed form (add back however far past
+    the bound the plain sum has ever gone), so that's done a window at a time.
+    Whenever the result crosses the other bound, it's clamped there, and the
+    sum restarts from that point, clamping at that bound instead. Swinging
+    from one bound all the way to the other is rare in real audio, but the
+    windows keep it from getting expensive when it isn't.
+    '''
+    out = np.empty(len(deltas))
+    pos = 0
+    at_low = True  # Which bound is being clamped in closed form
+    while pos < len(deltas):
+        sums = start + np.cumsum(deltas[pos:pos + CLAMP_WINDOW])
+        if at_low:
+            clamped = sums + np.maximum(
+                np.maximum.accumulate(low - sums), 0
+            )
+            crossed = np.flatnonzero(clamped > high)
+        else:
+            clamped = sums - np.maximum(
+                np.maximum.accumulate(sums - high), 0
+            )
+            crossed = np.flatnonzero(clamped < low)
+        if not len(crossed):
+            out[pos:pos + len(clamped)] = clamped
+            start = clamped[-1]
+            pos += len(clamped)
+            continue
+        i = crossed[0]
+        out[pos:pos + i] = clamped[:i]
+        out[pos + i] = start = high if at_low else low
+        at_low = not at_low
+        pos += i + 1
+        if i < SHORT_SWING:
+            # Swinging between the bounds this quickly (basically only in
+            # noise) is cheaper to follow one sample at a time for a bit
+            end = min(pos + SLOW_RUN, len(deltas))
+            for j, v in enumerate(deltas[pos:end].tolist(), pos):
+                start = min(max(start + v, low), high)
+                out[j] = start
+            pos = end
+    return out
+
+
+def step_sizes(step: int, magnitudes: np.ndarray) -> np.ndarray:
+    '''
+    Returns the step size each sample uses (the one from BEFORE it's
+    updated), followed by the step size after the last sample.
+    '''
+    result = [step]
+    append = result.append
+    next_steps = NEXT_STEPS
+    for m in magnitudes.tolist():
+        step = next_steps[(step << 3) | m]
+        append(step)
+    return np.array(result, dtype=np.int64)
+
+
+def unpack_nibbles(data) -> np.ndarray:
+    # High nibble first
+    packed = np.frombuffer(data, dtype=np.uint8)
+    nibbles = np.empty(len(packed) * 2, dtype=np.uint8)
+    nibbles[0::2] = packed >> 4
+    nibbles[1::2] = packed & 0x0F
+    return nibbles
+
+
+# API functions
+def decode_adpcm_b(data) -> np.ndarray:
+    '''
+    Decodes YM2608 ADPCM-B data into an array of signed 16-bit samples (two
+    per byte).
+
+    :param data: A bytes-like object (ideally a memoryview) to decode. It's
+    only read from, never copied.
+    '''
+    view = memoryview(data)
+    out = np.empty(len(view) * 2, dtype=np.int16)
+    step = STEP_MIN
+    value = 0.0
+    for start in range(0, len(view), CHUNK_SIZE):
+        nibbles = unpack_nibbles(view[start:start + CHUNK_SIZE])
+        magnitudes = nibbles & 7
+        steps = step_sizes(step, magnitudes)
+        step = int(steps[-1])
+
+        differences = ((magnitudes * 2 + 1) * steps[:-1]) >> 3
+        differences[nibbles >= 8] *= -1
+        samples = clamped_cumsum(value, differences, SAMPLE_MIN, SAMPLE_MAX)
+        value = float(samples[-1])
+        out[start * 2:start * 2 + len(samples)] = samples
+    view.release()
+    return out
+
+
+def read_adpcm_data(filename: str, song: Song) -> np.ndarray:
+    '''
+    Decodes the ADPCM data in an MDT file. The file is mmapped, and only the
+    ADPCM region is ever read. Returns an empty array if there's no ADPCM data.
+
+    :param filename: A path to the MDT file.
+    :param song: The Song returned from `parse_mdt(filename)`.
+    '''
+    if song.adpcm_loc < 0 or song.adpcm_size == 0:
+        return np.empty(0, dtype=np.int16)
+    with open(filename, "rb") as f, mmap(
+        f.fileno(), 0, access=ACCESS_READ
+    ) as data:
+        view = memoryview(data)[
+            song.adpcm_loc:song.adpcm_loc + song.adpcm_size
+        ]
+        try:
+            return decode_adpcm_b(view)
+        finally:
+            # The memoryview HAS to be released before the mmap is closed
+            view.release()
+
+
+def write_adpcm_wav(
+    filename: str,
+    samples: np.ndarray,
+    sample_rate=DEFAULT_SAMPLE_RATE
+):
+    '''
+    Writes decoded ADPCM samples to a 16-bit mono WAV file.
+
+    :param filename: A path to where the WAV file will be written.
+    :param samples: An array returned from `decode_adpcm_b()`.
+    :param sample_rate: The sample rate to write, in Hz.
+    '''
+    with atomic_open(filename, "wb") as f:
+        with open_wave(f, "wb") as wav:
+            wav.setnchannels(1)
+            wav.setsampwidth(2)
+            wav.setframerate(sample_rate)
+            wav.writeframes(samples.astype("<i2").tobytes())
+
+
+if __name__ == "__main__":
+    if len(CMD_ARGS) < 3:
+        print(
+            "Please specify an input MDT file (or raw ADPCM data, with \"raw\"",
+            "as the 3rd argument) and an output WAV file."
+        )
+        exit()
+
+    if len(CMD_ARGS) >= 4 and CMD_ARGS[3].lower() == "raw":
+        with open(CMD_ARGS[1], "rb") as f, mmap(
+            f.fileno(), 0, access=ACCESS_READ
+        ) as data:
+            samples = decode_adpcm_b(data)
+    else:
+        samples = read_adpcm_data(CMD_ARGS[1], parse_mdt(CMD_ARGS[1]))
+        if not len(samples):
+            print("No ADPCM data found.")
+            exit()
+    write_adpcm_wav(CMD_ARGS[2], samples)
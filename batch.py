@@ -0,0 +1,213 @@
+# Contains a scheduler for converting lots of MDT files at once, spread across
+# several processes. Most MDTs convert in a blink, but a few (the ones with
+# big nested loops and lots of macro calls) take WAY longer and use WAY more
+# memory, since everything gets unrolled during MIDI conversion.
+
+# So, before anything runs, each file's cost is estimated by walking its raw
+# channel data and multiplying out loop counts and macro calls. Jobs are then
+# handed out longest-first (which keeps one huge file from starting last and
+# finishing long after everything else), and a job is held back if starting it
+# would push the estimated memory use of everything in flight over a budget.
+# Smaller jobs can start ahead of a held-back one, but only a few times, after
+# which nothing else starts until it does (otherwise the biggest job would
+# keep getting pushed back, and end up running last, on its own).
+
+
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from io import TextIOWrapper as FILE
+from os import cpu_count
+from os.path import getsize
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+from mdt_decomp_rip import (
+    MemoryReader,
+    Song,
+    uint8,
+    uint16,
+    skip_event
+)
+from md2mml_midi import parse_song, write_midi_file
+
+
+# Constants
+# Rough guess at the memory used per unrolled event during MIDI conversion
+# (one NoteEvent, plus MIDIUtil's own event objects), erring on the high side,
+# because running out of memory is worse than being slow.
+MEMORY_PER_COST = 1024
+DEFAULT_MEMORY_BUDGET = 1024 * 1024 * 1024  # 1 GiB
+# How many smaller jobs can start ahead of a job that doesn't fit yet
+SKIP_LIMIT = 4
+
+LOOP_STARTS = {0xE0: 0, 0xE4: 0, 0xF6: 2}  # Command: bytes after the count
+LOOP_ENDS = {0xE2, 0xE5, 0xF7}
+
+
+# Helper functions
+def channel_cost(
+    f: FILE,
+    location: int,
+    channel_id: int,
+    macro_costs: Dict[int, int]
+) -> int:
+    '''
+    Returns the number of events a channel (or macro) would play through, with
+    all loops and macro calls unrolled.
+
+    :param macro_costs: Costs of macros that have already been walked, keyed
+    by location. Macros currently being walked are stored as 0, so a macro that
+    calls itself doesn't send this into an infinite loop.
+    '''
+    total = 0
+    multipliers: List[int] = [1]
+    f.seek(location)
+    char = 0x00
+    while char != 0xFF:
+        char = uint8(f)
+        total += multipliers[-1]
+        if char in LOOP_STARTS:
+            count = uint8(f) or 1
+            f.seek(LOOP_STARTS[char], 1)
+            multipliers.append(multipliers[-1] * count)
+        elif char in LOOP_ENDS:
+            if len(multipliers) > 1:
+                multipliers.pop()
+            skip_event(f, char, channel_id)
+        elif char == 0xFA:
+            macro_loc = uint16(f)
+            if macro_loc not in macro_costs:
+                macro_costs[macro_loc] = 0
+                here = f.tell()
+                macro_costs[macro_loc] = channel_cost(
+                    f, macro_loc, channel_id, macro_costs
+                )
+                f.seek(here)
+            total += multipliers[-1] * macro_costs[macro_loc]
+        else:
+            skip_event(f, char, channel_id)
+    return total
+
+
+# API functions
+def estimate_cost(filename: str) -> int:
+    '''
+    Estimates how expensive an MDT file is to convert, in (roughly) unrolled
+    events. Files that can't be walked get their size as their cost, so they
+    still get scheduled (and fail properly later on).
+
+    :param filename: A path to the MDT file.
+    '''
+    size = getsize(filename)
+    try:
+        with open(filename, "rb") as src:
+            f = MemoryReader(src.read())
+        f.seek(2)
+        channel_count = uint16(f)
+        f.seek(2, 1)  # Chip
+        channels = [(uint16(f), uint16(f)) for _ in range(channel_count)]
+        macro_costs: Dict[int, int] = {}
+        return size + sum(
+            channel_cost(f, location, channel_id, macro_costs)
+            for location, channel_id in channels if channel_id != 0
+        )
+    except BaseException:
+        return size
+
+
+def run_batch(
+    func: Callable,
+    jobs: List[Tuple],
+    costs: List[int],
+    workers=0,
+    memory_budget=DEFAULT_MEMORY_BUDGET
+) -> Iterator[Tuple[int, Any, BaseException]]:
+    '''
+    Runs `func(*job)` for every job in `jobs` across several processes, and
+    yields an `(index, result, error)` tuple for each as it finishes. Exactly
+    one of `result` and `error` is None.
+    Jobs are started most expensive first, and a job only starts if the
+    estimated memory of every running job (including it) fits in
+    `memory_budget`. A job that's too big to EVER fit runs alone. Up to
+    SKIP_LIMIT smaller jobs can start ahead of a job that doesn't fit, and
+    then the running jobs are drained until it does.
+
+    :param func: A module-level function (so it can be pickled).
+    :param jobs: A list of argument tuples, one per job.
+    :param costs: The estimated cost of each job (see `estimate_cost()`).
+    :param workers: The number of processes to use. 0 uses one per CPU core.
+    :param memory_budget: The memory budget, in bytes.
+    '''
+    workers = workers or cpu_count() or 1
+    queue = deque(sorted(
+        range(len(jobs)), key=lambda i: costs[i], reverse=True
+    ))
+
+    # Not worth spinning up processes for this
+    if workers == 1 or len(jobs) <= 1:
+        for i in queue:
+            try:
+                yield (i, func(*jobs[i]), None)
+            except BaseException as err:
+                yield (i, None, err)
+        return
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        running = {}  # Future: job index
+        memory_used = 0
+        skips = 0  # Jobs started ahead of the one at the front of the queue
+        while queue or running:
+            # Start as many jobs as will fit. The biggest job goes first if it
+            # fits; if not, smaller ones are allowed to jump ahead of it (for
+            # a bit) so the other cores don't sit around doing nothing.
+            while queue and len(running) < workers:
+                for pos, i in enumerate(queue):
+                    if pos > 0 and skips >= SKIP_LIMIT:
+                        pos = -1
+                        break
+                    memory = costs[i] * MEMORY_PER_COST
+                    if not running or memory_used + memory <= memory_budget:
+                        break
+                else:
+                    pos = -1
+                if pos < 0:
+                    break
+                skips = skips + 1 if pos > 0 else 0
+                del queue[pos]
+                memory_used += memory
+                running[pool.submit(func, *jobs[i])] = i
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                i = running.pop(future)
+                memory_used -= costs[i] * MEMORY_PER_COST
+                err = future.exception()
+                yield (i, None if err else future.result(), err)
+
+
+def midi_job(
+    song: Song,
+    filename: str,
+    fm_inst_map: Dict[str, Dict[int, int]],
+    ssg_inst_map: Dict[str, Dict[int, int]],
+    portamento_rate: int,
+    cut_time: bool,
+    loop_markers=False,
+    loop_count: Optional[int] = None,
+    portamento_tolerance: Optional[float] = None
+) -> str:
+    '''
+    Converts `song` to MIDI and writes it to `filename`, for use with
+    `run_batch()`. (Since MIDIFile instances are a pain to send between
+    processes, the file gets written by the worker.)
+    '''
+    write_midi_file(filename, parse_song(
+        song=song,
+        fm_inst_map=fm_inst_map,
+        ssg_inst_map=ssg_inst_map,
+        portamento_rate=portamento_rate,
+        cut_time=cut_time,
+        loop_markers=loop_markers,
+        loop_count=loop_count,
+        portamento_tolerance=portamento_tolerance
+    ))
+    return filename
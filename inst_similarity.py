@@ -0,0 +1,289 @@
+# Contains a nearest-neighbour index for FM instruments ripped by
+# mdt_decomp_rip.py. `process_insts_in_songs()` only merges instruments whose
+# parameters match EXACTLY, but a lot of ripped instruments only differ by a
+# few steps of TL or a single envelope rate. This script finds those.
+
+# Distances are measured in a "perceptual" feature space: every parameter is
+# scaled by roughly how much one step of it changes the sound, so that plain
+# Euclidean distance does something sensible. A distance of about 1.0 is
+# "probably audible, but only just." The weights are my own guesses, made by
+# ear in VOPM, so take them with a grain of salt. 🧂
+
+# Requires NumPy.
+
+
+from sys import argv as CMD_ARGS, exit
+from glob import glob
+from typing import List, Tuple
+
+import numpy as np
+
+from mdt_decomp_rip import FMInstrument, parse_mdt, remove_path
+
+
+# Constants
+# Which operators (rows 1-4 of FMInstrument.params, i.e. M1, C1, M2, C2) are
+# carriers for each of the 8 algorithms. Carrier TL is just volume, whereas
+# modulator TL changes the timbre a LOT, so they're weighted differently.
+CARRIER_MASKS = np.array([
+    [0, 0, 0, 1],
+    [0, 0, 0, 1],
+    [0, 0, 0, 1],
+    [0, 0, 0, 1],
+    [0, 1, 0, 1],
+    [0, 1, 1, 1],
+    [0, 1, 1, 1],
+    [1, 1, 1, 1]
+], dtype=bool)
+
+OPERATOR_WEIGHTS = np.array([
+    0.15,  # AR
+    0.15,  # DR
+    0.1,  # SR
+    0.1,  # RR
+    0.2,  # SL
+    0,  # TL (depends on the algorithm, see below)
+    0.2,  # KS
+    1.0,  # MUL (changes which harmonics you get, so it's a BIG deal)
+    0.3,  # DT1
+    0.5,  # DT2
+    0.5  # AMS-EN
+])
+CARRIER_TL_WEIGHT = 0.05  # ~20 steps of carrier TL is "just audible"
+MODULATOR_TL_WEIGHT = 0.25  # ~4 steps of modulator TL is "just audible"
+
+CHANNEL_WEIGHTS = np.array([
+    1.0,  # OM (slot mask, per bit)
+    0.2,  # WF
+    0.05,  # SY
+    0.01,  # SP
+    0.01,  # PMD
+    0.01,  # AMD
+    0.1,  # PMS
+    0.1,  # AMS
+    0.1,  # PAN
+    0.2  # NOI
+])
+ALGORITHM_WEIGHT = 2.0
+FEEDBACK_WEIGHT = 0.3
+
+# Pairwise distances are computed in blocks of this many rows, so that
+# clustering tens of thousands of instruments doesn't eat all of your RAM.
+BLOCK_SIZE = 512
+
+
+# Helper functions
+def inst_params(insts: List[FMInstrument]) -> np.ndarray:
+    '''
+    Stacks the parameters of each instrument into an `(n, 5, 11)` array.
+    '''
+    return np.array([v.params for v in insts], dtype=np.float32).reshape(
+        -1, 5, 11
+    )
+
+
+def inst_features(params: np.ndarray) -> np.ndarray:
+    '''
+    Converts an `(n, 5, 11)` parameter array (see `inst_params()`) into an
+    `(n, 66)` array of perceptually weighted features.
+    '''
+    n = params.shape[0]
+    first = params[:, 0]
+    ops = params[:, 1:]
+    alg = first[:, 0].astype(np.int64) % 0x08
+    feedback = first[:, 0].astype(np.int64) >> 3
+
+    # Algorithms are categorical (algorithm 4 isn't "between" 3 and 5), so
+    # they get one-hot encoded.
+    alg_onehot = np.zeros((n, 8), dtype=np.float32)
+    alg_onehot[np.arange(n), alg] = ALGORITHM_WEIGHT / np.sqrt(2)
+
+    # Same goes for the slot mask, which gets split into its 4 bits
+    slot_bits = (
+        first[:, 1:2].astype(np.int64) >> np.arange(4)
+    ) & 1
+
+    # Operator parameters, with TL weighted based on the operator's role
+    op_features = ops * OPERATOR_WEIGHTS
+    op_features[:, :, 5] = ops[:, :, 5] * np.where(
+        CARRIER_MASKS[alg], CARRIER_TL_WEIGHT, MODULATOR_TL_WEIGHT
+    )
+
+    return np.hstack([
+        alg_onehot,
+        (feedback * FEEDBACK_WEIGHT)[:, None],
+        slot_bits * CHANNEL_WEIGHTS[0],
+        first[:, 2:] * CHANNEL_WEIGHTS[1:],
+        op_features.reshape(n, 4 * 11)
+    ]).astype(np.float32)
+
+
+def squared_distances(a: np.ndarray, b: np.ndarray) -> np.ndarray:
+    '''
+    Returns the squared Euclidean distances between every row of `a` and every
+    row of `b`, as an `(len(a), len(b))` array.
+    '''
+    result = (
+        (a * a).sum(axis=1)[:, None]
+        + (b * b).sum(axis=1)[None, :]
+        - 2 * (a @ b.T)
+    )
+    # Floating-point error can make identical rows come out very slightly
+    # negative, which makes sqrt() very unhappy
+    return np.maximum(result, 0, out=result)
+
+
+# Classes
+class InstrumentIndex:
+    def __init__(self, insts: List[FMInstrument]):
+        '''
+        Builds a nearest-neighbour index over a bank of FM instruments.
+        Instruments with identical parameters are stored once internally.
+
+        :param insts: A list of FMInstrument instances.
+        '''
+        self.insts = insts
+        params = inst_params(insts) if insts else np.zeros(
+            (0, 5, 11), dtype=np.float32
+        )
+
+        # Exact duplicates are REALLY common in ripped banks, so collapse them
+        # first. `self.groups[i]` holds the indicies of every instrument with
+        # the same parameters as unique row `i`.
+        unique, inverse = np.unique(
+            params.reshape(len(insts), 5 * 11),
+            axis=0,
+            return_inverse=True
+        )
+        inverse = inverse.reshape(-1)
+        order = np.argsort(inverse, kind="stable")
+        bounds = np.searchsorted(inverse[order], np.arange(len(unique) + 1))
+        self.groups: List[np.ndarray] = [
+            order[bounds[i]:bounds[i + 1]] for i in range(len(unique))
+        ]
+        self.params = unique
+        self.features = inst_features(unique.reshape(-1, 5, 11))
+
+    def __len__(self) -> int:
+        return len(self.insts)
+
+    def nearest(
+        self,
+        inst: FMInstrument,
+        k=5,
+        include_exact=True
+    ) -> List[Tuple[FMInstrument, float]]:
+        '''
+        Returns the `k` instruments closest to `inst`, as a list of
+        `(FMInstrument, distance)` tuples, closest first.
+
+        :param inst: The FMInstrument to search for. It doesn't need to be in
+        the index.
+        :param k: The maximum number of results to return.
+        :param include_exact: If False, instruments with exactly the same
+        parameters as `inst` are left out of the results.
+        '''
+        if not len(self.features) or k <= 0:
+            return []
+        query_params = inst_params([inst])
+        dist = squared_distances(inst_features(query_params), self.features)[0]
+        # Exact matches are found by their parameters, since the distances
+        # lose enough precision that identical rows don't always come out 0
+        exact = (self.params == query_params.reshape(1, 5 * 11)).all(axis=1)
+        dist[exact] = 0 if include_exact else np.inf
+
+        # argpartition is O(n), which is what makes this fast on huge banks.
+        # Only the k survivors actually need to be sorted.
+        count = min(k, len(dist))
+        best = np.argpartition(dist, count - 1)[:count]
+        best = best[np.argsort(dist[best], kind="stable")]
+
+        result: List[Tuple[FMInstrument, float]] = []
+        for row in best:
+            if not np.isfinite(dist[row]):
+                break
+            for j in self.groups[row]:
+                result.append((self.insts[j], float(np.sqrt(dist[row]))))
+                if len(result) == k:
+                    return result
+        return result
+
+    def cluster(self, threshold=1.0) -> List[List[FMInstrument]]:
+        '''
+        Groups the indexed instruments into near-duplicate clusters. Two
+        instruments end up in the same cluster if they're linked by a chain of
+        instruments that are each within `threshold` of the next (a.k.a.
+        single-linkage clustering). Clusters are returned largest first, and
+        instruments within a cluster keep their original order.
+
+        :param threshold: The maximum distance between linked instruments.
+        '''
+        n = len(self.features)
+        parent = list(range(n))
+
+        # Union-find, with path halving
+        def find(x: int) -> int:
+            while parent[x] != x:
+                parent[x] = parent[parent[x]]
+                x = parent[x]
+            return x
+
+        limit = threshold * threshold
+        for start in range(0, n, BLOCK_SIZE):
+            block = self.features[start:start + BLOCK_SIZE]
+            # Only compare against rows after the block's first row, since
+            # distance is symmetric
+            dist = squared_distances(block, self.features[start:])
+            rows, cols = np.nonzero(dist <= limit)
+            for r, c in zip(rows + start, cols + start):
+                if r < c:
+                    a, b = find(r), find(c)
+                    if a != b:
+                        parent[max(a, b)] = min(a, b)
+
+        roots = np.array([find(x) for x in range(n)], dtype=np.int64)
+        clusters: List[List[FMInstrument]] = []
+        for root in np.unique(roots):
+            members = np.concatenate([
+                self.groups[x] for x in np.nonzero(roots == root)[0]
+            ])
+            members.sort()
+            clusters.append([self.insts[j] for j in members])
+        clusters.sort(key=len, reverse=True)
+        return clusters
+
+
+# API functions
+def find_near_duplicates(
+    insts: List[FMInstrument],
+    threshold=1.0
+) -> List[List[FMInstrument]]:
+    '''
+    Convenience wrapper around `InstrumentIndex.cluster()` that only returns
+    clusters containing more than one instrument.
+
+    :param insts: A list of FMInstrument instances.
+    :param threshold: The maximum distance between linked instruments.
+    '''
+    return [
+        c for c in InstrumentIndex(insts).cluster(threshold) if len(c) > 1
+    ]
+
+
+if __name__ == "__main__":
+    if len(CMD_ARGS) < 2:
+        print("Please specify an input folder, and optionally a threshold.")
+        exit()
+
+    threshold = float(CMD_ARGS[2]) if len(CMD_ARGS) >= 3 else 1.0
+    insts: List[FMInstrument] = []
+    for f in glob(f"{CMD_ARGS[1]}/*.MDT"):
+        try:
+            insts.extend(parse_mdt(f).fm)
+        except BaseException as err:
+            print("Skipping file", remove_path(f), "due to error:", err)
+
+    for i, cluster in enumerate(find_near_duplicates(insts, threshold)):
+        print(f"Group {i}:")
+        for inst in cluster:
+            print("   ", inst.gen_files_str(), inst.mml_names)
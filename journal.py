@@ -0,0 +1,125 @@
+# Contains a journal for keeping track of progress during batch exports, so
+# that a crash (or a killed process) three hours into converting a huge folder
+# doesn't mean starting over from scratch.
+
+# The journal is a plain text file in the output folder, with one JSON object
+# per line: which input was processed, for which export, what it wrote, and
+# what went wrong (if anything). Lines are only ever appended, and each one is
+# flushed to disk right away, so the worst a crash can do is cut off the last
+# line, which gets ignored when the journal is read back.
+
+# Inputs are identified by their filename AND their content fingerprint, so an
+# input that's been changed since it was last exported gets exported again.
+# The same goes for the conversion options (portamento rate, instrument maps,
+# loop handling, etc.): each entry has a digest of the ones it was exported
+# with, and only counts as done if they're the same this time around.
+
+
+from json import dumps, loads
+from os import fsync
+from os.path import isfile
+from typing import List, Dict, Optional, Tuple
+
+from mdt_decomp_rip import Song
+from mdt_fingerprint import Fingerprint, digest
+
+
+# Constants
+JOURNAL_FILENAME = "mdtparse_journal.jsonl"
+
+
+# Classes
+class Journal:
+    def __init__(self, folder: str, options: Optional[dict] = None):
+        '''
+        Opens (or creates) the journal in an output folder.
+
+        :param folder: A path to the output folder.
+        :param options: The options everything's being exported with. Must be
+            JSON-serializable.
+        '''
+        self.filename = folder + "/" + JOURNAL_FILENAME
+        self.options = digest(dumps(options or {}, sort_keys=True))
+        self.done: Dict[Tuple[str, str, str, str], List[str]] = {}
+        self.fingerprints: Dict[int, str] = {}
+
+        if isfile(self.filename):
+            with open(self.filename, "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        entry = loads(line)
+                    except ValueError:
+                        # Probably the last line, cut off by a crash
+                        continue
+                    key = (
+                        entry["stage"],
+                        entry["input"],
+                        entry["content"],
+                        entry.get("options", "")
+                    )
+                    if entry.get("error"):
+                        self.done.pop(key, None)
+                    else:
+                        self.done[key] = entry["outputs"]
+
+        self.file = open(self.filename, "a", encoding="utf-8")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.file.close()
+
+    def key(self, stage: str, song: Song) -> Tuple[str, str, str, str]:
+        # Fingerprinting isn't free, so only do it once per Song
+        content = self.fingerprints.get(id(song))
+        if content is None:
+            content = Fingerprint(song).content
+            self.fingerprints[id(song)] = content
+        return (stage, song.filename, content, self.options)
+
+    def is_done(self, stage: str, song: Song) -> bool:
+        '''
+        Returns True if `song` was already exported successfully for `stage`,
+        with the same options, and everything it wrote is still there.
+        '''
+        outputs = self.done.get(self.key(stage, song))
+        return outputs is not None and all(isfile(v) for v in outputs)
+
+    def done_count(self, stage: str, song_list: List[Song]) -> int:
+        return sum(1 for s in song_list if self.is_done(stage, s))
+
+    def record(
+        self,
+        stage: str,
+        song: Song,
+        outputs: List[str],
+        error: Optional[BaseException] = None
+    ):
+        '''
+        Appends an entry to the journal, and makes sure it's actually on disk
+        before returning.
+
+        :param stage: Which export this is for, e.g. `"md2"` or `"midi"`.
+        :param song: The Song that was exported.
+        :param outputs: Paths to the files that were written.
+        :param error: The error that stopped the export, if any.
+        '''
+        key = self.key(stage, song)
+        self.file.write(dumps({
+            "stage": stage,
+            "input": song.filename,
+            "content": key[2],
+            "options": key[3],
+            "outputs": outputs,
+            "error": str(error) if (error is not None) else None
+        }) + "\n")
+        self.file.flush()
+        fsync(self.file.fileno())
+        if error is None:
+            self.done[key] = outputs
+        else:
+            self.done.pop(key, None)
@@ -0,0 +1,350 @@
+# Contains an optional compression pass for decompiled songs, which finds
+# phrases that channels repeat (without using a loop or macro for them), and
+# moves each one into a new macro (#n) that's called with U instead. The MD2
+# files come out a lot smaller, and still play the same.
+
+# Finding repeats is done with rolling hashes: every window of L events gets a
+# hash, windows with the same hash are repeats, and each repeat is extended
+# for as long as all of its copies keep matching. L starts big and halves
+# each pass, so longer phrases get first dibs on events, and each pass takes
+# O(n log n) time (for sorting the hashes), for a handful of passes.
+
+# Only some events can go in a new macro. Macros don't get the channel's
+# octave, and md2mml_midi doesn't hand everything set in a macro back to the
+# channel, so phrases can only contain notes, rests, ties, octaves, volumes
+# and note-offs. Each macro starts by setting its octave, and the channel
+# sets its octave again after the call if the phrase changed it. Loops, macro
+# calls and the infinite loop point are never moved, and neither is anything
+# on RHYTHM or ADPCM channels.
+
+# With cut time, the decompiler doubles note lengths in channels but not in
+# macros (see EventDecoder.decode()), so lengths are halved on the way in.
+
+
+from copy import copy
+from sys import argv as CMD_ARGS, exit
+from typing import Dict, List, Tuple
+
+import numpy as np
+
+from md2mml_midi import CLOCKS_PER_QUARTER, NOTE_NAME_CHARS, NOTE_STARTS
+from md2mml_midi import parse_length
+from mdt_decomp_rip import Channel, Macro, Song, mml_length, parse_mdt
+
+
+# Constants
+MIN_RUN = 4  # Events. Anything shorter barely saves anything.
+MAX_RUN = 256  # Longest window hashed. Repeats can still grow past it.
+HASH_BASE = 0x100000001B3
+MOVABLE_COMMANDS = {"&", "O", "/", "V", "@V", "@V+", "@V-"}
+MELODIC_FLAGS = [0x80, 0x40]  # FM and SSG
+
+
+# Helper functions
+def is_movable(command: str) -> bool:
+    return (
+        command[0] in NOTE_STARTS or command[0] in "(r"
+        or command in MOVABLE_COMMANDS
+    )
+
+
+def length_split(command: str) -> int:
+    # Returns where the length starts in a note, rest or portamento
+    if command[0] == "(":
+        return command.index(")") + 1
+    i = 0
+    while command[i] in "<>r" or command[i] in NOTE_NAME_CHARS:
+        i += 1
+    return i
+
+
+def halve_length(event: list) -> list:
+    command = event[0]
+    if not (command[0] in NOTE_STARTS or command[0] in "(r"):
+        return event
+    split = length_split(command)
+    clocks = round(parse_length(command[split:]) * CLOCKS_PER_QUARTER)
+    return [command[:split] + mml_length(clocks // 2, False), *event[1:]]
+
+
+def channel_tokens(
+    ch: Channel,
+    keys: Dict[tuple, int]
+) -> Tuple[List[int], List[bool], List[int], List[int]]:
+    '''
+    Returns a token for each event (the same for events that play the same),
+    whether each event can be moved into a macro, and the octave before and
+    after each event.
+    '''
+    tokens: List[int] = []
+    movable: List[bool] = []
+    before: List[int] = []
+    after: List[int] = []
+    octave = -1  # Not set yet
+    octave_stack: List[int] = []
+    for event in ch.events:
+        command = event[0]
+        before.append(octave)
+        key = tuple(event)
+        if command[0] in NOTE_STARTS:
+            if command[0] == "<":
+                octave -= 1
+            elif command[0] == ">":
+                octave += 1
+            # Notes are compared by the octave they're actually in
+            key = (command.lstrip("<>"), octave)
+        elif command == "O":
+            octave = event[1]
+        elif command == "|:":
+            # Same as the decoder (only these loops can be exited early)
+            octave_stack.append(-1)
+        elif command == ":" and octave_stack and octave_stack[-1] == -1:
+            octave_stack[-1] = octave
+        elif command == ":|" and octave_stack:
+            if octave_stack[-1] >= 0:
+                octave = octave_stack[-1]
+            octave_stack.pop()
+        tokens.append(keys.setdefault(key, len(keys)))
+        movable.append(
+            is_movable(command)
+            and not (command[0] in NOTE_STARTS and before[-1] < 0)
+        )
+        after.append(octave)
+    return (tokens, movable, before, after)
+
+
+def prefix_hashes(tokens: List[int]) -> np.ndarray:
+    # Polynomial hashes of every prefix, mod 2 ** 64
+    result = [0]
+    for t in tokens:
+        result.append((result[-1] * HASH_BASE + t) & 0xFFFFFFFFFFFFFFFF)
+    return np.array(result, dtype=np.uint64)
+
+
+def window_hashes(prefix: np.ndarray, length: int) -> np.ndarray:
+    # Hashes of every window of `length` tokens. Arithmetic on uint64 arrays
+    # wraps around, which is exactly what's wanted here.
+    power = np.array([pow(HASH_BASE, length, 1 << 64)], dtype=np.uint64)
+    return prefix[length:] - prefix[:len(prefix) - length] * power
+
+
+# Classes
+class Repeat:
+    def __init__(self, starts: List[int], length: int):
+        '''
+        A run of events that shows up more than once.
+
+        :param starts: Where each copy starts, in the combined event list.
+        :param length: How many events each copy is.
+        '''
+        self.starts = starts
+        self.length = length
+
+
+class RepeatFinder:
+    def __init__(self, channels: List[Channel]):
+        '''
+        Finds repeats across channels of the same type. Every channel's
+        events go into one list, with an unmovable gap between channels.
+        '''
+        self.channels = channels
+        self.offsets: List[int] = []
+        keys: Dict[tuple, int] = {}
+        tokens: List[int] = []
+        movable: List[bool] = []
+        self.before: List[int] = []
+        self.after: List[int] = []
+        for ch in channels:
+            t, m, b, a = channel_tokens(ch, keys)
+            self.offsets.append(len(tokens))
+            tokens += t + [-1]
+            movable += m + [False]
+            self.before += b + [-1]
+            self.after += a + [-1]
+        self.tokens = np.array(tokens, dtype=np.int64)
+        self.prefix = prefix_hashes(tokens)
+        self.blocked = ~np.array(movable, dtype=bool)
+        # Ties can't be split from the notes they join
+        is_tie = np.array(
+            [e[0] == "&" for ch in channels for e in ch.events + [["r"]]],
+            dtype=bool
+        )
+        self.splittable = np.ones(len(tokens) + 1, dtype=bool)
+        self.splittable[1:] &= ~is_tie
+        self.splittable[:-1] &= ~is_tie
+        self.repeats: List[Repeat] = []
+
+    def find(self, min_run=MIN_RUN, max_run=MAX_RUN) -> List[Repeat]:
+        length = max_run
+        while length >= min_run:
+            if length <= len(self.tokens):
+                self.find_pass(length)
+            length //= 2
+        return self.repeats
+
+    def find_pass(self, length: int):
+        tokens = self.tokens
+        n = len(tokens)
+        # A window works if nothing in it is blocked (or already taken), and
+        # it doesn't split a tie at either end
+        blocked_sums = np.concatenate(([0], np.cumsum(self.blocked)))
+        starts = np.flatnonzero(
+            (blocked_sums[length:] == blocked_sums[:n - length + 1])
+            & self.splittable[:n - length + 1]
+            & self.splittable[length:]
+        )
+        if len(starts) < 2:
+            return
+        hashes = window_hashes(self.prefix, length)[starts]
+        order = np.lexsort((starts, hashes))
+        starts = starts[order]
+        hashes = hashes[order]
+        group_ends = np.flatnonzero(np.diff(hashes)) + 1
+        bounds = np.concatenate(([0], group_ends, [len(starts)]))
+
+        for lo, hi in zip(bounds[:-1].tolist(), bounds[1:].tolist()):
+            if hi - lo < 2:
+                continue
+            self.take(starts[lo:hi].tolist(), length)
+
+    def take(self, candidates: List[int], length: int):
+        tokens = self.tokens
+        blocked = self.blocked
+        first = tokens[candidates[0]:candidates[0] + length]
+        # Copies can't overlap each other, or anything taken this pass. Since
+        # everything taken this pass is at least `length` long, checking the
+        # ends of a window is enough.
+        chosen: List[int] = []
+        for s in candidates:
+            if blocked[s] or blocked[s + length - 1]:
+                continue
+            if chosen and s < chosen[-1] + length:
+                continue
+            if not np.array_equal(tokens[s:s + length], first):
+                continue  # Hash collision
+            chosen.append(s)
+        if len(chosen) < 2:
+            return
+
+        # Grow every copy for as long as they all keep matching
+        run = length
+        best = length
+        while True:
+            ends = [s + run for s in chosen]
+            if any(
+                e >= len(tokens) or blocked[e]
+                or tokens[e] != tokens[ends[0]]
+                for e in ends
+            ) or any(
+                e >= nxt for e, nxt in zip(ends, chosen[1:])
+            ):
+                break
+            run += 1
+            if all(self.splittable[e + 1] for e in ends):
+                best = run
+
+        # Each copy turns into a U (and maybe an O), and the macro has an O
+        if len(chosen) * best <= best + 1 + 2 * len(chosen):
+            return
+        for s in chosen:
+            blocked[s:s + best] = True
+        self.repeats.append(Repeat(chosen, best))
+
+    def locate(self, pos: int) -> Tuple[int, int]:
+        # Returns the channel number and event index of a combined position
+        i = int(np.searchsorted(self.offsets, pos, side="right")) - 1
+        return (i, pos - self.offsets[i])
+
+
+# API functions
+def compress_song(
+    song: Song,
+    cut_time=False,
+    min_run=MIN_RUN
+) -> Song:
+    '''
+    Returns a copy of `song` where phrases its channels repeat are moved into
+    new macros. The original Song isn't changed.
+
+    :param song: A Song instance returned from `parse_mdt()`.
+    :param cut_time: Must match what `song` was parsed with.
+    :param min_run: The fewest events a phrase can have to get a macro.
+    '''
+    result = copy(song)
+    result.channels = [copy(ch) for ch in song.channels]
+    result.macros = dict(song.macros)
+    next_id = len(song.macros)
+
+    # Replacements for each channel: event index: (length, new events)
+    replacements: Dict[int, Dict[int, Tuple[int, list]]] = {}
+    for flag in MELODIC_FLAGS:
+        indices = [
+            i for i, ch in enumerate(song.channels) if ch.id & 0xF0 == flag
+        ]
+        if not indices:
+            continue
+        finder = RepeatFinder([song.channels[i] for i in indices])
+        for repeat in finder.find(min_run):
+            first = repeat.starts[0]
+            ch_num, index = finder.locate(first)
+            events = song.channels[indices[ch_num]].events[
+                index:index + repeat.length
+            ]
+            if cut_time:
+                events = [halve_length(e) for e in events]
+            # Notes at the start depend on the octave from before the macro
+            for e in events:
+                if e[0][0] in NOTE_STARTS:
+                    events = [["O", finder.before[first]]] + events
+                    break
+                if e[0] == "O":
+                    break
+
+            macro = Macro(location=-1 - next_id, id=flag, macro_id=next_id)
+            macro.events = [list(e) for e in events]
+            result.macros[macro.location] = macro
+
+            for s in repeat.starts:
+                ch_num, index = finder.locate(s)
+                new_events = [["U", next_id]]
+                end_octave = finder.after[s + repeat.length - 1]
+                if end_octave != finder.before[s]:
+                    new_events.append(["O", end_octave])
+                replacements.setdefault(indices[ch_num], {})[index] = (
+                    repeat.length, new_events
+                )
+            next_id += 1
+
+    for ch_num, spans in replacements.items():
+        ch = result.channels[ch_num]
+        events = []
+        i = 0
+        while i < len(ch.events):
+            if i in spans:
+                length, new_events = spans[i]
+                events += new_events
+                i += length
+            else:
+                events.append(ch.events[i])
+                i += 1
+        ch.events = events
+    return result
+
+
+if __name__ == "__main__":
+    if len(CMD_ARGS) < 3:
+        print(
+            "Please specify an input MDT file and an output MD2 file, and",
+            "optionally whether to use cut time (True or False)."
+        )
+        exit()
+
+    cut_time = len(CMD_ARGS) >= 4 and CMD_ARGS[3].lower() == "true"
+    song = parse_mdt(CMD_ARGS[1], cut_time)
+    compressed = compress_song(song, cut_time)
+    compressed.write_md2_file(CMD_ARGS[2])
+    print(
+        "Added {} macro(s).".format(
+            len(compressed.macros) - len(song.macros)
+        )
+    )
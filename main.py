@@ -1,9 +1,11 @@
 from sys import exit
 from os.path import isfile, isdir
 from glob import glob
-from typing import List, Dict, cast
+from multiprocessing import freeze_support
+from typing import List, Dict, Optional, Tuple, cast
 
 from mdt_decomp_rip import (
+    atomic_open,
     write_opm_header,
     write_unused_warning,
     remove_path,
@@ -12,10 +14,15 @@ from mdt_decomp_rip import (
     parse_mdt,
     process_insts_in_songs
 )
+from mdt_fingerprint import identify_songs, load_default_index
+from batch import estimate_cost, run_batch, midi_job
+from journal import Journal
+from macro_compress import compress_song
 from md2mml_midi import (
     SUGGESTED_INST_NUMS,
     SUGGESTED_SSG_NUMS,
     APPROXIMATION_SSG_NUMS,
+    PORTAMENTO_TOLERANCE,
     parse_song,
     write_midi_file,
     MIDIFile
@@ -67,6 +74,24 @@ def yes_no(*question_parts: str) -> bool:
     return answer in AFFIRMATIVES
 
 
+def resume_from_journal(
+    journal: Journal,
+    stage: str,
+    song_list: List[Song]
+) -> List[Song]:
+    # Offer to skip whatever was finished last time
+    done = journal.done_count(stage, song_list)
+    if done == 0:
+        return song_list
+    whether_resume = yes_no(
+        f"{done} of {len(song_list)} file(s) were already exported to this",
+        "folder by a previous run. Skip them?"
+    )
+    if not whether_resume:
+        return song_list
+    return [s for s in song_list if not journal.is_done(stage, s)]
+
+
 # Subroutines (so I don't hate myself when writing main())
 def input_subroutine() -> (str, bool):
     path = ""
@@ -82,9 +107,10 @@ def parse_subroutine(
     path_input: str,
     input_is_file: bool,
     whether_cut_time: bool
-) -> list:
+) -> Tuple[List[Song], Dict[str, int]]:
     print("Parsing input MDT file(s)...")
     song_list = []
+    costs: Dict[str, int] = {}
 
     # Give credit where it's due
     print(longstr(
@@ -108,19 +134,42 @@ def parse_subroutine(
             exit()
 
     else:
-        for f in glob(f"{path_input}/*.MDT"):
-            try:
-                s = parse_mdt(f, whether_cut_time)
-                song_list.append(s)
-            except BaseException as err:
-                print("Skipping file", remove_path(f), "due to error:", err)
+        # Parse several files at once, biggest first
+        files = glob(f"{path_input}/*.MDT")
+        file_costs = [estimate_cost(f) for f in files]
+        parsed: Dict[int, Song] = {}
+        for i, s, err in run_batch(
+            parse_mdt,
+            [(f, whether_cut_time) for f in files],
+            file_costs
+        ):
+            if err is not None:
+                print(
+                    "Skipping file", remove_path(files[i]),
+                    "due to error:", err
+                )
                 continue
+            parsed[i] = s
+            costs[s.filename] = file_costs[i]
+
+        # Keep the files in the same order as before
+        song_list = [parsed[i] for i in sorted(parsed)]
+
+    # Recognize renamed tracks, if there's a fingerprint index to do it with
+    index = load_default_index(whether_cut_time)
+    if index is not None:
+        recognized = identify_songs(song_list, index)
+        print(f"Recognized {recognized} of {len(song_list)} file(s).")
 
     print("DONE")
-    return song_list
+    return (song_list, costs)
 
 
-def md2_subroutine(song_list: List[Song], input_is_file: bool):
+def md2_subroutine(
+    song_list: List[Song],
+    input_is_file: bool,
+    cut_time: bool
+):
     # Possibly exit subroutine early
     whether_decompile = yes_no(
         "Would you like to decompile the MDT file(s) to MD2 (MML) file(s)?"
@@ -128,6 +177,15 @@ def md2_subroutine(song_list: List[Song], input_is_file: bool):
     if not whether_decompile:
         return
 
+    whether_compress = yes_no(
+        "Would you like to move repeated phrases into new macros?",
+        "This makes the MD2 file(s) smaller, but harder to compare to the",
+        "original(s)."
+    )
+    if whether_compress:
+        # Copies, so the MIDI conversion below uses the original events
+        song_list = [compress_song(s, cut_time) for s in song_list]
+
     # Output MD2 file(s)
     if input_is_file:
         while True:
@@ -156,13 +214,22 @@ def md2_subroutine(song_list: List[Song], input_is_file: bool):
                     "Please specify an output folder for the MD2 files:"
                 )
 
-            # Try to write to it
+            # Try to write to it, keeping track of progress in case something
+            # goes wrong halfway through
             try:
-                for s in song_list:
-                    filename = s.filename
-                    if len(filename) >= 4 and filename[-4:].upper() == ".MDT":
-                        filename = filename[:-4] + ".MD2"
-                    s.write_md2_file(path + "/" + filename)
+                with Journal(path, {
+                    "cut_time": cut_time,
+                    "compress": whether_compress
+                }) as journal:
+                    for s in resume_from_journal(journal, "md2", song_list):
+                        filename = s.filename
+                        if (
+                            len(filename) >= 4
+                            and filename[-4:].upper() == ".MDT"
+                        ):
+                            filename = filename[:-4] + ".MD2"
+                        s.write_md2_file(path + "/" + filename)
+                        journal.record("md2", s, [path + "/" + filename])
             except OSError:
                 print(longstr(
                     "Failed to write to folder.",
@@ -208,11 +275,10 @@ def opm_subroutine(song_list: List[Song]) -> Dict[str, Dict[int, int]]:
 
             # Try to write to it
             try:
-                with open(path, "w") as f:
+                with atomic_open(path, "w") as f:
                     write_opm_header(f)
                     for i, v in enumerate(used):
                         f.write(v.opm_str(i))
-                    f.close()
             except OSError:
                 print("Failed to create file. Please enter a different path.")
                 continue
@@ -231,12 +297,11 @@ def opm_subroutine(song_list: List[Song]) -> Dict[str, Dict[int, int]]:
 
             # Try to write to it
             try:
-                with open(path, "w") as f:
+                with atomic_open(path, "w") as f:
                     write_unused_warning(f)
                     write_opm_header(f)
                     for i, v in enumerate(unused):
                         f.write(v.opm_str(i))
-                    f.close()
             except OSError:
                 print("Failed to create file. Please enter a different path.")
                 continue
@@ -248,6 +313,7 @@ def opm_subroutine(song_list: List[Song]) -> Dict[str, Dict[int, int]]:
 
 def midi_subroutine(
     song_list: List[Song],
+    costs: Dict[str, int],
     inst_map: Dict[str, Dict[int, int]],
     input_is_file: bool,
     cut_time: bool
@@ -333,7 +399,30 @@ def midi_subroutine(
     # Figure out what portamento rate to use
     # Can you say "feature creep?" 😏
     portamento_rate = 55
-    while True:
+    portamento_tolerance: Optional[float] = None
+    whether_bend = yes_no(
+        "Would you like to play portamentos with pitch bends that follow",
+        "MDRV2's glides, instead of with MIDI portamento?"
+    )
+    while whether_bend:
+        # Get a tolerance
+        answer = prompt(
+            "Please specify how far (in cents) the pitch bends can be from",
+            "the glides, or leave empty to use the default ({}):".format(
+                PORTAMENTO_TOLERANCE
+            )
+        )
+        if not answer:
+            portamento_tolerance = PORTAMENTO_TOLERANCE
+            break
+        try:
+            portamento_tolerance = float(answer)
+            if not portamento_tolerance >= 0:
+                continue
+            break
+        except ValueError:
+            continue
+    while not whether_bend:
         # Get a portamento rate
         answer = prompt(
             "Please specify a portamento rate to use (0-127, inclusive),",
@@ -352,6 +441,33 @@ def midi_subroutine(
         except ValueError:
             continue
 
+    # Figure out what to do with infinite loops
+    loop_markers = yes_no(
+        "Would you like to mark infinite loops with CC111 and",
+        "loopStart/loopEnd text events?"
+    )
+    loop_count: Optional[int] = None
+    whether_extend_loops = yes_no(
+        "Would you like to extend infinite loops, so that every part ends",
+        "at the same time?"
+    )
+    if whether_extend_loops:
+        loop_count = 1
+        while True:
+            answer = prompt(
+                "Please specify how many more times the longest loop should",
+                "play, or leave empty to use the default (1):"
+            )
+            if not answer:
+                break
+            try:
+                loop_count = int(answer)
+                if loop_count < 0:
+                    continue
+                break
+            except ValueError:
+                continue
+
     # Export one MIDI file
     if input_is_file:
         s = song_list[0]
@@ -364,7 +480,10 @@ def midi_subroutine(
                 fm_inst_map=fm_inst_map,
                 ssg_inst_map=ssg_inst_map,
                 portamento_rate=portamento_rate,
-                cut_time=cut_time
+                cut_time=cut_time,
+                loop_markers=loop_markers,
+                loop_count=loop_count,
+                portamento_tolerance=portamento_tolerance
             )
         except BaseException as err:
             print("Could not convert file", s.filename, "due to error:", err)
@@ -395,41 +514,68 @@ def midi_subroutine(
             if not isdir(path):
                 continue
 
-            # Try... several things
+            # Keep track of progress in case something goes wrong halfway
             try:
-                for s in song_list:
-                    # Convenience variables
-                    filename = s.filename
-                    if len(filename) >= 4 and filename[-4:].upper() == ".MDT":
-                        filename = filename[:-4] + ".MID"
-                    midi: MIDIFile
-
-                    # Try to convert to MIDI
-                    try:
-                        midi = parse_song(
-                            song=s,
-                            fm_inst_map=fm_inst_map,
-                            ssg_inst_map=ssg_inst_map,
-                            portamento_rate=portamento_rate,
-                            cut_time=cut_time
-                        )
-                    except BaseException as err:
-                        print(
-                            "Skipping file", s.filename, "due to error:", err
-                        )
-                        continue
-
-                    # Try to write to the directory from before
-                    write_midi_file(
-                        filename=path + "/" + filename,
-                        midi_file=midi
-                    )
+                journal = Journal(path, {
+                    "fm_inst_map": fm_inst_map,
+                    "ssg_inst_map": ssg_inst_map,
+                    "portamento_rate": portamento_rate,
+                    "portamento_tolerance": portamento_tolerance,
+                    "cut_time": cut_time,
+                    "loop_markers": loop_markers,
+                    "loop_count": loop_count
+                })
             except OSError:
                 print(longstr(
                     "Failed to write to folder.",
                     "Please specify a different output folder."
                 ))
                 continue
+            todo = resume_from_journal(journal, "midi", song_list)
+
+            # Convert several files at once, biggest first. The workers
+            # write the files themselves.
+            jobs = []
+            for s in todo:
+                filename = s.filename
+                if len(filename) >= 4 and filename[-4:].upper() == ".MDT":
+                    filename = filename[:-4] + ".MID"
+                jobs.append((
+                    s,
+                    path + "/" + filename,
+                    fm_inst_map,
+                    ssg_inst_map,
+                    portamento_rate,
+                    cut_time,
+                    loop_markers,
+                    loop_count,
+                    portamento_tolerance
+                ))
+
+            # Try... several things
+            failed_to_write = False
+            for i, result, err in run_batch(
+                midi_job,
+                jobs,
+                [costs.get(s.filename, 0) for s in todo]
+            ):
+                journal.record(
+                    "midi", todo[i], [result] if result else [], err
+                )
+                if isinstance(err, OSError):
+                    failed_to_write = True
+                elif err is not None:
+                    print(
+                        "Skipping file", todo[i].filename,
+                        "due to error:", err
+                    )
+            journal.close()
+            if failed_to_write:
+                print(longstr(
+                    "Failed to write to folder.",
+                    "Please specify a different output folder."
+                ))
+                continue
             break
 
     print("DONE")
@@ -454,7 +600,7 @@ def main():
     )
 
     # Parse all the things!
-    song_list: List[Song] = parse_subroutine(
+    song_list, costs = parse_subroutine(
         path_input,
         input_is_file,
         whether_cut_time
@@ -462,7 +608,7 @@ def main():
     empty_line()
 
     # Decompile stuff!
-    md2_subroutine(song_list, input_is_file)
+    md2_subroutine(song_list, input_is_file, whether_cut_time)
     empty_line()
 
     # Do OPM stuff!
@@ -470,7 +616,13 @@ def main():
     empty_line()
 
     # Now export MIDI! (If the user wants)
-    midi_subroutine(song_list, fm_inst_map, input_is_file, whether_cut_time)
+    midi_subroutine(
+        song_list,
+        costs,
+        fm_inst_map,
+        input_is_file,
+        whether_cut_time
+    )
     empty_line()
 
     print("All tasks complete!")
@@ -478,4 +630,6 @@ def main():
 
 
 if __name__ == "__main__":
+    # Needed for the worker processes to work in the Windows EXE
+    freeze_support()
     main()
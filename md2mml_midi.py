@@ -1,20 +1,60 @@
 from MidiFile import MIDIFile
+from bisect import bisect_right
+from collections import deque
+from copy import copy
 from io import TextIOWrapper as FILE
-from math import floor
+from heapq import merge
+from itertools import chain
+from math import ceil, floor, gcd, log2, trunc
 from sys import argv as CMD_ARGS, exit
-from typing import List, Dict, Union
+from typing import (
+    Callable,
+    Deque,
+    Generator,
+    Iterator,
+    List,
+    Dict,
+    Optional,
+    Tuple,
+    Union
+)
 
 from mdt_decomp_rip import (
     NOTE_NAMES,
+    atomic_open,
+    chip_profile,
     remove_path,
+    ChipProfile,
     Song,
     Channel,
     Macro
 )
+from mdrv2_emu import (
+    FM_FNUMS,
+    OCTAVE_STEPS,
+    midi_frequency,
+    portamento_step,
+    ssg_period
+)
 
 
 # Constants
 MIDI_EPSILON = 3 / 960
+MIDI_PITCH_MAX = 127  # G9
+CLOCKS_PER_QUARTER = 48
+# How often channel state is saved for seeking: every 4 bars of 4/4
+SNAPSHOT_INTERVAL = CLOCKS_PER_QUARTER * 16
+# Infinite loop markers, as understood by RPG Maker and plenty of players
+LOOP_CONTROLLER = 111
+LOOP_START_TEXT = "loopStart"
+LOOP_END_TEXT = "loopEnd"
+# Extended loops are lined up so the whole song loops seamlessly, unless that
+# would make it more than this many times longer than it'd be otherwise
+LOOP_ALIGN_LIMIT = 4
+# Portamentos as pitch bends
+PITCH_BEND_MAX = 8191
+BEND_RANGE_MIN = 2  # Semitones, the GM default
+PORTAMENTO_TOLERANCE = 5  # Cents, suggested
 
 # MIDI instrument suggestions for each track from HRtP
 # Made with Microsoft GS Wavetable Synth and Arachno Soundfont in mind.
@@ -278,6 +318,8 @@ class NoteEvent:
         self.time = time
         self.duration = duration
         self.velocity = velocity
+        # Whether a portamento left the pitch bent while this note played
+        self.bent = False
 
     def extend(self, duration: float):
         '''
@@ -285,6 +327,9 @@ class NoteEvent:
         '''
         self.duration += duration
 
+    def notes(self) -> List["NoteEvent"]:
+        return [self]
+
     def write(self, midi_file: MIDIFile):
         '''
         Writes this NoteEvent to the specified MIDIFile.
@@ -325,37 +370,232 @@ class PercussionEvent:
         '''
         self.duration += duration
 
-    def write(self, midi_file: MIDIFile):
+    def notes(self) -> List[NoteEvent]:
         '''
-        Writes this PercussionEvent to the specified MIDIFile.
-
-        :param midi_file: The MIDIFile in question.
+        Returns a NoteEvent (on MIDI channel 10) for each RHYTHM sample hit.
         '''
-        a: List[int] = [0, 9]  # Track and channel - deconstructed later
-        b: List[float] = [self.time, self.duration]  # Time and duration - same
+        result: List[NoteEvent] = []
+        a = [9]  # Channel - deconstructed later
+        b = [self.time, self.duration]  # Time and duration - same
         if self.samples & 1:
             # Bass drum
-            midi_file.addNote(*a, 36, *b, self.bass_v)  # C2
+            result.append(NoteEvent(*a, 36, *b, self.bass_v))  # C2
         if self.samples & 2:
             # Snare drum
-            midi_file.addNote(*a, 38, *b, self.snare_v)  # D2
+            result.append(NoteEvent(*a, 38, *b, self.snare_v))  # D2
         if self.samples & 4:
             # Top cymbal
-            midi_file.addNote(*a, 46, *b, self.cymbal_v)  # A#2 (Bb2)
+            result.append(NoteEvent(*a, 46, *b, self.cymbal_v))  # A#2 (Bb2)
         if self.samples & 8:
             # Hi-hat
-            midi_file.addNote(*a, 42, *b, self.hat_v)  # F#2 (Gb2)
+            result.append(NoteEvent(*a, 42, *b, self.hat_v))  # F#2 (Gb2)
         if self.samples & 16:
             # Tom
-            midi_file.addNote(*a, 48, *b, self.tom_v)  # C3
+            result.append(NoteEvent(*a, 48, *b, self.tom_v))  # C3
         if self.samples & 32:
             # Rim shot
-            midi_file.addNote(*a, 37, *b, self.rim_v)  # C#2 (Db2)
+            result.append(NoteEvent(*a, 37, *b, self.rim_v))  # C#2 (Db2)
+        return result
+
+    def write(self, midi_file: MIDIFile):
+        '''
+        Writes this PercussionEvent to the specified MIDIFile.
+
+        :param midi_file: The MIDIFile in question.
+        '''
+        for n in self.notes():
+            n.write(midi_file)
+
+
+class ControlEvent:
+    def __init__(
+        self,
+        channel: int,
+        time: float,
+        controller_number: int,
+        parameter: int
+    ):
+        self.channel = channel
+        self.time = time
+        self.controller_number = controller_number
+        self.parameter = parameter
+
+    def write(self, midi_file: MIDIFile):
+        midi_file.addControllerEvent(
+            track=0,
+            channel=self.channel,
+            time=self.time,
+            controller_number=self.controller_number,
+            parameter=self.parameter
+        )
+
+
+class ProgramEvent:
+    def __init__(self, channel: int, time: float, program: int):
+        self.channel = channel
+        self.time = time
+        self.program = program
+
+    def write(self, midi_file: MIDIFile):
+        midi_file.addProgramChange(
+            tracknum=0,
+            channel=self.channel,
+            time=self.time,
+            program=self.program
+        )
+
+
+class TempoEvent:
+    def __init__(self, time: float, tempo: int):
+        self.time = time
+        self.tempo = tempo
+
+    def write(self, midi_file: MIDIFile):
+        midi_file.addTempo(
+            track=0,
+            time=self.time,
+            tempo=self.tempo
+        )
+
+
+class PitchBendEvent:
+    def __init__(self, channel: int, time: float, value: int):
+        self.channel = channel
+        self.time = time
+        self.value = value  # -8192 to 8191
+
+    def write(self, midi_file: MIDIFile):
+        midi_file.addPitchWheelEvent(
+            track=0,
+            channel=self.channel,
+            time=self.time,
+            pitchWheelValue=self.value
+        )
+
+
+class TextEvent:
+    def __init__(self, time: float, text: str):
+        self.time = time
+        self.text = text
+
+    def write(self, midi_file: MIDIFile):
+        midi_file.addText(
+            track=0,
+            time=self.time,
+            text=self.text
+        )
+
+
+# Everything iter_song_events() can yield (PercussionEvents are split into
+# NoteEvents first). Times are in quarter notes, as in MIDIUtil.
+SongEvent = Union[
+    NoteEvent,
+    PercussionEvent,
+    ControlEvent,
+    ProgramEvent,
+    TempoEvent,
+    TextEvent,
+    PitchBendEvent
+]
+
+
+class Snapshot:
+    def __init__(
+        self,
+        time: float,
+        frames: List[tuple],
+        rhythm_velocities: List[int],
+        last_note: Optional[NoteEvent],
+        chase: Dict[tuple, SongEvent]
+    ):
+        self.time = time
+        # The state of each call in the macro call stack, outermost first
+        self.frames = frames
+        self.rhythm_velocities = rhythm_velocities
+        self.last_note = last_note
+        # The latest control, program and tempo events before the snapshot
+        self.chase = chase
+
+    def controls(self) -> dict:
+        '''
+        Returns the `controls` that make `iter_channel_events()` carry on from
+        this snapshot. (Can be used any number of times.)
+        '''
+        return {
+            "rhythm_velocities": list(self.rhythm_velocities),
+            "last_note": copy(self.last_note),
+            "resume": self.frames
+        }
+
+
+class SnapshotRecorder:
+    '''
+    Saves the state of a channel's interpreter (`iter_channel_events()`) every
+    so often, so playback can later be picked up from the nearest snapshot,
+    instead of replaying everything from the top. Snapshots are only taken
+    between events, so there's nothing half-done to save.
+    '''
+
+    def __init__(self, interval=SNAPSHOT_INTERVAL):
+        '''
+        :param interval: How often to take a snapshot, in clocks.
+        '''
+        self.interval = interval / CLOCKS_PER_QUARTER
+        self.next_time = 0.0
+        # Functions returning the state of each call in the macro call stack
+        self.frames: List[Callable[[], tuple]] = []
+        self.snapshots: List[Snapshot] = []
+        self.times: List[float] = []
+        self.chase: Dict[tuple, SongEvent] = {}
+
+    def record(
+        self,
+        time: float,
+        rhythm_velocities: List[int],
+        last_note: Optional[NoteEvent]
+    ):
+        self.snapshots.append(Snapshot(
+            time=time,
+            frames=[v() for v in self.frames],
+            rhythm_velocities=list(rhythm_velocities),
+            last_note=copy(last_note),
+            chase=dict(self.chase)
+        ))
+        self.times.append(time)
+        while self.next_time <= time:
+            self.next_time += self.interval
+
+    def watch(self, events: Generator) -> Generator:
+        '''
+        Passes along the events from `iter_channel_events()`, keeping track of
+        the ones that have to be re-sent after seeking.
+        '''
+        while True:
+            try:
+                event = next(events)
+            except StopIteration as done:
+                return done.value
+            key = chase_key(event)
+            if key is not None:
+                self.chase[key] = event
+            yield event
+
+    def find(self, time: float) -> Optional[Snapshot]:
+        '''
+        Returns the latest snapshot at or before `time`, if there is one.
+        '''
+        i = bisect_right(self.times, time)
+        return self.snapshots[i - 1] if i else None
 
 
 # Helper functions
 def parse_name(note_name: str, octave: int, transpose: int) -> int:
-    return NOTE_NAMES.index(note_name) + ((octave + 1) * 12) + transpose
+    pitch = NOTE_NAMES.index(note_name) + ((octave + 1) * 12) + transpose
+    # Octave 8 SSG notes land in MIDI octave 9, which stops at G, so anything
+    # above that is played an octave lower instead of crashing MIDIUtil
+    while pitch > MIDI_PITCH_MAX:
+        pitch -= 12
+    return pitch
 
 
 def parse_length(note_length: str, double=False) -> float:
@@ -377,18 +617,169 @@ def v_map(value: int, high1: int, high2: int) -> int:
     return floor(value * (high2 / high1))
 
 
+def fm_steps(pitch: int) -> int:
+    # Where a note is along MDRV2's F-number scale (see mdrv2_emu)
+    octave, note = divmod(pitch, 12)
+    return octave * OCTAVE_STEPS + FM_FNUMS[note] - OCTAVE_STEPS
+
+
+def fm_frequency(steps: int) -> int:
+    # Not in Hz, but proportional to it, which is enough for intervals
+    block, fnum = divmod(max(steps, 0), OCTAVE_STEPS)
+    return (fnum + OCTAVE_STEPS) << max(0, min(block, 7))
+
+
+def portamento_bends(
+    ssg: bool,
+    start: Tuple[int, int],
+    end: Tuple[int, int],
+    transpose: int,
+    clocks: int
+) -> List[float]:
+    '''
+    Returns how far (in semitones) MDRV2 has glided from the starting note
+    after each clock of a portamento, from 0 to `clocks`. FM channels glide
+    along the F-number scale, and SSG channels along the tone period (as in
+    mdrv2_emu), so neither is a straight line in semitones.
+
+    :param start: The starting octave and note (index in NOTE_NAMES), as
+    written in MML.
+    :param end: The ending octave and note.
+    '''
+    (start_octave, start_note), (end_octave, end_note) = start, end
+    if ssg:
+        start_period = ssg_period(midi_frequency(
+            (start_octave + 2) * 12 + start_note + transpose
+        ))
+        end_period = ssg_period(midi_frequency(
+            (end_octave + 2) * 12 + end_note + transpose
+        ))
+        step = (end_period - start_period) / max(clocks, 1)
+        return [
+            12 * log2(start_period / round(start_period + step * c))
+            for c in range(clocks + 1)
+        ]
+
+    start_steps = fm_steps(start_octave * 12 + start_note + transpose)
+    step = portamento_step(
+        False,
+        (start_octave << 4) | start_note,
+        (end_octave << 4) | end_note,
+        clocks
+    )
+    if step == 0:
+        # Not in the compiler's tables, so go by the F-numbers instead
+        step = trunc((
+            fm_steps(end_octave * 12 + end_note + transpose) - start_steps
+        ) / max(clocks, 1))
+    start_frequency = fm_frequency(start_steps)
+    return [
+        12 * log2(fm_frequency(start_steps + step * c) / start_frequency)
+        for c in range(clocks + 1)
+    ]
+
+
+def thin_bends(
+    bends: List[float],
+    tolerance: float
+) -> List[Tuple[int, float]]:
+    '''
+    Returns the (clock, semitones) points needed to follow `bends` (one per
+    clock) to within `tolerance` cents, where each point holds until the
+    next. Fast parts of a glide get a point every clock, and flat parts get
+    none.
+    '''
+    result = [(0, bends[0])]
+    for c, v in enumerate(bends):
+        if abs(v - result[-1][1]) * 100 > tolerance:
+            result.append((c, v))
+    return result
+
+
+def bend_value(semitones: float, bend_range: int) -> int:
+    value = round(semitones / bend_range * (PITCH_BEND_MAX + 1))
+    return max(-PITCH_BEND_MAX - 1, min(value, PITCH_BEND_MAX))
+
+
+def ties_back(events: List[list], start: int) -> bool:
+    '''
+    Returns whether the events from `start` on can tie onto the last note
+    played before them (as far as can be told without playing them).
+    '''
+    for event in events[start:]:
+        command = event[0]
+        if command == "&" or command == "U":
+            return True
+        if command[0] in NOTE_STARTS or command[0] == "(":
+            return False
+    return False
+
+
+def chase_key(event: SongEvent) -> Optional[tuple]:
+    # Events with the same key replace each other, as far as seeking goes.
+    # Loop markers only mean something where they are, so they're dropped.
+    if isinstance(event, ControlEvent):
+        if event.controller_number == LOOP_CONTROLLER:
+            return None
+        return (event.channel, event.controller_number)
+    if isinstance(event, ProgramEvent):
+        return (event.channel, "program")
+    if isinstance(event, PitchBendEvent):
+        return (event.channel, "bend")
+    if isinstance(event, TempoEvent):
+        return ("tempo",)
+    return None
+
+
+def channel_assignments(
+    song: Song,
+    fm_inst_map: Dict[str, Dict[int, int]],
+    ssg_inst_map: Dict[str, Dict[int, int]]
+) -> List[Tuple[Channel, int, Dict[int, int]]]:
+    '''
+    Returns each of the Song's channels, along with its MIDI channel and the
+    instrument map it uses.
+    '''
+    result = []
+    channel_number = 0
+    for ch in song.channels:
+        if ch.id & 0x10:
+            # RHYTHM channel
+            result.append((ch, 9, {}))
+            continue
+        # FM/SSG/ADPCM channel
+        result.append((
+            ch,
+            channel_number,
+            (fm_inst_map if (ch.id & 0x80) else ssg_inst_map).get(
+                song.track_key, {}
+            )
+        ))
+        channel_number += 1
+        if channel_number == 9:
+            channel_number += 1
+    return result
+
+
 # Magic
 # (jk)
-def parse_channel_or_macro(
+def iter_channel_events(
     ch: Channel,
     midi_ch: int,
-    midi: MIDIFile,
     macro_list: List[Macro],
     inst_map: Dict[str, Dict[int, int]],
     portamento_rate: int,
     cut_time: bool,
+    profile: ChipProfile,
+    portamento_tolerance: Optional[float] = None,
     controls={}
-) -> (float, int):
+) -> Generator[SongEvent, None, Tuple[float, int, Optional[NoteEvent]]]:
+    '''
+    Yields the events in a channel (or macro) as they're interpreted, and
+    returns its end time, velocity, and last note (for ties) once it's done.
+    Notes are yielded as soon as they start, but ties may still extend them
+    afterwards, so use `release_notes()` for anything that needs them final.
+    '''
     RHYTHM = not not ch.id & 0x10
     SSG = not not ch.id & 0x40
     FM = not not ch.id & 0x80
@@ -399,7 +790,15 @@ def parse_channel_or_macro(
     )
     if not FM and not SSG and not RHYTHM:
         # Don't process ADPCM channels
-        return controls.get("time", 0)
+        return (
+            controls.get("time", 0),
+            controls.get("velocity", 127),
+            controls.get("last_note")
+        )
+
+    # Added to every octave setting, since some channels play in a different
+    # octave than specified in MML (see CHIP_PROFILES)
+    OCTAVE_OFFSET = profile.octave_offsets.get(ch.id & 0xF0, 0)
 
     # Control variables
     time: float = controls.get("time", 0)
@@ -413,11 +812,21 @@ def parse_channel_or_macro(
     ssg_noise_mix: int = controls.get("ssg_noise_mix", 1)
     pan_nonzero: bool = controls.get("pan_nonzero", True)
     tie: bool = controls.get("tie", False)
-    note_list: List[Union[NoteEvent, PercussionEvent]] = []
+    last_note: Optional[NoteEvent] = controls.get("last_note")
     loop_stack = []  # Number of times to repeat
     return_stack = []  # Index to return to when repeating
     skip_stack = []  # Index to skip to on last repeat
     octave_stack = []  # Keeps track of octave numbers when looping
+    # Infinite loop ("\"): where it is, and the octave and time there. The
+    # loop body is played again until `loop_until` (which only channels get).
+    loop_point: Optional[Tuple[int, int, float]] = None
+    loop_until: float = controls.get("loop_until", 0.0)
+    loop_markers: bool = controls.get("loop_markers", False)
+    loop_times: Optional[List[float]] = controls.get("loop_times")
+    # If True, stop once a pass through the loop body ends the way it started
+    # (see repeat_loop_block())
+    loop_blocks: bool = controls.get("loop_blocks", False)
+    pass_state: Optional[tuple] = None
 
     # Helper function (defined locally because I'm lazy)
     def parse_note(note: str) -> (int, float):
@@ -434,7 +843,65 @@ def parse_channel_or_macro(
 
     # Looping requires manipulation of indicies, so for once, this is okay
     i = 0
-    while i < len(ch.events):
+
+    # Seeking (see SnapshotRecorder): Each call in the macro call stack saves
+    # and restores its own state, starting at the event it's on
+    recorder: Optional[SnapshotRecorder] = controls.get("recorder")
+    resume: List[tuple] = controls.get("resume", [])
+    if resume:
+        (
+            i, time, articulation, octave, transpose, velocity,
+            rhythm_samples, ssg_noise_mix, pan_nonzero, tie, loop_stack,
+            return_stack, skip_stack, octave_stack, loop_point
+        ) = resume[0]
+        loop_stack, return_stack, skip_stack, octave_stack = (
+            list(loop_stack),
+            list(return_stack),
+            list(skip_stack),
+            list(octave_stack)
+        )
+
+    def capture() -> tuple:
+        return (
+            i, time, articulation, octave, transpose, velocity,
+            rhythm_samples, ssg_noise_mix, pan_nonzero, tie,
+            tuple(loop_stack), tuple(return_stack), tuple(skip_stack),
+            tuple(octave_stack), loop_point
+        )
+    if recorder is not None:
+        recorder.frames.append(capture)
+
+    def loop_state() -> tuple:
+        # Everything that carries over from one pass through the loop body to
+        # the next (the octave is reset anyway)
+        state = capture()
+        return (state[2], *state[4:], tuple(rhythm_velocities))
+
+    while True:
+        if i >= len(ch.events):
+            # Jump back to the infinite loop point, if there's time left (and
+            # the loop body actually takes any)
+            if (
+                loop_point is None or time >= loop_until
+                or time <= loop_point[2]
+            ):
+                break
+            # Every pass after this one would play the same, unless the next
+            # one starts by extending this one's last note. (The first pass
+            # can't be the one, since events from before the loop can land
+            # on its start.)
+            if (
+                loop_blocks and pass_state == loop_state()
+                and not ties_back(ch.events, loop_point[0] + 1)
+            ):
+                break
+            i = loop_point[0] + 1
+            octave = loop_point[1]
+            if loop_blocks:
+                pass_state = loop_state()
+            continue
+        if recorder is not None and time >= recorder.next_time:
+            recorder.record(time, rhythm_velocities, last_note)
         event: list = ch.events[i]
         command = event[0]
 
@@ -459,32 +926,34 @@ def parse_channel_or_macro(
                 continue
 
             duration = length * articulation
-            if tie:
-                note_list[-1].extend(duration)
-                tie = False
+            if tie and last_note:
+                last_note.extend(duration)
             elif RHYTHM:
-                note_list.append(PercussionEvent(
+                last_note = PercussionEvent(
                     time=time,
                     duration=duration,
                     samples=rhythm_samples,
                     velocities=rhythm_velocities
-                ))
+                )
+                yield last_note
             else:
-                note_list.append(NoteEvent(
+                # Macros shared with the RHYTHM channel can leave a
+                # PercussionEvent here, which never gets bent
+                if isinstance(last_note, NoteEvent) and last_note.bent:
+                    yield PitchBendEvent(channel=midi_ch, time=time, value=0)
+                last_note = NoteEvent(
                     channel=midi_ch,
                     pitch=pitch,
                     time=time,
                     duration=duration,
                     velocity=velocity
-                ))
+                )
+                yield last_note
+            tie = False
             time += length
         elif command == "O":
             # Octave setting
-            octave = event[1]
-            # For reasons I don't fully understand, SSG plays one octave higher
-            # than specified in MML. Possibly related to the OC compiler flag?
-            if SSG:
-                octave += 1
+            octave = event[1] + OCTAVE_OFFSET
         # "L" (default note length) command is not output by the decompiler
         elif command[0] == "r":
             # Rest
@@ -526,8 +995,7 @@ def parse_channel_or_macro(
         elif command == "/":
             # Force note-off
             # Using CC 120 instead of 123 because VOPM doesn't respond to 123
-            midi.addControllerEvent(
-                track=0,
+            yield ControlEvent(
                 channel=midi_ch,
                 time=time,
                 controller_number=120,  # All Sound Off
@@ -538,8 +1006,7 @@ def parse_channel_or_macro(
             # Detune in MDRV2 is signed, whereas MIDI just has "detune amount."
             # So I use the absolute value of the detune as the "amount."
             # This MIGHT sound okay? It won't work in VOPM, though.
-            midi.addControllerEvent(
-                track=0,
+            yield ControlEvent(
                 channel=midi_ch,
                 time=time,
                 controller_number=94,
@@ -586,22 +1053,19 @@ def parse_channel_or_macro(
                 LFO_delay = floor(event[5] / 2)
 
             # Set control changes
-            midi.addControllerEvent(
-                track=0,
+            yield ControlEvent(
                 channel=midi_ch,
                 time=time,
                 controller_number=3,  # LFO rate (MSB)
                 parameter=LFO_speed
             )
-            midi.addControllerEvent(
-                track=0,
+            yield ControlEvent(
                 channel=midi_ch,
                 time=time,
                 controller_number=13,  # Frequency LFO depth (MSB)
                 parameter=LFO_pitch_depth
             )
-            midi.addControllerEvent(
-                track=0,
+            yield ControlEvent(
                 channel=midi_ch,
                 time=time,
                 controller_number=12,  # Amplitude LFO depth (MSB)
@@ -610,8 +1074,7 @@ def parse_channel_or_macro(
             # I'm not actually sure how best to calculate delay, so I've just
             # kind of... not? This should be pretty easy to fix in any decent
             # MIDI editor, though.
-            midi.addControllerEvent(
-                track=0,
+            yield ControlEvent(
                 channel=midi_ch,
                 time=time,
                 controller_number=78,  # LFO delay
@@ -620,8 +1083,7 @@ def parse_channel_or_macro(
         elif command == "t" or command == "@T":
             # Tempo
             # Cut time (@T) is handled (mostly) by the decompiler
-            midi.addTempo(
-                track=0,
+            yield TempoEvent(
                 time=time,
                 tempo=event[1]
             )
@@ -640,8 +1102,7 @@ def parse_channel_or_macro(
             # SSG envelope change,
             # or RHYTHM sample selection
             if FM:
-                midi.addProgramChange(
-                    tracknum=0,
+                yield ProgramEvent(
                     channel=midi_ch,
                     time=time,
                     program=inst_map.get(event[1], 0)
@@ -650,8 +1111,7 @@ def parse_channel_or_macro(
                 offset = 0
                 if USING_SUGGESTION:
                     offset = (ssg_noise_mix - 1) * 128
-                midi.addProgramChange(
-                    tracknum=0,
+                yield ProgramEvent(
                     channel=midi_ch,
                     time=time,
                     program=inst_map.get(offset + event[1], 0)
@@ -691,8 +1151,7 @@ def parse_channel_or_macro(
         elif command == "W":
             # FM LFO delay, or SSG noise frequency
             if FM:
-                midi.addControllerEvent(
-                    track=0,
+                yield ControlEvent(
                     channel=midi_ch,
                     time=time,
                     controller_number=78,  # LFO delay
@@ -715,8 +1174,7 @@ def parse_channel_or_macro(
                 value = 0 if (event[1] == 1) else (
                     127 if (event[1] == 2) else 64
                 )
-                midi.addControllerEvent(
-                    track=0,
+                yield ControlEvent(
                     channel=midi_ch,
                     time=time,
                     controller_number=10,  # Pan
@@ -757,9 +1215,72 @@ def parse_channel_or_macro(
                 transpose=transpose
             )
 
+            if portamento_tolerance is not None:
+                # One note, bent along the same path MDRV2 glides along
+                base_note = last_note.pitch if (tie and last_note) else (
+                    start_note
+                )
+                points = [
+                    (time + c / CLOCKS_PER_QUARTER, start_note - base_note + v)
+                    for c, v in thin_bends(portamento_bends(
+                        SSG,
+                        (
+                            int(command[1]),
+                            NOTE_NAMES.index(command[2:comma_index])
+                        ),
+                        (
+                            int(command[comma_index + 1]),
+                            NOTE_NAMES.index(
+                                command[comma_index + 2:close_index]
+                            )
+                        ),
+                        transpose,
+                        round(length * CLOCKS_PER_QUARTER)
+                    ), portamento_tolerance)
+                ]
+                bend_range = max(
+                    BEND_RANGE_MIN, ceil(max(abs(v) for _, v in points))
+                )
+                # RPN 0 (pitch bend range): semitones, then cents
+                for number, value in (
+                    (101, 0), (100, 0), (6, bend_range), (38, 0)
+                ):
+                    yield ControlEvent(
+                        channel=midi_ch,
+                        time=time,
+                        controller_number=number,
+                        parameter=value
+                    )
+                yield PitchBendEvent(
+                    channel=midi_ch,
+                    time=time,
+                    value=bend_value(points[0][1], bend_range)
+                )
+                if tie and last_note:
+                    last_note.extend(length)
+                else:
+                    last_note = NoteEvent(
+                        channel=midi_ch,
+                        pitch=start_note,
+                        time=time,
+                        duration=length,
+                        velocity=velocity
+                    )
+                    yield last_note
+                last_note.bent = True
+                for t, v in points[1:]:
+                    yield PitchBendEvent(
+                        channel=midi_ch,
+                        time=t,
+                        value=bend_value(v, bend_range)
+                    )
+                tie = False
+                time += length
+                i += 1
+                continue
+
             # Turn portamento on
-            midi.addControllerEvent(
-                track=0,
+            yield ControlEvent(
                 channel=midi_ch,
                 time=time,
                 controller_number=65,  # Portamento ON/OFF
@@ -770,8 +1291,7 @@ def parse_channel_or_macro(
             # which may vary between synths. In my own testing (with CoolSoft
             # VirtualMIDISynth), a rate of 55 sounded pretty good, so I'm using
             # that as the default value.
-            midi.addControllerEvent(
-                track=0,
+            yield ControlEvent(
                 channel=midi_ch,
                 time=time,
                 controller_number=5,
@@ -779,48 +1299,60 @@ def parse_channel_or_macro(
             )
 
             # Send notes
-            if tie:
+            if tie and last_note:
                 # NOTE: Portamentos in MDRV2 ARE affected by ties.
-                note_list[-1].extend(length - MIDI_EPSILON)
-                tie = False
+                last_note.extend(length - MIDI_EPSILON)
             else:
-                note_list.append(NoteEvent(
+                yield NoteEvent(
                     channel=midi_ch,
                     pitch=start_note,
                     time=time,
                     duration=length - MIDI_EPSILON,
                     velocity=velocity
-                ))
-            note_list.append(NoteEvent(
+                )
+            tie = False
+            last_note = NoteEvent(
                 channel=midi_ch,
                 pitch=end_note,
                 time=time + MIDI_EPSILON,
                 duration=length - MIDI_EPSILON,
                 velocity=velocity
-            ))
+            )
+            yield last_note
 
             # Increment time, then turn portamento off
             time += length
-            midi.addControllerEvent(
-                track=0,
+            yield ControlEvent(
                 channel=midi_ch,
                 time=time,
                 controller_number=65,  # Portamento ON/OFF
                 parameter=0  # OFF
             )
-        # "\" (infinite loop) command is probably better done in a DAW
+        elif command == "\\":
+            # Infinite loop point
+            loop_point = (i, octave, time)
+            if loop_times is not None:
+                loop_times.append(time)
+            if loop_markers:
+                yield ControlEvent(
+                    channel=midi_ch,
+                    time=time,
+                    controller_number=LOOP_CONTROLLER,
+                    parameter=0
+                )
         # "Z" (sync-work value entry) is probably not relevant to MIDI
         elif command == "U":
             # Macro playback
             # This is why I put the code for parsing tracks inside a function:
-            time, velocity = parse_channel_or_macro(
+            time, velocity, last_note = yield from iter_channel_events(
                 ch=macro_list[event[1]],
                 midi_ch=midi_ch,
-                midi=midi,
                 macro_list=macro_list,
                 inst_map=inst_map,
                 portamento_rate=portamento_rate,
                 cut_time=cut_time,
+                profile=profile,
+                portamento_tolerance=portamento_tolerance,
                 controls={
                     "time": time,
                     "articulation": articulation,
@@ -829,111 +1361,482 @@ def parse_channel_or_macro(
                     "rhythm_velocities": rhythm_velocities,
                     "ssg_noise_mix": ssg_noise_mix,
                     "pan_nonzero": pan_nonzero,
-                    "tie": tie
+                    "tie": tie,
+                    "last_note": last_note,
+                    "recorder": recorder,
+                    # The frames under this one, when resuming from a
+                    # snapshot taken inside this macro
+                    "resume": resume[1:]
                 }
             )
+            resume = []
             # Ain't it beautiful? 😁
             # Of course, if there are any macros that reference themselves
             # (directly or indirectly), I'm kind of screwed. But I'm banking on
             # the hope that MDRV2's compiler catches those. 🤞
         i += 1
 
-    # Write events and return
-    for n in note_list:
-        n.write(midi)
-    return (time, velocity)
+    if recorder is not None:
+        recorder.frames.pop()
+    return (time, velocity, last_note)
+
+
+def release_notes(
+    events: Generator[SongEvent, None, tuple],
+    end_times: List[float]
+) -> Iterator[SongEvent]:
+    '''
+    Yields the events from `iter_channel_events()`, but holds each note back
+    until the next one starts (since until then, a tie could still extend it),
+    along with everything after it. Order by time is kept, and RHYTHM hits are
+    split into one NoteEvent per drum.
+
+    :param end_times: The channel's end time is appended to this list once
+    the channel is done.
+    '''
+    held: Optional[NoteEvent] = None
+    waiting: List[SongEvent] = []
+    while True:
+        try:
+            event = next(events)
+        except StopIteration as done:
+            end_times.append(done.value[0])
+            break
+        if isinstance(event, (NoteEvent, PercussionEvent)):
+            if held is not None:
+                yield from held.notes()
+                yield from waiting
+                waiting.clear()
+            held = event
+        elif held is not None:
+            waiting.append(event)
+        else:
+            yield event
+    if held is not None:
+        yield from held.notes()
+    yield from waiting
+
+
+def resume_events(
+    first: Optional[SongEvent],
+    events: Generator[SongEvent, None, tuple]
+) -> Generator[SongEvent, None, tuple]:
+    # Re-sends the note a snapshot was holding, so ties can still extend it
+    if first is not None:
+        yield first
+    return (yield from events)
+
+
+def seek_events(
+    events: Iterator[SongEvent],
+    start_time: float,
+    chase: Dict[tuple, SongEvent]
+) -> Iterator[SongEvent]:
+    '''
+    Drops everything before `start_time` from the events of `release_notes()`.
+    The latest control, program and tempo events are sent at `start_time`
+    instead, along with the notes still sounding then (cut short to match).
+    '''
+    chase = dict(chase)
+    sounding: List[NoteEvent] = []
+    event = None
+    for event in events:
+        if event.time >= start_time:
+            break
+        key = chase_key(event)
+        if key is not None:
+            chase[key] = event
+        elif (
+            isinstance(event, NoteEvent)
+            and event.time + event.duration > start_time
+        ):
+            sounding.append(event)
+    else:
+        event = None
+
+    for v in chain(chase.values(), sounding):
+        v = copy(v)
+        if isinstance(v, NoteEvent):
+            v.duration += v.time - start_time
+        v.time = start_time
+        yield v
+    if event is not None:
+        yield event
+        yield from events
+
+
+def repeat_loop_block(
+    events: Generator[SongEvent, None, tuple],
+    body: float,
+    end_time: float
+) -> Generator[SongEvent, None, tuple]:
+    '''
+    Passes along the events from `iter_channel_events()`. If the channel
+    stops short of `end_time` (because a pass through its infinite loop
+    ended the way it started, so every pass after it plays the same), that
+    last pass is repeated until `end_time` as one block of events, shifted
+    in time, instead of being interpreted again.
+
+    :param body: How long the loop body is, in quarter notes.
+    '''
+    # Only the last pass is ever needed, so only that much is kept
+    window: Deque[SongEvent] = deque()
+    while True:
+        try:
+            event = next(events)
+        except StopIteration as done:
+            time, velocity, last_note = done.value
+            break
+        window.append(event)
+        while window[0].time < event.time - body - MIDI_EPSILON:
+            window.popleft()
+        yield event
+    if time >= end_time or body <= 0:
+        return (time, velocity, last_note)
+
+    # Events at the very end (like a portamento turning off) belong to the
+    # last pass, and the pass before it left the same ones at the start, so
+    # those aren't part of the block
+    start = time - body
+    tail = sum(1 for e in window if e.time == time)
+    block = [e for e in window if e.time > start - MIDI_EPSILON / 2][tail:]
+    repeats = 1
+    while start + repeats * body < end_time - MIDI_EPSILON / 2:
+        offset = repeats * body
+        for event in block:
+            event = copy(event)
+            event.time += offset
+            yield event
+        repeats += 1
+    return (start + repeats * body, velocity, last_note)
+
+
+def cut_events(
+    events: Iterator[SongEvent],
+    end_time: float
+) -> Iterator[SongEvent]:
+    '''
+    Stops the events of `release_notes()` at `end_time`, cutting short the
+    notes still sounding then. (The events after that are never generated.)
+    '''
+    # Times that should match rarely do exactly, after adding up lengths
+    for event in events:
+        if event.time > end_time + MIDI_EPSILON / 2:
+            return
+        if isinstance(event, NoteEvent):
+            if event.time > end_time - MIDI_EPSILON / 2:
+                continue
+            if event.time + event.duration > end_time:
+                event = copy(event)
+                event.duration = end_time - event.time
+        yield event
+
+
+def loop_layout(
+    measured: List[Tuple[Optional[float], float]],
+    loop_count: Optional[int]
+) -> Tuple[Optional[float], float]:
+    '''
+    Returns where the song's loop starts (once every channel with an infinite
+    loop is in it, or None if none of them have one), and where the song
+    ends, from what `measure_channel()` returned for each channel.
+
+    With `loop_count`, the song ends once the longest loop has been played
+    that many more times, rounded up so that every loop body fits between
+    the two a whole number of times (i.e. to a multiple of their least common
+    multiple), making the whole song loop seamlessly. If that would make the
+    song over LOOP_ALIGN_LIMIT times longer, it isn't rounded up.
+    '''
+    # Everything's in clocks, which MDRV2 lengths always come in whole
+    # numbers of, so the multiples work out exactly
+    loop_start: Optional[int] = None
+    song_end = 0
+    period = 1
+    for loop_time, end_time in measured:
+        end = round(end_time * CLOCKS_PER_QUARTER)
+        if loop_time is None:
+            song_end = max(song_end, end)
+            continue
+        intro = round(loop_time * CLOCKS_PER_QUARTER)
+        body = end - intro
+        loop_start = intro if loop_start is None else max(loop_start, intro)
+        song_end = max(song_end, end + (loop_count or 0) * body)
+        if body > 0:
+            period = period * body // gcd(period, body)
+
+    if loop_start is None:
+        return (None, song_end / CLOCKS_PER_QUARTER)
+    if loop_count is not None:
+        periods = max(1, -(-(song_end - loop_start) // period))
+        aligned = loop_start + periods * period
+        if aligned <= song_end * LOOP_ALIGN_LIMIT:
+            song_end = aligned
+    return (loop_start / CLOCKS_PER_QUARTER, song_end / CLOCKS_PER_QUARTER)
+
+
+def measure_channel(
+    ch: Channel,
+    midi_ch: int,
+    macro_list: List[Macro],
+    inst_map: Dict[str, Dict[int, int]],
+    cut_time: bool,
+    profile: ChipProfile
+) -> Tuple[Optional[float], float]:
+    '''
+    Runs through a channel without keeping any of its events, and returns
+    when it reaches its infinite loop point (None if it doesn't have one),
+    and when it ends.
+    '''
+    loop_times: List[float] = []
+    events = iter_channel_events(
+        ch=ch,
+        midi_ch=midi_ch,
+        macro_list=macro_list,
+        inst_map=inst_map,
+        portamento_rate=0,
+        cut_time=cut_time,
+        profile=profile,
+        controls={"loop_times": loop_times}
+    )
+    while True:
+        try:
+            next(events)
+        except StopIteration as done:
+            return (loop_times[0] if loop_times else None, done.value[0])
 
 
 # API begins here
-def parse_song(
+def index_song(
     song: Song,
     fm_inst_map={},
     ssg_inst_map={},
     portamento_rate=55,
-    cut_time=False
-) -> MIDIFile:
+    cut_time=False,
+    interval=SNAPSHOT_INTERVAL,
+    portamento_tolerance: Optional[float] = None
+) -> List[SnapshotRecorder]:
     '''
-    Converts the MML events in the specified MDT `Song` to MIDI events,
-    writes them to a MIDIFile instance, and returns it.
+    Runs through the specified MDT `Song` once, saving each channel's state
+    every `interval` clocks, and returns the snapshots for each channel. Pass
+    them to `iter_song_events()` to start anywhere in the song without having
+    to replay everything before it.
     NOTE: This function can raise BaseExceptions.
 
+    The other parameters must match the ones given to `iter_song_events()`.
+    '''
+    profile = chip_profile(song.chip)
+    macro_list = list(v for _, v in sorted(
+        song.macros.items(), key=lambda m: m[1].macro_id
+    ))
+    index: List[SnapshotRecorder] = []
+    for ch, midi_ch, inst_map in channel_assignments(
+        song, fm_inst_map, ssg_inst_map
+    ):
+        recorder = SnapshotRecorder(interval)
+        for _ in recorder.watch(iter_channel_events(
+            ch=ch,
+            midi_ch=midi_ch,
+            macro_list=macro_list,
+            inst_map=inst_map,
+            portamento_rate=portamento_rate,
+            cut_time=cut_time,
+            profile=profile,
+            portamento_tolerance=portamento_tolerance,
+            controls={"recorder": recorder}
+        )):
+            pass
+        index.append(recorder)
+    return index
+
+
+def iter_song_events(
+    song: Song,
+    fm_inst_map={},
+    ssg_inst_map={},
+    portamento_rate=55,
+    cut_time=False,
+    start_time=0.0,
+    index: Optional[List[SnapshotRecorder]] = None,
+    loop_markers=False,
+    loop_count: Optional[int] = None,
+    portamento_tolerance: Optional[float] = None
+) -> Iterator[SongEvent]:
+    '''
+    Converts the MML events in the specified MDT `Song` to MIDI events, and
+    yields them one at a time, in order of time. Events are only generated as
+    they're needed, so this takes the same (small) amount of memory no matter
+    how long the song is once its loops are unrolled.
+    NOTE: This function can raise BaseExceptions (once iteration starts).
+
     :param song: A Song instance returned from `MDTTools.parse_mdt()`.
-    :param inst_map: An optional dict with filenames as keys and more dicts as
-    values. The sub-dicts have MML instrument numbers as keys and MIDI
-    instrument numbers as values.
+    :param inst_map: An optional dict with filenames (or rather, track keys)
+    as keys and more dicts as values. The sub-dicts have MML instrument numbers
+    as keys and MIDI instrument numbers as values.
     :param cut_time: If True, all note lengths in macros will be doubled.
+    :param start_time: Where to start, in quarter notes. The controls in
+    effect at that point are sent first, and notes still sounding are cut.
+    :param index: Snapshots from `index_song()`, which make starting past
+    the beginning cost (at most) one snapshot interval of replaying, instead
+    of everything before `start_time`.
+    :param loop_markers: If True, each channel's infinite loop point gets a
+    CC111, and the song gets "loopStart" and "loopEnd" text events (where
+    every channel is looping, and at the end).
+    :param loop_count: If not None, channels with infinite loops keep playing
+    them (without going through the rest of the channel again) until the
+    song's end, which is when the longest one has played its loop this many
+    more times, or a bit later, so the song loops seamlessly (see
+    `loop_layout()`).
+    :param portamento_tolerance: If not None, portamentos are played as one
+    note with pitch bends that follow MDRV2's glide to within this many
+    cents, instead of with MIDI portamento (and `portamento_rate`).
     '''
     if len(song.channels) == 0:
         raise BaseException("Provided Song has no channels.")
-    if song.chip != 1:
-        raise BaseException("Provided Song is not for OPN/OPNA.")
+    profile = chip_profile(song.chip)
     if portamento_rate < 0 or portamento_rate > 127:
         raise BaseException("Portamento rate must be an int 0-127, inclusive.")
+    if loop_count is not None and loop_count < 0:
+        raise BaseException("Loop count must be at least 0.")
+    if portamento_tolerance is not None and portamento_tolerance < 0:
+        raise BaseException("Portamento tolerance must be at least 0 cents.")
 
     macro_list = list(v for _, v in sorted(
         song.macros.items(), key=lambda m: m[1].macro_id
     ))
 
-    midi = MIDIFile(
-        numTracks=1,
-        removeDuplicates=False,
-        deinterleave=False,
-        adjust_origin=False,
-        file_format=1
-    )
-
-    track_end_time = 0
+    # One stream of events per channel, which are merged by time below
+    streams: List[Iterator[SongEvent]] = []
+    end_times: List[float] = []
     melodic_channels_written = []
+    assignments = channel_assignments(song, fm_inst_map, ssg_inst_map)
 
-    channel_number = 0
-    for ch in song.channels:
-        if ch.id & 0x10:
-            # RHYTHM channel
-            parse_channel_or_macro(
+    # Where the infinite loops are has to be known before anything's merged
+    measured: List[Tuple[Optional[float], float]] = []
+    if loop_markers or loop_count is not None:
+        measured = [
+            measure_channel(
+                ch, midi_ch, macro_list, inst_map, cut_time, profile
+            )
+            for ch, midi_ch, inst_map in assignments
+        ]
+    loop_start, loop_until = loop_layout(measured, loop_count)
+    if loop_markers and loop_start is not None and loop_start >= start_time:
+        streams.append(iter([
+            TextEvent(time=loop_start, text=LOOP_START_TEXT)
+        ]))
+
+    for i, (ch, midi_ch, inst_map) in enumerate(assignments):
+        snapshot = index[i].find(start_time) if index else None
+        controls = snapshot.controls() if snapshot else {}
+        controls["loop_markers"] = loop_markers
+        looping = loop_count is not None and measured[i][0] is not None
+        if looping:
+            # Each loop body is only interpreted until it settles, and then
+            # repeated as a block
+            controls["loop_until"] = loop_until
+            controls["loop_blocks"] = True
+        events = resume_events(
+            controls.get("last_note"),
+            iter_channel_events(
                 ch=ch,
-                midi_ch=9,
-                midi=midi,
+                midi_ch=midi_ch,
                 macro_list=macro_list,
-                inst_map={},
+                inst_map=inst_map,
                 portamento_rate=portamento_rate,
-                cut_time=cut_time
+                cut_time=cut_time,
+                profile=profile,
+                portamento_tolerance=portamento_tolerance,
+                controls=controls
             )
-        else:
-            # FM/SSG/ADPCM channel
-            midi.addControllerEvent(
-                track=0,
-                channel=channel_number,
-                time=0,
+        )
+        if looping:
+            events = repeat_loop_block(
+                events, measured[i][1] - measured[i][0], loop_until
+            )
+        events = release_notes(events, [] if (ch.id & 0x10) else end_times)
+        if loop_count is not None:
+            events = cut_events(events, loop_until)
+        if start_time > 0:
+            events = seek_events(
+                events, start_time, snapshot.chase if snapshot else {}
+            )
+
+        if not ch.id & 0x10:
+            mono_on = ControlEvent(
+                channel=midi_ch,
+                time=start_time,
                 controller_number=126,  # Mono mode ON
                 parameter=10  # I think 10 is correct?
                 # Based on: https://www.midi.org/specifications-old/item/table-3-control-change-messages-data-bytes-2
             )
-            time, _ = parse_channel_or_macro(
-                ch=ch,
-                midi_ch=channel_number,
-                midi=midi,
-                macro_list=macro_list,
-                inst_map=(fm_inst_map if (ch.id & 0x80) else ssg_inst_map).get(
-                    song.filename, {}
-                ),
-                portamento_rate=portamento_rate,
-                cut_time=cut_time
-            )
-            track_end_time = max(time, track_end_time)
-            melodic_channels_written.append(channel_number)
-            channel_number += 1
-            if channel_number == 9:
-                channel_number += 1
+            events = chain([mono_on], events)
+            melodic_channels_written.append(midi_ch)
+        streams.append(events)
+
+    # Each stream is already in order, and merge() keeps events with the same
+    # time in channel order
+    yield from merge(*streams, key=lambda e: e.time)
 
+    track_end_time = max(end_times, default=start_time)
+    if loop_count is not None:
+        # Channels that get cut off never report their end time
+        track_end_time = max(loop_until, start_time)
+    if loop_markers and loop_start is not None:
+        yield TextEvent(time=track_end_time, text=LOOP_END_TEXT)
     for ch in melodic_channels_written:
-        midi.addControllerEvent(
-            track=0,
+        yield ControlEvent(
             channel=ch,
             time=track_end_time,
             controller_number=127,  # Mono mode OFF
             parameter=0
         )
 
+
+def parse_song(
+    song: Song,
+    fm_inst_map={},
+    ssg_inst_map={},
+    portamento_rate=55,
+    cut_time=False,
+    loop_markers=False,
+    loop_count: Optional[int] = None,
+    portamento_tolerance: Optional[float] = None
+) -> MIDIFile:
+    '''
+    Converts the MML events in the specified MDT `Song` to MIDI events,
+    writes them to a MIDIFile instance, and returns it.
+    NOTE: This function can raise BaseExceptions.
+
+    :param song: A Song instance returned from `MDTTools.parse_mdt()`.
+    :param inst_map: An optional dict with filenames (or rather, track keys)
+    as keys and more dicts as values. The sub-dicts have MML instrument numbers
+    as keys and MIDI instrument numbers as values.
+    :param cut_time: If True, all note lengths in macros will be doubled.
+    :param loop_markers: If True, infinite loops are marked with CC111 and
+    "loopStart"/"loopEnd" text events.
+    :param loop_count: If not None, infinite loops are extended until every
+    channel ends together (see `iter_song_events()`).
+    :param portamento_tolerance: If not None, portamentos are converted to
+    pitch bends, accurate to within this many cents.
+    '''
+    midi = MIDIFile(
+        numTracks=1,
+        removeDuplicates=False,
+        deinterleave=False,
+        adjust_origin=False,
+        file_format=1
+    )
+    for event in iter_song_events(
+        song,
+        fm_inst_map,
+        ssg_inst_map,
+        portamento_rate,
+        cut_time,
+        loop_markers=loop_markers,
+        loop_count=loop_count,
+        portamento_tolerance=portamento_tolerance
+    ):
+        event.write(midi)
     return midi
 
 
@@ -944,9 +1847,8 @@ def write_midi_file(filename: str, midi_file: MIDIFile):
     :param filename: A path to where the MIDI file will be written.
     :param midi_file: A MIDIFile instance returned from `parse_song()`.
     '''
-    with open(filename, "wb") as f:
+    with atomic_open(filename, "wb") as f:
         midi_file.writeFile(f)
-        f.close()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,1097 @@
+# Contains an emulator for (the playback side of) MDRV2, which turns a decoded
+# Song into the stream of YM2608 (OPNA) register writes that the driver would
+# make while playing it. Everything else in this project approximates; this is
+# meant to be the foundation for exports that DON'T have to, like VGM.
+
+# The emulator runs on MDRV2's own clock (48 clocks per quarter note), and
+# only does per-clock work for channels that actually need it (portamentos,
+# software LFOs, fades and SSG envelopes). Everything else jumps straight to
+# the next clock where something happens, so a whole track takes a fraction of
+# a second to emulate.
+
+# Channels can loop back to their `\` at different times, so a looping VGM
+# keeps going past the first pass until every channel's loop lines up with the
+# end. (Unless that'd make it too long; see LOOP_ALIGN_LIMIT.)
+
+# A word of warning: I don't have the driver's source code, so anything that
+# isn't obvious from the MDT data itself is an educated guess. The guesses are
+# marked as such, and they're all in one place each, so they're easy to fix if
+# anyone figures out the real behavior. (The portamento math, at least, comes
+# straight from the compiler's own lookup tables.)
+
+
+from math import gcd, trunc
+from struct import pack, pack_into
+from sys import argv as CMD_ARGS, exit
+from typing import Iterator, List, Dict, Tuple, Optional
+
+from mdt_decomp_rip import (
+    NOTE_NAMES,
+    NOTE_LENGTHS,
+    Song,
+    Channel,
+    Macro,
+    FMInstrument,
+    SSGEnvelope,
+    atomic_open
+)
+from portamento_map_fm import PORTAMENTO_MAP_FM
+from portamento_map_ssg import PORTAMENTO_MAP_SSG
+
+
+# Constants
+OPNA_CLOCK = 7987200  # Hz, as found in the PC-9801-86
+SSG_CLOCK = OPNA_CLOCK // 4
+CLOCKS_PER_QUARTER = 48
+DEFAULT_TEMPO = 120
+
+# F-numbers for C through B, at block (octave) = MML octave
+FM_FNUMS = [617, 654, 693, 734, 778, 824, 873, 925, 980, 1038, 1100, 1165]
+# The portamento tables say an octave is worth 617 "steps", no matter which
+# octave it is. So the driver must glide along block * 617 + (F-number - 617).
+OCTAVE_STEPS = 617
+
+# Register offsets of the operators in FMInstrument.params rows 1-4
+OPERATOR_OFFSETS = [0, 8, 4, 12]
+# Carrier operators (as a bitmask of rows 1-4) for each algorithm
+CARRIER_MASKS = [
+    0b1000, 0b1000, 0b1000, 0b1000, 0b1010, 0b1110, 0b1110, 0b1111
+]
+
+# Pan values (P0-P3) to bits 7 and 6 of registers 0xB4-0xB6 and 0x18-0x1D
+PAN_BITS = [0x00, 0x80, 0x40, 0xC0]
+
+LENGTH_CLOCKS = {v: k for k, v in NOTE_LENGTHS.items()}
+NOTE_STARTS = "<>abcdefg"
+NOTE_NAME_CHARS = "abcdefg+"
+LOOP_STARTS = {"|:", "[:", "["}
+LOOP_SKIPS = {":", "|"}
+LOOP_ENDS = {":|", ":]", "]"}
+
+# VGM output
+VGM_VERSION = 0x151
+VGM_HEADER_SIZE = 0x80
+VGM_SAMPLE_RATE = 44100
+VGM_CHUNK_SIZE = 0x10000  # Bytes of commands buffered before writing
+VGM_WRITE_COMMANDS = [0x56, 0x57]  # YM2608 port 0, port 1
+VGM_MAX_WAIT = 0xFFFF
+
+# Looping VGMs are lined up so every channel loops seamlessly, unless that
+# would make them more than this many times longer than they'd be otherwise
+LOOP_ALIGN_LIMIT = 4
+
+# If a channel goes this many events without time moving forward, it's stuck
+# in a loop with nothing in it, and gets stopped.
+EVENT_LIMIT = 100000
+
+
+# Helper functions
+def length_clocks(length: str) -> int:
+    if length[0] == "%":
+        return int(length[1:])
+    return LENGTH_CLOCKS[length]
+
+
+def split_note(note: str) -> Tuple[int, str]:
+    '''
+    Splits a note (without octave marks) into its index in NOTE_NAMES and its
+    length string.
+    '''
+    split_index = 0
+    while note[split_index] in NOTE_NAME_CHARS:
+        split_index += 1
+    return (NOTE_NAMES.index(note[:split_index]), note[split_index:])
+
+
+def split_portamento_note(note: str) -> Tuple[int, int]:
+    # e.g. "4c+" -> (4, 1)
+    return (int(note[0]), NOTE_NAMES.index(note[1:]))
+
+
+def portamento_step(ssg: bool, start: int, end: int, duration: int) -> int:
+    '''
+    Finds the per-clock step that the compiler would have written for a
+    portamento from MDT note `start` to MDT note `end` (both octave << 4 |
+    note), by looking it up in the same tables the decompiler uses.
+    '''
+    portamento_map = PORTAMENTO_MAP_SSG if ssg else PORTAMENTO_MAP_FM
+    for k, v in portamento_map.get(start, {}).items():
+        if v == end:
+            return trunc(k / max(duration, 1))
+    return 0
+
+
+def ssg_period(frequency: float) -> int:
+    return max(1, min(0xFFF, round(SSG_CLOCK / (16 * frequency))))
+
+
+def midi_frequency(pitch: float) -> float:
+    return 440 * (2 ** ((pitch - 69) / 12))
+
+
+def compile_events(ch: Channel, cut_time: bool) -> list:
+    '''
+    Converts a channel's (or macro's) MML events into tuples that are quicker
+    to interpret, with all note lengths converted to driver clocks.
+    When `cut_time` is set, the decompiler doubles lengths (and tempos) in
+    channels, but not in macros, so the doubling is undone here.
+    '''
+    halve = cut_time and not isinstance(ch, Macro)
+    compiled = []
+    for event in ch.events:
+        command = event[0]
+        if command[0] in NOTE_STARTS:
+            shift = 0
+            if command[0] == "<":
+                shift = -1
+                command = command[1:]
+            elif command[0] == ">":
+                shift = 1
+                command = command[1:]
+            note, length = split_note(command)
+            clocks = length_clocks(length)
+            compiled.append(
+                ("note", shift, note, clocks // 2 if halve else clocks)
+            )
+        elif command[0] == "r":
+            clocks = length_clocks(command[1:])
+            compiled.append(("r", clocks // 2 if halve else clocks))
+        elif command[0] == "(":
+            comma_index = command.index(",")
+            close_index = command.index(")")
+            clocks = length_clocks(command[close_index + 1:])
+            compiled.append((
+                "(",
+                split_portamento_note(command[1:comma_index]),
+                split_portamento_note(command[comma_index + 1:close_index]),
+                clocks // 2 if halve else clocks
+            ))
+        elif command == "@T":
+            compiled.append(("t", event[1] // 2 if cut_time else event[1]))
+        else:
+            compiled.append((command, *event[1:]))
+    return compiled
+
+
+def vgm_wait(samples: int) -> bytes:
+    '''
+    Returns the shortest VGM commands for waiting the given number of samples.
+    '''
+    out = bytearray()
+    while samples > 0:
+        if samples <= 16:
+            out.append(0x70 + samples - 1)
+            break
+        if samples == 735 or samples == 882:
+            out.append(0x62 if (samples == 735) else 0x63)
+            break
+        n = min(samples, VGM_MAX_WAIT)
+        out += pack("<BH", 0x61, n)
+        samples -= n
+    return bytes(out)
+
+
+def gd3_tag(title: str) -> bytes:
+    # Track name in English and Japanese, then 9 empty fields
+    # (game, system, author, in both languages, plus date, ripper and notes)
+    strings = [title, title] + [""] * 9
+    data = b"".join((v + "\0").encode("utf-16-le") for v in strings)
+    return b"Gd3 " + pack("<II", 0x100, len(data)) + data
+
+
+# Classes
+class RegisterLog:
+    def __init__(self):
+        # (clock, time in seconds, port, register, value)
+        self.writes: List[Tuple[int, float, int, int, int]] = []
+        self.loop_index = -1  # Index of the first write in the loop, if any
+        self.loop_clock = -1
+        self.loop_time = -1.0
+        self.end_clock = 0
+        self.end_time = 0.0
+
+    def __len__(self) -> int:
+        return len(self.writes)
+
+
+class Frame:
+    # One level of the macro call stack
+    def __init__(self, events: list, octave: int):
+        self.events = events
+        self.i = 0
+        self.octave = octave
+        self.loop_stack: List[int] = []
+        self.return_stack: List[int] = []
+        self.skip_stack: List[int] = []
+        self.octave_stack: List[int] = []
+
+
+class ChannelEmulator:
+    def __init__(self, emu, ch: Channel, index: int):
+        self.emu = emu
+        self.id = ch.id
+        self.FM = not not ch.id & 0x80
+        self.SSG = not not ch.id & 0x40
+        self.RHYTHM = not not ch.id & 0x10
+        self.index = index  # Channel number within its chip section
+
+        self.events = emu.compiled(ch)
+        self.loop_pos = -1
+        for i, event in enumerate(self.events):
+            if event[0] == "\\":
+                self.loop_pos = i
+        self.frames = [Frame(self.events, 0)]
+        self.finished = False  # Has played through at least once
+        self.stopped = False  # Has no more events to play, ever
+        self.passes = 0
+        self.loop_clock = -1
+        self.end_clock = -1  # When the first pass ended
+
+        # Timing
+        self.wait = 0  # Clocks until the next event
+        self.gate = -1  # Clocks until key-off, or -1 for none
+        self.key_on = False
+        self.tie = False
+        self.on_clock = 0  # Clock of the last key-on
+        self.off_clock = -1  # Clock of the last key-off
+
+        # Playback state
+        self.transpose = 0
+        self.detune = 0
+        self.articulation = 8
+        self.volume = 127 if self.FM else 15
+        self.pan = 3
+        self.inst: Optional[FMInstrument] = None
+        self.envelope: Optional[SSGEnvelope] = None
+        self.noise_mix = 1
+        self.pitch = 0  # F-number steps (FM) or SSG tone period (SSG)
+
+        # Effects
+        self.portamento_step = 0
+        self.portamento_clocks = 0
+        self.portamento_elapsed = 0
+        self.portamento_start = 0
+        # (is_pitch, speed, waveform, depth, delay)
+        self.lfo: Optional[Tuple] = None
+        self.lfo_offset = 0
+        self.lfo_delay_override = -1
+        self.fade_rate = 0
+        self.fade_level = 0  # Attenuation, in FM TL units
+        self.fade_counter = 0
+
+        # RHYTHM state
+        self.rhythm_samples = 0x3F
+        self.rhythm_levels = [31] * 6
+        self.rhythm_pans = [3] * 6
+
+        # Port and register offset for FM channels
+        self.port = 1 if (self.FM and index >= 3) else 0
+        self.reg = index % 3
+        self.key_code = (4 if (index >= 3) else 0) + (index % 3)
+
+    # Register helpers
+    def write(self, register: int, value: int):
+        self.emu.write(self.port, register, value)
+
+    def write_fm_pitch(self):
+        steps = self.pitch + self.detune + (
+            self.lfo_offset if (self.lfo and self.lfo[0]) else 0
+        )
+        block, fnum = divmod(max(steps, 0), OCTAVE_STEPS)
+        fnum += OCTAVE_STEPS
+        block = max(0, min(block, 7))
+        self.write(0xA4 + self.reg, (block << 3) | (fnum >> 8))
+        self.write(0xA0 + self.reg, fnum & 0xFF)
+
+    def write_ssg_pitch(self):
+        period = self.pitch - self.detune + (
+            self.lfo_offset if (self.lfo and self.lfo[0]) else 0
+        )
+        period = max(1, min(period, 0xFFF))
+        self.emu.write(0, self.index * 2, period & 0xFF)
+        self.emu.write(0, self.index * 2 + 1, period >> 8)
+
+    def write_pitch(self):
+        if self.FM:
+            self.write_fm_pitch()
+        elif self.SSG:
+            self.write_ssg_pitch()
+
+    def write_fm_volume(self):
+        if self.inst is None:
+            return
+        carriers = CARRIER_MASKS[self.inst.params[0][0] % 0x08]
+        amplitude_lfo = self.lfo_offset if (
+            self.lfo and not self.lfo[0]
+        ) else 0
+        attenuation = (127 - self.volume) + self.fade_level + amplitude_lfo
+        for row in range(4):
+            if carriers & (1 << row):
+                tl = self.inst.params[row + 1][5] + attenuation
+                self.write(
+                    0x40 + OPERATOR_OFFSETS[row] + self.reg,
+                    max(0, min(tl, 127))
+                )
+
+    def write_ssg_volume(self):
+        level = self.volume - (self.fade_level >> 3)
+        if self.envelope is not None:
+            level += self.envelope_delta()
+        elif not self.key_on:
+            level = 0
+        if self.lfo and not self.lfo[0]:
+            level -= self.lfo_offset
+        self.emu.write(0, 0x08 + self.index, max(0, min(level, 15)))
+
+    def write_volume(self):
+        if self.FM:
+            self.write_fm_volume()
+        elif self.SSG:
+            self.write_ssg_volume()
+
+    def write_fm_pan(self):
+        first = self.inst.params[0] if self.inst else [0] * 11
+        self.write(
+            0xB4 + self.reg,
+            PAN_BITS[self.pan & 3] | (first[8] << 4) | first[7]
+        )
+
+    def write_fm_instrument(self):
+        # Operator registers, then FB/ALG, then pan/AMS/PMS
+        for row in range(4):
+            op = self.inst.params[row + 1]
+            offset = OPERATOR_OFFSETS[row] + self.reg
+            self.write(0x30 + offset, ((op[8] & 7) << 4) | op[7])
+            self.write(0x40 + offset, op[5] & 0x7F)
+            self.write(0x50 + offset, (op[6] << 6) | op[0])
+            self.write(0x60 + offset, (op[10] << 7) | op[1])
+            self.write(0x70 + offset, op[2])
+            self.write(0x80 + offset, (op[4] << 4) | op[3])
+        self.write(0xB0 + self.reg, self.inst.params[0][0])
+        self.write_fm_pan()
+        self.write_fm_volume()
+
+    def write_rhythm_level(self, sample: int):
+        self.emu.write(
+            0,
+            0x18 + sample,
+            PAN_BITS[self.rhythm_pans[sample] & 3]
+            | (self.rhythm_levels[sample] & 0x1F)
+        )
+
+    def envelope_delta(self) -> int:
+        # GUESS: SSG envelopes are treated like PMD's 4-parameter software
+        # envelopes (AL, DD, SR, RR), with the last 2 parameters ignored:
+        # - The volume is left alone for AL clocks after key-on,
+        # - then DD (signed) is added to it,
+        # - then it drops by 1 every SR clocks (0 = never),
+        # - and after key-off, it drops by 1 every RR clocks (0 = instantly).
+        al, dd, sr, rr = self.envelope.params[:4]
+        dd = dd - 0x100 if (dd >= 0x80) else dd
+        clock = self.emu.clock
+        since_on = clock - self.on_clock
+        delta = 0
+        if since_on >= al:
+            delta = dd
+            if sr:
+                delta -= (since_on - al) // sr
+        if not self.key_on:
+            if not rr:
+                return -15
+            delta -= (clock - self.off_clock) // rr
+        return delta
+
+    def needs_ticks(self) -> bool:
+        '''
+        Returns True if something about this channel changes every clock, and
+        not just at its events.
+        '''
+        return (
+            self.portamento_clocks > 0
+            or self.lfo is not None
+            or self.fade_rate != 0
+            or (self.SSG and self.envelope is not None)
+        )
+
+    # Key on/off
+    def note_on(self):
+        emu = self.emu
+        if self.FM:
+            self.write_fm_pitch()
+            if self.key_on:
+                emu.write(0, 0x28, self.key_code)
+            slots = self.inst.params[0][1] if self.inst else 0
+            emu.write(0, 0x28, ((slots or 0x0F) << 4) | self.key_code)
+        elif self.SSG:
+            self.write_ssg_pitch()
+            # Tone/noise mix. Bits 0-2 disable tone, bits 3-5 disable noise.
+            mixer = emu.registers.get((0, 0x07), 0x3F)
+            bit = 1 << self.index
+            mixer |= (bit | (bit << 3))
+            if self.noise_mix & 1:
+                mixer &= ~bit
+            if self.noise_mix & 2:
+                mixer &= ~(bit << 3)
+            emu.write(0, 0x07, mixer)
+        self.key_on = True
+        self.on_clock = emu.clock
+        if self.SSG:
+            self.write_ssg_volume()
+
+    def note_off(self):
+        if not self.key_on:
+            return
+        self.key_on = False
+        self.off_clock = self.emu.clock
+        if self.FM:
+            self.emu.write(0, 0x28, self.key_code)
+        elif self.SSG:
+            self.write_ssg_volume()
+
+    # Event processing
+    def start_note(self, note: int, octave: int, clocks: int):
+        pitch = octave * 12 + note + self.transpose
+        if self.FM:
+            octave, note = divmod(pitch, 12)
+            self.pitch = octave * OCTAVE_STEPS + FM_FNUMS[note] - OCTAVE_STEPS
+        elif self.SSG:
+            # SSG plays one octave higher than the MML says (see md2mml_midi)
+            self.pitch = ssg_period(midi_frequency(pitch + 24))
+        self.portamento_clocks = 0
+        self.lfo_offset = 0
+        if self.tie:
+            self.tie = False
+            self.write_pitch()
+        elif self.RHYTHM:
+            self.emu.write(0, 0x10, self.rhythm_samples & 0x3F)
+        else:
+            self.note_on()
+        self.wait = clocks
+        self.set_gate(clocks)
+
+    def set_gate(self, clocks: int):
+        # Don't key off if the next event is a tie
+        frame = self.frames[-1]
+        if frame.i < len(frame.events) and frame.events[frame.i][0] == "&":
+            self.gate = -1
+        elif self.articulation in (0, 8):
+            self.gate = clocks
+        else:
+            self.gate = max(1, clocks * self.articulation // 8)
+
+    def start_portamento(self, start, end, clocks: int):
+        (start_octave, start_note), (end_octave, end_note) = start, end
+        step = portamento_step(
+            self.SSG,
+            (start_octave << 4) | start_note,
+            (end_octave << 4) | end_note,
+            clocks
+        )
+        if self.SSG:
+            # GUESS: The SSG tables don't make a whole lot of sense, so SSG
+            # portamentos glide linearly between the two periods instead.
+            start_period = ssg_period(midi_frequency(
+                (start_octave + 2) * 12 + start_note + self.transpose
+            ))
+            end_period = ssg_period(midi_frequency(
+                (end_octave + 2) * 12 + end_note + self.transpose
+            ))
+            self.pitch = start_period
+            step = (end_period - start_period) / max(clocks, 1)
+            self.portamento_start = start_period
+        else:
+            octave, note = divmod(
+                start_octave * 12 + start_note + self.transpose, 12
+            )
+            self.pitch = octave * OCTAVE_STEPS + FM_FNUMS[note] - OCTAVE_STEPS
+        if self.tie:
+            self.tie = False
+            self.write_pitch()
+        else:
+            self.note_on()
+        # Portamentos ignore articulation
+        self.portamento_step = step
+        self.portamento_clocks = clocks
+        self.portamento_elapsed = 0
+        self.wait = clocks
+        self.gate = clocks
+
+    def run_events(self):
+        '''
+        Processes events until one of them takes time (a note, rest, or
+        portamento), or the channel runs out of events.
+        '''
+        count = 0
+        while self.wait == 0:
+            frame = self.frames[-1]
+            if frame.i >= len(frame.events):
+                if len(self.frames) > 1:
+                    # Return from macro
+                    self.frames.pop()
+                    continue
+                # End of channel
+                self.passes += 1
+                if not self.finished:
+                    self.finished = True
+                    self.emu.channel_finished(self)
+                if self.loop_pos >= 0 and not self.emu.stopping:
+                    frame.i = self.loop_pos
+                    frame.loop_stack.clear()
+                    frame.return_stack.clear()
+                    frame.skip_stack.clear()
+                    frame.octave_stack.clear()
+                else:
+                    self.note_off()
+                    self.stopped = True
+                    return
+            count += 1
+            if count > EVENT_LIMIT:
+                self.note_off()
+                self.stopped = True
+                return
+            event = frame.events[frame.i]
+            frame.i += 1
+            self.run_event(frame, event)
+
+    def run_event(self, frame: Frame, event: tuple):
+        emu = self.emu
+        command = event[0]
+        if command == "note":
+            frame.octave += event[1]
+            self.start_note(event[2], frame.octave, event[3])
+        elif command == "r":
+            self.note_off()
+            self.tie = False
+            self.wait = event[1]
+            self.gate = -1
+        elif command == "(":
+            self.start_portamento(event[1], event[2], event[3])
+        elif command == "O":
+            frame.octave = event[1]
+        elif command == "&":
+            self.tie = True
+        elif command in LOOP_STARTS:
+            frame.loop_stack.append(event[1] - 1)
+            frame.return_stack.append(frame.i)
+            frame.skip_stack.append(-1)
+            frame.octave_stack.append(frame.octave)
+        elif command in LOOP_SKIPS:
+            if frame.loop_stack[-1] == 0 and frame.skip_stack[-1] >= 0:
+                frame.i = frame.skip_stack[-1]
+        elif command in LOOP_ENDS:
+            if frame.loop_stack[-1] == 0:
+                frame.loop_stack.pop()
+                frame.return_stack.pop()
+                frame.skip_stack.pop()
+                frame.octave_stack.pop()
+            else:
+                frame.loop_stack[-1] -= 1
+                frame.skip_stack[-1] = frame.i - 1
+                frame.i = frame.return_stack[-1]
+                frame.octave = frame.octave_stack[-1]
+        elif command == "/":
+            self.note_off()
+        elif command == "^":
+            self.detune = event[1]
+            if self.key_on:
+                self.write_pitch()
+        elif command == "@^":
+            self.transpose = event[1]
+        elif command == "t":
+            emu.set_tempo(event[1] or DEFAULT_TEMPO)
+        elif command == "Q":
+            self.articulation = event[1]
+        elif command == "N":
+            self.noise_mix = event[1]
+        elif command == "@":
+            if self.FM:
+                if event[1] < len(emu.song.fm):
+                    self.inst = emu.song.fm[event[1]]
+                    self.write_fm_instrument()
+            elif self.SSG:
+                self.envelope = emu.song.ssg[event[1]] if (
+                    event[1] < len(emu.song.ssg)
+                ) else None
+            elif self.RHYTHM:
+                self.rhythm_samples = event[1]
+        elif command == "V" or command == "@V":
+            if self.RHYTHM:
+                if command == "@V":
+                    self.rhythm_levels[event[1]] = event[2]
+                    self.write_rhythm_level(event[1])
+                else:
+                    emu.write(0, 0x11, event[1] & 0x3F)
+                    for j in range(6):
+                        self.rhythm_levels[j] = event[j + 2]
+                        self.write_rhythm_level(j)
+            else:
+                self.volume = event[1]
+                self.write_volume()
+        elif command == "@V+" or command == "@V-":
+            change = -event[1] if (command == "@V-") else event[1]
+            limit = 127 if self.FM else 15
+            self.volume = max(0, min(self.volume + change, limit))
+            self.write_volume()
+        elif command == "P":
+            if self.RHYTHM:
+                self.rhythm_pans[event[1]] = event[2]
+                self.write_rhythm_level(event[1])
+            elif self.FM:
+                self.pan = event[1]
+                self.write_fm_pan()
+        elif command == "W":
+            if self.SSG:
+                emu.write(0, 0x06, event[1] & 0x1F)
+            else:
+                self.lfo_delay_override = event[1]
+        elif command == "S":
+            # Pitch LFO, triangle: speed, depth, proportion, delay
+            self.lfo = (True, event[1], 0, event[2], event[4])
+        elif command == "SP" or command == "SA":
+            # Pitch/amplitude LFO: speed, waveform, depth, proportion, delay
+            self.lfo = (
+                command == "SP", event[1], event[2], event[3], event[5]
+            )
+        elif command == "SH":
+            # Hardware LFO: speed, sync, PMS, AMS
+            emu.write(0, 0x22, 0x08 | (event[1] & 0x07))
+            if self.FM and self.inst is not None:
+                self.write(
+                    0xB4 + self.reg,
+                    PAN_BITS[self.pan & 3] | (event[4] << 4) | event[3]
+                )
+        elif command == "_":
+            self.fade_rate = event[1]
+            self.fade_counter = 0
+            # Fading in starts from silence
+            self.fade_level = 127 if (event[1] > 0) else 0
+            self.write_volume()
+        elif command == "Y":
+            self.write(event[1], event[2])
+        elif command == "\\":
+            if self.loop_clock < 0:
+                self.loop_clock = emu.clock
+                emu.loop_reached(self)
+        elif command == "U":
+            macro = emu.macro_list[event[1]]
+            self.frames.append(Frame(emu.compiled(macro), frame.octave))
+        # "Z" (sync-work value entry) doesn't do anything audible
+
+    def tick(self):
+        '''
+        Handles everything that happens every clock: portamentos, software
+        LFOs, fades and SSG envelopes.
+        '''
+        clock = self.emu.clock
+        pitch_changed = False
+        volume_changed = False
+
+        if self.portamento_clocks > 0:
+            self.portamento_elapsed += 1
+            if self.SSG:
+                self.pitch = round(
+                    self.portamento_start
+                    + self.portamento_step * self.portamento_elapsed
+                )
+            else:
+                self.pitch += self.portamento_step
+            self.portamento_clocks -= 1
+            pitch_changed = True
+
+        if self.lfo is not None and self.key_on:
+            # GUESS: After the delay, the LFO moves 1 step every `speed`
+            # clocks, between -depth and +depth (triangle), or from 0 to
+            # depth (sawtooth, in the direction given by the waveform).
+            # Proportion is ignored.
+            is_pitch, speed, wave, depth, delay = self.lfo
+            if self.lfo_delay_override >= 0:
+                delay = self.lfo_delay_override
+            since = clock - self.on_clock - delay
+            if since >= 0 and depth:
+                phase = since // max(speed, 1)
+                if wave:
+                    offset = phase % (depth + 1)
+                    offset = -offset if (wave == 1) else offset
+                else:
+                    period = depth * 4
+                    p = phase % period
+                    offset = p if (p <= depth) else (
+                        2 * depth - p if (p <= 3 * depth) else p - 4 * depth
+                    )
+                if offset != self.lfo_offset:
+                    self.lfo_offset = offset
+                    if is_pitch:
+                        pitch_changed = True
+                    else:
+                        volume_changed = True
+
+        if self.fade_rate != 0:
+            # GUESS: Fades move the volume by 1 FM TL step every |rate| clocks
+            self.fade_counter += 1
+            if self.fade_counter >= abs(self.fade_rate):
+                self.fade_counter = 0
+                if self.fade_rate > 0:
+                    self.fade_level -= 1
+                    if self.fade_level <= 0:
+                        self.fade_level = 0
+                        self.fade_rate = 0
+                else:
+                    self.fade_level += 1
+                    if self.fade_level >= 127:
+                        self.fade_level = 127
+                        self.fade_rate = 0
+                volume_changed = True
+
+        if self.SSG and self.envelope is not None:
+            volume_changed = True
+
+        if pitch_changed and (self.key_on or self.portamento_clocks):
+            self.write_pitch()
+        if volume_changed:
+            self.write_volume()
+
+
+class Emulator:
+    def __init__(self, song: Song, cut_time=False):
+        self.song = song
+        self.cut_time = cut_time
+        self.macro_list: List[Macro] = list(v for _, v in sorted(
+            song.macros.items(), key=lambda m: m[1].macro_id
+        ))
+        self.compiled_events: Dict[int, list] = {}
+        self.registers: Dict[Tuple[int, int], int] = {}
+        self.log = RegisterLog()
+        self.pending: List[Tuple[int, float, int, int, int]] = []
+        self.clock = 0
+        self.time = 0.0
+        self.tempo = DEFAULT_TEMPO
+        # Times are counted from the last tempo change, so that rounding
+        # errors don't pile up over a long song
+        self.tempo_clock = 0
+        self.tempo_time = 0.0
+        self.stopping = False
+
+        self.channels: List[ChannelEmulator] = []
+        for ch in song.channels:
+            # The low bits of the ID say which chip channel it is, even if
+            # the channels before it are missing (e.g. D without A-C)
+            if ch.id & 0xC0:
+                self.channels.append(ChannelEmulator(self, ch, ch.id & 0x0F))
+            elif ch.id & 0x10:
+                self.channels.append(ChannelEmulator(self, ch, 0))
+            # ADPCM channels aren't emulated (yet?)
+
+    def compiled(self, ch: Channel) -> list:
+        key = id(ch)
+        events = self.compiled_events.get(key)
+        if events is None:
+            events = compile_events(ch, self.cut_time)
+            self.compiled_events[key] = events
+        return events
+
+    def write(self, port: int, register: int, value: int):
+        # Key-on registers always get written, everything else only if the
+        # value actually changed.
+        key = (port, register)
+        if (
+            self.registers.get(key) == value
+            and not (port == 0 and register in (0x10, 0x28))
+        ):
+            return
+        self.registers[key] = value
+        self.pending.append((self.clock, self.time, port, register, value))
+
+    def register_state(self) -> List[Tuple[int, float, int, int, int]]:
+        '''
+        Returns writes that put every register written so far (except the
+        key-on ones) back to its current value. They're in the order each
+        register was first written, so e.g. F-numbers still get their high
+        byte before their low byte.
+        '''
+        return [
+            (self.clock, self.time, port, register, value)
+            for (port, register), value in self.registers.items()
+            if not (port == 0 and register in (0x10, 0x28))
+        ]
+
+    def set_tempo(self, tempo: int):
+        self.tempo_clock = self.clock
+        self.tempo_time = self.time
+        self.tempo = tempo
+
+    def channel_finished(self, ch: ChannelEmulator):
+        ch.end_clock = self.clock
+
+    def loop_reached(self, ch: ChannelEmulator):
+        # The loop point is wherever the LAST channel reaches its loop marker
+        if all(c.loop_clock >= 0 for c in self.channels if c.loop_pos >= 0):
+            self.log.loop_clock = self.clock
+            self.log.loop_time = self.time
+
+    def aligned_end(self) -> int:
+        '''
+        Returns the clock to stop at so that every looping channel's loop body
+        (from its `\\` to its end) fits between the loop point and the end a
+        whole number of times, i.e. a multiple of their least common multiple
+        past the loop point. Then looping back lands every channel exactly
+        where it was the first time around. If that's over LOOP_ALIGN_LIMIT
+        times later than now, or nothing loops, returns the current clock.
+        Only makes sense once every channel has finished.
+        '''
+        loop_start = self.log.loop_clock
+        if loop_start < 0:
+            return self.clock
+        period = 1
+        for ch in self.channels:
+            body = ch.end_clock - ch.loop_clock
+            if ch.loop_clock >= 0 and body > 0:
+                period = period * body // gcd(period, body)
+        periods = max(1, -(-(self.clock - loop_start) // period))
+        aligned = loop_start + periods * period
+        if aligned > self.clock * LOOP_ALIGN_LIMIT:
+            return self.clock
+        return aligned
+
+    def iter_writes(
+        self,
+        max_clocks=-1,
+        align_loops=False
+    ) -> Iterator[List[Tuple[int, float, int, int, int]]]:
+        '''
+        Runs the emulator until every channel has played through once (or
+        stopped), and yields the register writes one clock at a time, as lists
+        of `(clock, time, port, register, value)` tuples.
+        Channels with infinite loops keep looping until then.
+        `self.log.loop_clock` is set as soon as the loop point is passed, and
+        the rest of `self.log` (minus `writes`) once this is exhausted.
+
+        :param max_clocks: Stops early after this many clocks, if not -1.
+        :param align_loops: Keeps going after that, until the end lines up
+            with every channel's loop (see `aligned_end()`).
+        '''
+        # Initial chip setup: 6 FM channels, SSG mixer all off, RHYTHM on
+        self.write(0, 0x29, 0x80)
+        self.write(0, 0x07, 0x3F)
+        self.write(0, 0x11, 0x3F)
+        for ch in self.channels:
+            if ch.RHYTHM:
+                for j in range(6):
+                    ch.write_rhythm_level(j)
+
+        channels = self.channels
+        log = self.log
+        end_clock = -1
+        restored = False
+        while True:
+            # The next pass starts here, so it's left to the loop point
+            if 0 <= end_clock <= self.clock:
+                break
+            for ch in channels:
+                if not ch.stopped and ch.wait == 0:
+                    ch.run_events()
+            if not restored and log.loop_clock == self.clock:
+                # Writes that don't change anything get skipped, so the ones
+                # that would set things back to how they were at the loop
+                # point wouldn't be there when looping back. So the loop
+                # starts by setting everything.
+                restored = True
+                self.pending[:0] = self.register_state()
+            if self.pending:
+                yield self.pending
+                self.pending = []
+
+            if end_clock < 0 and all(
+                ch.finished or ch.stopped for ch in channels
+            ):
+                if not align_loops:
+                    break
+                end_clock = self.aligned_end()
+                if end_clock <= self.clock:
+                    break
+            if 0 <= max_clocks <= self.clock:
+                break
+
+            # Figure out how far to jump ahead
+            step = None
+            for ch in channels:
+                if ch.stopped:
+                    continue
+                if ch.needs_ticks():
+                    step = 1
+                    break
+                for n in (ch.wait, ch.gate):
+                    if n > 0 and (step is None or n < step):
+                        step = n
+            if step is None:
+                break
+            if end_clock >= 0:
+                step = min(step, end_clock - self.clock)
+
+            self.clock += step
+            self.time = self.tempo_time + (
+                (self.clock - self.tempo_clock) * 60
+                / (self.tempo * CLOCKS_PER_QUARTER)
+            )
+            for ch in channels:
+                if ch.stopped:
+                    continue
+                ch.wait -= step
+                if ch.gate > 0:
+                    ch.gate -= step
+                    if ch.gate == 0:
+                        ch.gate = -1
+                        ch.note_off()
+                if step == 1 and ch.needs_ticks():
+                    ch.tick()
+
+        # Key everything off at the end
+        self.stopping = True
+        for ch in channels:
+            ch.note_off()
+        if self.pending:
+            yield self.pending
+            self.pending = []
+        log.end_clock = self.clock
+        log.end_time = self.time
+
+    def run(self, max_clocks=-1, align_loops=False) -> RegisterLog:
+        '''
+        Runs the emulator to the end (see `iter_writes()`), and returns the
+        log of register writes.
+
+        :param max_clocks: Stops early after this many clocks, if not -1.
+        :param align_loops: See `iter_writes()`.
+        '''
+        log = self.log
+        for writes in self.iter_writes(max_clocks, align_loops):
+            if log.loop_index < 0 and 0 <= log.loop_clock <= writes[0][0]:
+                log.loop_index = len(log.writes)
+            log.writes.extend(writes)
+        return log
+
+
+# API functions
+def emulate_song(
+    song: Song,
+    cut_time=False,
+    max_clocks=-1,
+    align_loops=False
+) -> RegisterLog:
+    '''
+    Emulates MDRV2 playing the specified Song, and returns a RegisterLog
+    containing every YM2608 register write it would make, with timestamps.
+    NOTE: This function can raise BaseExceptions.
+
+    :param song: A Song instance returned from `parse_mdt()`.
+    :param cut_time: Must match the value the Song was parsed with.
+    :param max_clocks: Stops early after this many clocks, if not -1.
+    :param align_loops: Keeps emulating until every channel's loop lines up
+        with the end, so the log loops seamlessly (see `write_vgm_file()`).
+    '''
+    if song.chip != 1:
+        raise BaseException("Provided Song is not for OPN/OPNA.")
+    return Emulator(song, cut_time).run(max_clocks, align_loops)
+
+
+def write_register_log(filename: str, log: RegisterLog):
+    '''
+    Writes a RegisterLog to a text file, one write per line:
+    time (seconds), clock, port, register, value.
+
+    :param filename: A path to where the log will be written.
+    :param log: A RegisterLog returned from `emulate_song()`.
+    '''
+    with atomic_open(filename, "w", newline="\n") as f:
+        for i, (clock, time, port, register, value) in enumerate(log.writes):
+            if i == log.loop_index:
+                f.write("; loop\n")
+            f.write(f"{time:.6f} {clock} {port} {register:02X} {value:02X}\n")
+
+
+def write_vgm_file(filename: str, song: Song, cut_time=False):
+    '''
+    Emulates MDRV2 playing the specified Song, and writes the result to a VGM
+    file for the YM2608. If the Song has an infinite loop (`\\`), the VGM
+    loops from wherever the last channel reaches its loop marker, and ends
+    once every channel's loop body fits in between a whole number of times,
+    so that the loop is seamless. If that would make it over LOOP_ALIGN_LIMIT
+    times longer, it ends when the last channel finishes its first pass
+    instead, and channels whose loops are shorter than that will jump when
+    the VGM loops.
+    Register writes are encoded as they come out of the emulator, so only one
+    chunk of output is ever held in memory.
+    NOTE: This function can raise BaseExceptions.
+
+    :param filename: A path to where the VGM file will be written.
+    :param song: A Song instance returned from `parse_mdt()`.
+    :param cut_time: Must match the value the Song was parsed with.
+    '''
+    if song.chip != 1:
+        raise BaseException("Provided Song is not for OPN/OPNA.")
+    emu = Emulator(song, cut_time)
+    log = emu.log
+    with atomic_open(filename, "wb") as f:
+        f.write(bytes(VGM_HEADER_SIZE))  # Filled in at the end
+        offset = VGM_HEADER_SIZE
+        loop_offset = -1
+        loop_sample = 0
+        sample = 0
+        out = bytearray()
+        for writes in emu.iter_writes(align_loops=True):
+            # Rounding each write's own time (instead of adding up rounded
+            # waits) keeps the VGM from drifting out of time
+            if loop_offset < 0 and 0 <= log.loop_clock <= writes[0][0]:
+                target = round(log.loop_time * VGM_SAMPLE_RATE)
+                if target > sample:
+                    out += vgm_wait(target - sample)
+                    sample = target
+                loop_offset = offset + len(out)
+                loop_sample = sample
+            target = round(writes[0][1] * VGM_SAMPLE_RATE)
+            if target > sample:
+                out += vgm_wait(target - sample)
+                sample = target
+            for _, _, port, register, value in writes:
+                out += bytes((VGM_WRITE_COMMANDS[port], register, value))
+            if len(out) >= VGM_CHUNK_SIZE:
+                f.write(out)
+                offset += len(out)
+                out = bytearray()
+        target = round(log.end_time * VGM_SAMPLE_RATE)
+        if target > sample:
+            out += vgm_wait(target - sample)
+            sample = target
+        out.append(0x66)  # End of sound data
+        f.write(out)
+        offset += len(out)
+        gd3_offset = offset
+        f.write(gd3_tag(song.title))
+        end = f.tell()
+
+        header = bytearray(VGM_HEADER_SIZE)
+        header[:4] = b"Vgm "
+        pack_into("<I", header, 0x04, end - 0x04)
+        pack_into("<I", header, 0x08, VGM_VERSION)
+        pack_into("<I", header, 0x14, gd3_offset - 0x14)
+        pack_into("<I", header, 0x18, sample)
+        if loop_offset >= 0:
+            pack_into("<I", header, 0x1C, loop_offset - 0x1C)
+            pack_into("<I", header, 0x20, sample - loop_sample)
+        pack_into("<I", header, 0x34, VGM_HEADER_SIZE - 0x34)
+        pack_into("<I", header, 0x48, OPNA_CLOCK)
+        f.seek(0)
+        f.write(header)
+
+
+if __name__ == "__main__":
+    if len(CMD_ARGS) < 3:
+        print("Please specify an input MDT file and an output location.")
+        exit()
+
+    from mdt_decomp_rip import parse_mdt
+    cut_time = len(CMD_ARGS) >= 4 and CMD_ARGS[3].lower() == "true"
+    song = parse_mdt(CMD_ARGS[1], cut_time)
+    if CMD_ARGS[2].lower().endswith(".vgm"):
+        write_vgm_file(CMD_ARGS[2], song, cut_time)
+    else:
+        write_register_log(CMD_ARGS[2], emulate_song(song, cut_time))
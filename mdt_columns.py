@@ -0,0 +1,325 @@
+# Contains an exporter that turns MDT files into columnar tables, for
+# analyzing lots of songs at once (note length histograms, instrument usage,
+# tempos, etc.) with NumPy, pandas, or anything else that reads tables.
+
+# Two tables are written, with the same columns:
+# - Events: every MML event in every channel, as decoded (see
+#   `Channel.events`). Macros and loops are NOT expanded, so times are
+#   positions in the channel's data, not in the song. Pitches are as written
+#   (before transposing), and velocities/instruments are the last values set
+#   with a volume/@ command, or -1 before that.
+# - Notes: every note that actually plays, from md2mml_midi's converter, with
+#   macros, loops and ties all resolved. Times and lengths are real, and
+#   velocities are MIDI velocities. Instruments are MML instrument numbers
+#   (-1 on RHYTHM channels, where the pitch says which drum it is).
+# Times and lengths are in clocks (48 per quarter note).
+
+# The tables are NumPy structured arrays, saved as .npy files, or as Parquet
+# files if pyarrow is installed. Either way, rows are written out one song at
+# a time while the files are being read, so exporting a whole corpus only
+# ever needs one song in memory. (Since a .npy header has to say how many
+# rows there are, a placeholder is written first and filled in at the end.)
+
+
+from glob import glob
+from sys import argv as CMD_ARGS, exit
+from typing import Iterator, List, Tuple
+
+import numpy as np
+
+from md2mml_midi import (
+    CLOCKS_PER_QUARTER,
+    NOTE_NAME_CHARS,
+    NOTE_STARTS,
+    NoteEvent,
+    PercussionEvent,
+    ProgramEvent,
+    channel_assignments,
+    iter_song_events,
+    parse_length
+)
+from mdt_decomp_rip import NOTE_NAMES, Channel, Song, atomic_open, parse_mdt
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+
+# Constants
+ROW_DTYPE = np.dtype([
+    ("file", "U64"),
+    ("channel", "u1"),  # Channel ID, e.g. 0x80 for the first FM channel
+    ("index", "i4"),  # Position in the channel's events (or notes)
+    ("opcode", "U4"),  # MML command, or "note"
+    ("pitch", "i2"),
+    ("time", "i8"),
+    ("length", "i4"),
+    ("velocity", "i2"),
+    ("instrument", "i2")
+])
+NPY_MAGIC = b"\x93NUMPY\x01\x00"
+NPY_MAX_ROWS = 10 ** 15  # Only used to size the placeholder header
+NPY_ALIGNMENT = 64
+# Maps every instrument number to itself, so the converter's ProgramEvents
+# carry MML instrument numbers
+IDENTITY_INST_MAP = {i: i for i in range(256)}
+
+
+# Helper functions
+def to_clocks(length: float) -> int:
+    # Lengths from md2mml_midi are in quarter notes
+    return round(length * CLOCKS_PER_QUARTER)
+
+
+def npy_header(count: int, size=0) -> bytes:
+    '''
+    Returns a version 1.0 .npy header for `count` rows of ROW_DTYPE, padded
+    to `size` bytes (or the next multiple of 64, if that's bigger).
+    '''
+    header = (
+        "{{'descr': {!r}, 'fortran_order': False, 'shape': ({},), }}".format(
+            np.lib.format.dtype_to_descr(ROW_DTYPE), count
+        ).encode("latin1")
+    )
+    unpadded = len(NPY_MAGIC) + 2 + len(header) + 1
+    size = max(size, -(-unpadded // NPY_ALIGNMENT) * NPY_ALIGNMENT)
+    header += b" " * (size - unpadded) + b"\n"
+    return NPY_MAGIC + len(header).to_bytes(2, "little") + header
+
+
+def iter_channel_rows(
+    filename: str,
+    ch: Channel
+) -> Iterator[Tuple]:
+    # Octaves are tracked the same way the decoder wrote them, including
+    # being restored at the end of loops that were exited early
+    octave = 4
+    octave_stack: List[int] = []
+    time = 0
+    velocity = -1
+    instrument = -1
+    for i, event in enumerate(ch.events):
+        command = event[0]
+        pitch = -1
+        length = 0
+        opcode = command
+        if command[0] in NOTE_STARTS:
+            if command[0] == "<":
+                octave -= 1
+                command = command[1:]
+            elif command[0] == ">":
+                octave += 1
+                command = command[1:]
+            name_end = 1
+            while command[name_end] in NOTE_NAME_CHARS:
+                name_end += 1
+            pitch = NOTE_NAMES.index(command[:name_end]) + (octave + 1) * 12
+            length = to_clocks(parse_length(command[name_end:]))
+            opcode = "note"
+        elif command[0] == "(":
+            # Portamento, e.g. "(4c,5d)4". The starting note is the pitch.
+            comma_index = command.index(",")
+            pitch = NOTE_NAMES.index(command[2:comma_index]) + (
+                int(command[1]) + 1
+            ) * 12
+            length = to_clocks(parse_length(
+                command[command.index(")") + 1:]
+            ))
+            opcode = "note"
+        elif command[0] == "r":
+            length = to_clocks(parse_length(command[1:]))
+            opcode = "r"
+        elif command == "O":
+            octave = event[1]
+        elif command == "|:":
+            octave_stack.append(-1)
+        elif command == ":" and octave_stack and octave_stack[-1] == -1:
+            octave_stack[-1] = octave
+        elif command == ":|" and octave_stack:
+            if octave_stack[-1] >= 0:
+                octave = octave_stack[-1]
+            octave_stack.pop()
+        elif command in ("V", "@V"):
+            # On RHYTHM channels, this is the first (master) volume
+            velocity = event[1]
+        elif command == "@":
+            instrument = event[1]
+        yield (
+            filename, ch.id, i, opcode, pitch, time, length, velocity,
+            instrument
+        )
+        time += length
+
+
+# Classes
+class NpyTableWriter:
+    '''
+    Writes rows to a .npy file as they come, without keeping them around.
+    Use as a context manager, so the header gets filled in (and the file only
+    replaces `filename` once everything's been written).
+    '''
+
+    def __init__(self, filename: str):
+        self.filename = filename
+        self.count = 0
+
+    def __enter__(self):
+        self.context = atomic_open(self.filename, "wb")
+        self.f = self.context.__enter__()
+        self.header_size = len(npy_header(NPY_MAX_ROWS))
+        self.f.write(npy_header(0, self.header_size))
+        return self
+
+    def write(self, rows: np.ndarray):
+        self.f.write(rows.astype(ROW_DTYPE, copy=False).tobytes())
+        self.count += len(rows)
+
+    def __exit__(self, exc_type, exc, traceback):
+        if exc_type is None:
+            self.f.seek(0)
+            self.f.write(npy_header(self.count, self.header_size))
+        return self.context.__exit__(exc_type, exc, traceback)
+
+
+class ParquetTableWriter:
+    '''
+    Writes rows to a Parquet file as they come, one row group per `write()`.
+    Requires pyarrow.
+    '''
+
+    def __init__(self, filename: str):
+        if pa is None:
+            raise BaseException("Writing Parquet files requires pyarrow.")
+        self.filename = filename
+        self.schema = pa.schema([
+            (name, pa.from_numpy_dtype(ROW_DTYPE[name]))
+            if ROW_DTYPE[name].kind != "U" else (name, pa.string())
+            for name in ROW_DTYPE.names
+        ])
+
+    def __enter__(self):
+        self.context = atomic_open(self.filename, "wb")
+        self.writer = pq.ParquetWriter(self.context.__enter__(), self.schema)
+        return self
+
+    def write(self, rows: np.ndarray):
+        if len(rows):
+            self.writer.write_table(pa.Table.from_arrays(
+                [pa.array(rows[name]) for name in ROW_DTYPE.names],
+                schema=self.schema
+            ))
+
+    def __exit__(self, exc_type, exc, traceback):
+        self.writer.close()
+        return self.context.__exit__(exc_type, exc, traceback)
+
+
+# API functions
+def event_table(song: Song) -> np.ndarray:
+    '''
+    Returns every MML event in the Song's channels, one row each.
+
+    :param song: A Song instance returned from `parse_mdt()`.
+    '''
+    rows = []
+    for ch in song.channels:
+        rows.extend(iter_channel_rows(song.filename, ch))
+    return np.array(rows, dtype=ROW_DTYPE)
+
+
+def note_table(song: Song, cut_time=False) -> np.ndarray:
+    '''
+    Converts the specified MDT `Song` to MIDI events, and returns every note
+    that plays, one row each, in order of time.
+    NOTE: This function can raise BaseExceptions.
+
+    :param song: A Song instance returned from `parse_mdt()`.
+    :param cut_time: If True, all note lengths in macros will be doubled.
+    '''
+    inst_map = {song.track_key: IDENTITY_INST_MAP}
+    channel_ids = {
+        midi_ch: ch.id for ch, midi_ch, _ in channel_assignments(
+            song, inst_map, inst_map
+        )
+    }
+    instruments = {}
+    counts = {}
+    rows = []
+    for event in iter_song_events(
+        song,
+        fm_inst_map=inst_map,
+        ssg_inst_map=inst_map,
+        cut_time=cut_time
+    ):
+        if isinstance(event, ProgramEvent):
+            instruments[event.channel] = event.program
+        elif isinstance(event, (NoteEvent, PercussionEvent)):
+            for n in event.notes():
+                i = counts.get(n.channel, 0)
+                counts[n.channel] = i + 1
+                rows.append((
+                    song.filename,
+                    channel_ids[n.channel],
+                    i,
+                    "note",
+                    n.pitch,
+                    to_clocks(n.time),
+                    to_clocks(n.duration),
+                    n.velocity,
+                    instruments.get(n.channel, -1)
+                ))
+    return np.array(rows, dtype=ROW_DTYPE)
+
+
+def export_corpus(
+    filenames: List[str],
+    events_filename: str,
+    notes_filename: str,
+    parquet=False,
+    cut_time=False
+) -> int:
+    '''
+    Exports the event and note tables of every file, in one pass. Files that
+    can't be read or converted are skipped. Returns how many were exported.
+
+    :param filenames: Paths to the MDT files.
+    :param events_filename: A path to where the event table will be written.
+    :param notes_filename: A path to where the note table will be written.
+    :param parquet: If True, Parquet files are written instead of .npy files.
+    (This requires pyarrow.)
+    '''
+    writer = ParquetTableWriter if parquet else NpyTableWriter
+    exported = 0
+    with writer(events_filename) as events, writer(notes_filename) as notes:
+        for filename in filenames:
+            try:
+                song = parse_mdt(filename, cut_time)
+                song_notes = note_table(song, cut_time)
+            except BaseException as err:
+                print("Skipping file", filename, "due to error:", err)
+                continue
+            events.write(event_table(song))
+            notes.write(song_notes)
+            exported += 1
+    return exported
+
+
+if __name__ == "__main__":
+    if len(CMD_ARGS) < 3:
+        print(
+            "Please specify an input folder and an output prefix, and",
+            "optionally \"parquet\" to write Parquet files instead of .npy."
+        )
+        exit()
+
+    parquet = len(CMD_ARGS) >= 4 and CMD_ARGS[3].lower() == "parquet"
+    extension = ".parquet" if parquet else ".npy"
+    count = export_corpus(
+        sorted(glob(f"{CMD_ARGS[1]}/*.MDT")),
+        CMD_ARGS[2] + "_events" + extension,
+        CMD_ARGS[2] + "_notes" + extension,
+        parquet
+    )
+    print("Exported", count, "files.")
@@ -1,6 +1,7 @@
 # Contains functions, etc. for parsing and decompiling MDT files, as well as
 # ripping and exporting the instruments stored in them. Only MDT files made for
-# the YM2608 (OPNA) that do not contain ADPCM data are known to be supported.
+# the YM2608 (OPNA) are known to be supported, and the layout of ADPCM data is
+# inferred rather than documented.
 
 # The decompilation parts of the script are HEAVILY based off of HertzDevil's
 # "MDRV2 MDT to MML unconverter" script, which was written in Lua. As of
@@ -16,8 +17,10 @@
 
 from io import TextIOWrapper as FILE
 from math import trunc, fabs as abs, log
+from contextlib import contextmanager
 from functools import partial
 from itertools import chain
+from os import fsync, remove, replace
 from sys import argv as CMD_ARGS, exit
 from typing import List, Dict, Union
 
@@ -30,6 +33,7 @@ from portamento_map_ssg import PORTAMENTO_MAP_SSG
 # Constants
 CHANNEL_FLAGS = {
     0x10: "L",
+    0x20: "M",  # ADPCM. The letter is a guess, since it comes after RHYTHM
     0x40: "I",
     0x41: "J",
     0x42: "K",
@@ -40,6 +44,90 @@ CHANNEL_FLAGS = {
     0x84: "E",
     0x85: "F"
 }
+# I don't have any MDTs for OPM or OPLL, so these are guesses: one ID per FM
+# channel, counting up from A just like OPN's. (OPLL's RHYTHM mode is assumed
+# to use the same ID as OPN's.)
+OPM_CHANNEL_FLAGS = {
+    0x80: "A",
+    0x81: "B",
+    0x82: "C",
+    0x83: "D",
+    0x84: "E",
+    0x85: "F",
+    0x86: "G",
+    0x87: "H"
+}
+OPLL_CHANNEL_FLAGS = {
+    0x10: "L",
+    0x80: "A",
+    0x81: "B",
+    0x82: "C",
+    0x83: "D",
+    0x84: "E",
+    0x85: "F",
+    0x86: "G",
+    0x87: "H",
+    0x88: "I"
+}
+
+# Each command byte, the name of the EventDecoder method that decodes it, and
+# how many bytes of parameters it takes (for skipping over it without decoding
+# it). Bytes that aren't in here are unused, and have no parameters.
+OPCODES = {
+    0x90: ("rest", 1),
+    0x91: ("tie", 0),
+    0xE0: ("loop_start", 1),
+    0xE1: ("loop_skip", 0),
+    0xE2: ("loop_end", 0),
+    0xE3: ("note_off", 0),
+    0xE4: ("bracket_loop_start", 1),
+    0xE5: ("bracket_loop_end", 0),
+    0xE6: ("detune", 1),
+    0xE7: ("transpose", 1),
+    0xE8: ("triangle_amplitude_lfo", 4),
+    0xE9: ("tempo", 1),
+    0xEA: ("articulation", 1),
+    0xEB: ("instrument", 1),
+    0xEC: ("volume", 1),
+    0xED: ("triangle_pitch_lfo", 4),
+    0xEE: ("register_move", 2),
+    0xEF: ("lfo_delay", 1),
+    0xF0: ("fade", 1),
+    0xF1: ("pan", 1),
+    0xF2: ("portamento", 4),
+    0xF3: ("infinite_loop", 2),
+    0xF4: ("volume_up", 1),
+    0xF5: ("volume_down", 1),
+    0xF6: ("colon_loop_start", 3),
+    0xF7: ("colon_loop_end", 3),
+    0xF8: ("sync_work", 1),
+    0xF9: ("colon_loop_skip", 2),
+    0xFA: ("macro", 2),
+    0xFB: ("sawtooth_pitch_lfo", 4),
+    0xFC: ("sawtooth_amplitude_lfo", 4),
+    0xFD: ("hardware_lfo", 4)
+}
+# Notes are 0x00...0x8F (octave << 4 + note). Octave 8 is only reachable by
+# SSG, since its octaves are shifted up by the OC compiler flag.
+OPCODES.update((i, ("note", 1)) for i in range(0x90))
+# RHYTHM channels take different parameters for a couple of commands.
+# (A size of -1 means that it depends on the first parameter.)
+RHYTHM_OPCODES = {
+    **OPCODES,
+    0xEC: ("rhythm_volume", -1),
+    0xF1: ("rhythm_pan", 2)
+}
+EVENT_SIZES = [OPCODES.get(i, ("", 0))[1] for i in range(0x100)]
+RHYTHM_EVENT_SIZES = [RHYTHM_OPCODES.get(i, ("", 0))[1] for i in range(0x100)]
+
+# Every note a portamento can start or end on: octaves 0-7, 12 notes each
+PORTAMENTO_NOTES = [(o << 4) + n for o in range(8) for n in range(12)]
+# OPM pitches are key codes (semitones) plus 64ths of a semitone
+OPM_KEY_FRACTIONS = 64
+# OPLL F-numbers for C...B, for a 3.58 MHz clock
+OPLL_FNUMS = [172, 181, 192, 204, 216, 229, 242, 257, 272, 288, 306, 324]
+
+FM_INSTRUMENT_SIZE = 32
 
 NOTE_NAMES = ["c", "c+", "d", "d+", "e", "f", "f+", "g", "g+", "a", "a+", "b"]
 
@@ -71,6 +159,8 @@ OPM_PARAM_COLUMNS = [2, 2, 2, 2, 2, 3, 1,  2,  1,  1,     1]
 
 OPM_OPERATOR_FLAGS = ["M1: ", "C1: ", "M2: ", "C2: "]
 
+SSG_ENVELOPE_LIMIT = 0x40
+
 TRACK_NUMBER_MAP = {
     "INIT.MDT": "INIT",
     "REIMU.MDT": "01",
@@ -103,7 +193,12 @@ def mml_length(length: int, cut_time: bool) -> str:
 
 
 def uint8(f: FILE) -> int:
-    return int.from_bytes(f.read(1), "big")
+    b = f.read(1)
+    if not b:
+        # Without this, reading past the end returns 0 forever, and every
+        # "while char != 0xFF" loop in this file hangs on truncated data. 🙃
+        raise BaseException("Unexpected end of MDT data.")
+    return int.from_bytes(b, "big")
 
 
 def int8(f: FILE) -> int:
@@ -131,6 +226,53 @@ def skip_bytes(f: FILE, n: int):
     f.seek(n, 1)
 
 
+def skip_event(f: FILE, char: int, channel_id: int):
+    '''
+    Skips over the parameters of the event whose command byte (`char`) was
+    just read, without parsing them.
+
+    :param channel_id: The ID of the channel (or macro) the event is in, since
+    some events take different parameters on RHYTHM channels.
+    '''
+    size = (RHYTHM_EVENT_SIZES if (channel_id & 0x10) else EVENT_SIZES)[char]
+    if size < 0:
+        # RHYTHM volume: either one sample's, or all of them
+        size = 1 if (uint8(f) & 0x80) else 6
+    skip_bytes(f, size)
+
+
+def linear_portamento_map(pitch) -> Dict[int, Dict[int, int]]:
+    '''
+    Builds a portamento map (like PORTAMENTO_MAP_FM) for a chip whose pitch
+    can be worked out directly, instead of having to be ripped from compiled
+    MDTs. `pitch` takes a note (octave << 4 + note) and returns its pitch, in
+    whatever units the driver glides in.
+    '''
+    return {
+        start: {pitch(end) - pitch(start): end for end in PORTAMENTO_NOTES}
+        for start in PORTAMENTO_NOTES
+    }
+
+
+def opm_pitch(note: int) -> int:
+    return ((note >> 4) * 12 + note % 0x10) * OPM_KEY_FRACTIONS
+
+
+def opll_pitch(note: int) -> int:
+    # Same idea as OPN: an octave is worth one C's worth of F-number
+    return (note >> 4) * OPLL_FNUMS[0] + OPLL_FNUMS[note % 0x10]
+
+
+def chip_profile(chip: int) -> "ChipProfile":
+    '''
+    Returns the ChipProfile for a Song's `chip` number.
+    NOTE: This function can raise BaseExceptions.
+    '''
+    if not 0 <= chip < len(CHIP_PROFILES):
+        raise BaseException("Only OPM, OPN, and OPLL chips are supported.")
+    return CHIP_PROFILES[chip]
+
+
 def str_join_list(seperator: str, the_list: list) -> str:
     return seperator.join(str(v) for v in the_list)
 
@@ -168,6 +310,34 @@ def write_unused_warning(f: FILE):
     f.write("// Please use these instruments at your own discretion.\n\n")
 
 
+@contextmanager
+def atomic_open(filename: str, mode="w", **kwargs):
+    '''
+    Works like `open()`, except that everything is written to a temporary file
+    next to `filename`, which only replaces `filename` once it's been written
+    and closed without errors. So if the program crashes (or gets killed)
+    halfway through, there's never a half-written file left behind.
+
+    :param filename: A path to the file to write.
+    :param mode: The mode to open the file in. Must be a writing mode.
+    '''
+    temp_filename = filename + ".tmp"
+    try:
+        with open(temp_filename, mode, **kwargs) as f:
+            yield f
+            # Otherwise a crash right after the rename could leave an empty
+            # file behind, on filesystems that don't order the two
+            f.flush()
+            fsync(f.fileno())
+        replace(temp_filename, filename)
+    except BaseException:
+        try:
+            remove(temp_filename)
+        except OSError:
+            pass
+        raise
+
+
 def remove_path(file_path: str) -> str:
     '''
     Removes directory names and slashes (foward and back) from a path,
@@ -183,6 +353,42 @@ def remove_path(file_path: str) -> str:
 
 
 # Classes
+class MemoryReader:
+    '''
+    A minimal, read-only, file-like wrapper around a bytes-like object (e.g. a
+    slice of an mmap), so MDT data can be parsed in place without copying it.
+    Reads are bounded: reading past the end raises instead of returning less.
+    '''
+
+    def __init__(self, data):
+        self.data = memoryview(data)
+        self.pos = 0
+        self.extent = 0  # One past the furthest byte read so far
+
+    def read(self, n=1) -> memoryview:
+        end = self.pos + n
+        if end > len(self.data):
+            raise BaseException("Unexpected end of MDT data.")
+        result = self.data[self.pos:end]
+        self.pos = end
+        self.extent = max(self.extent, end)
+        return result
+
+    def seek(self, offset: int, whence=0) -> int:
+        if whence == 1:
+            offset += self.pos
+        elif whence == 2:
+            offset += len(self.data)
+        self.pos = offset
+        return self.pos
+
+    def tell(self) -> int:
+        return self.pos
+
+    def close(self):
+        self.data.release()
+
+
 class Channel:
     def __init__(self, location: int, id: int):
         self.location = location
@@ -203,7 +409,7 @@ class Macro(Channel):
 class FMInstrument:
     OPERATOR_OFFSETS = [0, 2, 1, 3]
 
-    def __init__(self, params: list):
+    def __init__(self, params: list, operator_offsets=OPERATOR_OFFSETS):
         self.plays = False
         self.is_duplicate = False
         self.mml_names: Dict[str, List[int]] = {}
@@ -238,8 +444,8 @@ class FMInstrument:
         # brought to care anymore. 💀
         first[5] = params[30] % 0x80  # PMD
 
-        # Assign operator parameters, in OPNA register order (1, 3, 2, 4)
-        for i, j in enumerate(FMInstrument.OPERATOR_OFFSETS):
+        # Assign operator parameters, in register order (1, 3, 2, 4 on OPNA)
+        for i, j in enumerate(operator_offsets):
             op = self.params[i + 1]
             op[7] = params[j + 6] % 0x10  # ML
             op[8] = (
@@ -326,6 +532,438 @@ class SSGEnvelope:
         return f"P{str(number)} = {str_join_list(', ', self.params)}\r\n"
 
 
+class ChipProfile:
+    '''
+    Everything about decoding and converting MDTs that depends on which chip
+    they were compiled for. A Song's profile is looked up ONCE (with
+    `chip_profile()`), so nothing that runs per event ever checks the chip.
+    '''
+
+    def __init__(
+        self,
+        name: str,
+        channel_flags: Dict[int, str],
+        opcodes: Dict[int, tuple],
+        rhythm_opcodes: Dict[int, tuple],
+        operator_offsets: List[int],
+        fm_portamento_map: Dict[int, Dict[int, int]],
+        ssg_portamento_map: Dict[int, Dict[int, int]],
+        octave_offsets: Dict[int, int]
+    ):
+        self.name = name  # As written in MD2 files
+        self.channel_flags = channel_flags
+        # EventDecoder method names, indexed by command byte
+        self.handlers = [opcodes.get(i, ("", 0))[0] for i in range(0x100)]
+        self.rhythm_handlers = [
+            rhythm_opcodes.get(i, ("", 0))[0] for i in range(0x100)
+        ]
+        self.instrument_size = FM_INSTRUMENT_SIZE
+        self.operator_offsets = operator_offsets
+        self.fm_portamento_map = fm_portamento_map
+        self.ssg_portamento_map = ssg_portamento_map
+        # Octaves to add to MML octaves to get MIDI octaves, by channel type
+        # (channel ID & 0xF0)
+        self.octave_offsets = octave_offsets
+
+
+# As far as I can tell, the compiler emits the same commands and instrument
+# layout for every chip (it's the driver that's different), so only the
+# channels and pitches actually differ here. If anything turns out to be
+# chip-specific, it only has to be changed in its chip's profile.
+OPM_PORTAMENTO_MAP = linear_portamento_map(opm_pitch)
+OPLL_PORTAMENTO_MAP = linear_portamento_map(opll_pitch)
+CHIP_PROFILES = [
+    ChipProfile(
+        name="OPM",
+        channel_flags=OPM_CHANNEL_FLAGS,
+        opcodes=OPCODES,
+        rhythm_opcodes=RHYTHM_OPCODES,
+        operator_offsets=FMInstrument.OPERATOR_OFFSETS,
+        fm_portamento_map=OPM_PORTAMENTO_MAP,
+        ssg_portamento_map=OPM_PORTAMENTO_MAP,
+        octave_offsets={}
+    ),
+    ChipProfile(
+        name="OPN",
+        channel_flags=CHANNEL_FLAGS,
+        opcodes=OPCODES,
+        rhythm_opcodes=RHYTHM_OPCODES,
+        operator_offsets=FMInstrument.OPERATOR_OFFSETS,
+        fm_portamento_map=PORTAMENTO_MAP_FM,
+        ssg_portamento_map=PORTAMENTO_MAP_SSG,
+        # For reasons I don't fully understand, SSG plays one octave higher
+        # than specified in MML. Possibly related to the OC compiler flag?
+        octave_offsets={0x40: 1}
+    ),
+    ChipProfile(
+        name="OPLL",
+        channel_flags=OPLL_CHANNEL_FLAGS,
+        opcodes=OPCODES,
+        rhythm_opcodes=RHYTHM_OPCODES,
+        operator_offsets=FMInstrument.OPERATOR_OFFSETS,
+        fm_portamento_map=OPLL_PORTAMENTO_MAP,
+        ssg_portamento_map=OPLL_PORTAMENTO_MAP,
+        octave_offsets={}
+    )
+]
+
+
+class EventDecoder:
+    '''
+    Decodes the events in channels and macros into MML events. Each command
+    byte is looked up in a table of this class's methods (built from the chip
+    profile), which read the command's parameters from `f` and add the event.
+    '''
+
+    def __init__(
+        self,
+        f: FILE,
+        song: "Song",
+        profile: ChipProfile,
+        cut_time: bool
+    ):
+        self.f = f
+        self.song = song
+        self.profile = profile
+        self.cut_time = cut_time
+
+        # Control variables
+        self.octave = 0
+        self.oct_stack: List[int] = []
+        self.fm_usage: Dict[int, bool] = {}
+        self.ssg_usage: Dict[int, bool] = {}
+        self.noise_mix = 1
+        self.current_inst = 255
+        self.ch: Channel = None
+        self.channel_cut_time = cut_time
+        self.portamento_map = profile.fm_portamento_map
+
+        # Unused bytes get None, and are skipped over
+        def bind(names: List[str]) -> list:
+            return [getattr(self, v) if v else None for v in names]
+        self.handlers = bind(profile.handlers)
+        self.rhythm_handlers = bind(profile.rhythm_handlers)
+
+    def decode(self, ch: Channel):
+        '''
+        Decodes all of the events in `ch`, and adds them to it.
+        '''
+        f = self.f
+        self.ch = ch
+        self.octave = 0xFF  # Guarantees that first note sets octave
+        self.current_inst = 255
+        # NOTE (ha): Cut time CANNOT apply to macros, since the compiler isn't
+        # smart enough to figure out whether or not cut time applies to a
+        # macro during playback (which may require compiling two of the same
+        # macro). Instead, the compiler just assumes that cut time is NEVER
+        # used when it compiles macros.
+        self.channel_cut_time = self.cut_time and not isinstance(ch, Macro)
+        self.portamento_map = (
+            self.profile.ssg_portamento_map if (ch.id & 0x40)
+            else self.profile.fm_portamento_map
+        )
+        handlers = self.rhythm_handlers if (ch.id & 0x10) else self.handlers
+        loop_pos_file = -1
+
+        # Find the channel's infinite loop point, if there is one
+        f.seek(ch.location)
+        char = 0x00
+        while char != 0xFF:
+            char = uint8(f)
+
+            # Exit if we find it
+            if char == 0xF3:
+                loop_pos_file = int16(f) + f.tell()  # Order matters
+                break
+            # Otherwise, keep advancing based on command. If we don't, the
+            # loop might exit early. -__- (Yes, this caused me some headaches.)
+            skip_event(f, char, ch.id)
+
+        # Parse all the events in the channel
+        f.seek(ch.location)
+        char = 0x00
+        while char != 0xFF:
+            char = uint8(f)
+
+            # Add infinite loop event if need be
+            if f.tell() == loop_pos_file:
+                ch.add_event(["\\"])
+
+            # Parse the current event
+            # 0xFF: End of channel/macro. Part of loop condition
+            handler = handlers[char]
+            if handler is not None:
+                handler(char)
+
+    def note_str(self, char: int) -> str:
+        result = NOTE_NAMES[char % 0x10]
+        shift = (char >> 4) - self.octave
+        self.octave += shift
+        if abs(shift) >= 2:
+            # Separated into its own event for easier parsing in MDTtoMIDI.py
+            self.ch.add_event(["O", self.octave])
+        else:
+            oct_mark = ">" if (shift > 0) else "<" if (shift < 0) else ""
+            result = oct_mark + result
+        return result
+
+    def length_str(self) -> str:
+        return mml_length(uint8(self.f), self.channel_cut_time)
+
+    def note(self, char: int):
+        ch = self.ch
+        ch.add_event([self.note_str(char) + self.length_str()])
+        if ch.id & 0xC0:
+            (self.ssg_usage if (ch.id & 0x40) else self.fm_usage)[
+                self.current_inst
+            ] = True
+
+    def rest(self, char: int):
+        self.ch.add_event(["r" + self.length_str()])
+
+    def tie(self, char: int):
+        self.ch.add_event(["&"])
+
+    def loop_start(self, char: int):
+        # Loop start (pipe-colon)
+        self.oct_stack.append(-1)
+        self.ch.add_event(["|:", uint8(self.f)])
+
+    def loop_skip(self, char: int):
+        # Skip to end of loop on last iteration (pipe-colon)
+        if self.oct_stack[-1] == -1:
+            self.oct_stack[-1] = self.octave
+        self.ch.add_event([":"])
+
+    def loop_end(self, char: int):
+        # Loop end (pipe-colon)
+        if self.oct_stack[-1] >= 0:
+            self.octave = self.oct_stack[-1]
+        self.oct_stack.pop()
+        self.ch.add_event([":|"])
+
+    def note_off(self, char: int):
+        # Force note-off
+        self.ch.add_event(["/"])
+
+    def bracket_loop_start(self, char: int):
+        # These loops can't be exited early, so the octave stack isn't
+        # necessary.
+        self.ch.add_event(["[", uint8(self.f)])
+
+    def bracket_loop_end(self, char: int):
+        self.ch.add_event(["]"])
+
+    def detune(self, char: int):
+        self.ch.add_event(["^", int8(self.f)])
+
+    def transpose(self, char: int):
+        self.ch.add_event(["@^", int8(self.f)])
+
+    def triangle_amplitude_lfo(self, char: int):
+        a, b, c, d = read_params(self.f, 4)
+        self.ch.add_event(["SA", a, 0, b, c, d])
+
+    def tempo(self, char: int):
+        tempo = uint8(self.f)
+        # The @T (tempo + cut time) command seems to be a compiler flag,
+        # prompting it to double tempo and note lengths.
+        if self.cut_time:
+            self.ch.add_event(["@T", tempo * 2])
+        else:
+            self.ch.add_event(["t", tempo])
+
+    def articulation(self, char: int):
+        # Articulation (...is what I'm calling it)
+        self.ch.add_event(["Q", uint8(self.f)])
+
+    def instrument(self, char: int):
+        # FM instrument change,
+        # SSG noise mix and envelope change,
+        # RHYTHM sample selection,
+        # or ADPCM sample selection
+        ch = self.ch
+        inst_num = uint8(self.f)
+        if ch.id & 0x40:
+            # SSG noise mix and envelope
+            # MDRV2 appears to combine the tone/noise mix (2 bits) with the
+            # envelope number (6 bits). The Lua script assumes that N is
+            # always set to 1, thus producing negative envelope numbers for
+            # anything else. Whoops! 😜
+            # This actually took me a REALLY long time to fix, and I only
+            # figured it out thanks to the documentation, which states that
+            # the N command "[takes] effect at the point where the envelope
+            # settings are changed."
+            tone = not inst_num & 0x40
+            noise = not inst_num & 0x80
+            inst_num %= 0x40
+            # Booleans in Python are also integers:
+            new_noise_mix = noise * 2 + tone
+            if new_noise_mix != self.noise_mix:
+                self.noise_mix = new_noise_mix
+                ch.add_event(["N", self.noise_mix])
+        ch.add_event(["@", inst_num])
+        if ch.id & 0xC0:
+            self.current_inst = inst_num
+            (self.ssg_usage if (ch.id & 0x40) else self.fm_usage).setdefault(
+                inst_num,
+                False
+            )
+
+    def volume(self, char: int):
+        if self.ch.id & 0x40:
+            # SSG
+            # The Lua script (incorrectly) uses @V in SSG channels, so I added
+            # this to fix that.
+            # Hooray for translated docs! ✊
+            self.ch.add_event(["V", uint8(self.f)])
+        else:
+            # FM (or ADPCM, I guess, but 🤷‍♀️)
+            self.ch.add_event(["@V", uint8(self.f)])
+
+    def rhythm_volume(self, char: int):
+        first = uint8(self.f)
+        if first & 0x80:
+            # One RHYTHM sample
+            self.ch.add_event(["@V", first % 0x80, uint8(self.f)])
+        else:
+            # All RHYTHM samples
+            self.ch.add_event(["V", first, *read_params(self.f, 6)])
+
+    def triangle_pitch_lfo(self, char: int):
+        self.ch.add_event(["S", *read_params(self.f, 4)])
+
+    def register_move(self, char: int):
+        # Register move/copy
+        # ...O...kay? Is this actually a useful feature?
+        self.ch.add_event(["Y", *read_params(self.f, 2)])
+
+    def lfo_delay(self, char: int):
+        # FM LFO delay, or SSG noise frequency
+        self.ch.add_event(["W", uint8(self.f)])
+
+    def fade(self, char: int):
+        # Fade in/out
+        time = uint8(self.f)
+        self.ch.add_event(["_", 0x80 - time if (time & 0x80) else time])
+
+    def pan(self, char: int):
+        self.ch.add_event(["P", uint8(self.f)])
+
+    def rhythm_pan(self, char: int):
+        self.ch.add_event(["P", *read_params(self.f, 2)])
+
+    def portamento(self, char: int):
+        # Neither my nor HertzDevil's attempts at correctly calculating
+        # portamento from the MDT parameters succeeded, so I created a set of
+        # MD2 files containing every possible %1 portamento, compiled them,
+        # and extracted their parameters into a dict.
+        # There's DEFINITELY a better way to do this, but I've sunk WAY too
+        # much time into this already. 😭
+        # Portamentos in MDRV2 have 4 bytes of parameters:
+        f = self.f
+        start_note = uint8(f)  # Starting note (and octave)
+        duration = uint8(f)  # Duration, in clock cycles
+        change = int16(f)  # I have NO IDEA.
+        # Each octave up/down adds/subtracts 617 to change, and change is
+        # divided by duration during compilation. Semitones vary in size
+        # depending on the starting AND ENDING positions in their respective
+        # octaves, but the starting octave doesn't seem to matter??? IDK,
+        # dude. 😕
+        portamento_map = self.portamento_map
+        end_note = -1
+        for k, v in portamento_map[start_note].items():
+            # Find the note corresponding to the value of change
+            if trunc(k / duration) == change:  # Signed int division
+                end_note = v
+                break
+        # NOTE for people who don't write Python: code in a for...else block
+        # runs only if the for loop doesn't break.
+        else:
+            # If there's no direct correspondance, find whatever key is
+            # closest (and greater in magnitude) to change
+            # TODO: This might not work for SSG...
+            last = 0
+            change_abs = abs(change)
+            itemiter = sorted(portamento_map[start_note].items())
+            for k, v in reversed(itemiter) if change < 0 else itemiter:
+                if (change < 0 and k > 0) or (change >= 0 and k < 0):
+                    continue
+                last = k
+                if abs(k) > change_abs:
+                    end_note = v
+                    break
+            else:
+                end_note = portamento_map[start_note][last]
+        self.ch.add_event(["({}{},{}{}){}".format(
+            str(start_note >> 4),
+            NOTE_NAMES[start_note % 0x10],
+            str(end_note >> 4),
+            NOTE_NAMES[end_note % 0x10],
+            mml_length(duration, self.channel_cut_time)
+        )])
+
+    def infinite_loop(self, char: int):
+        # Already handled by decode()
+        skip_bytes(self.f, 2)
+
+    def volume_up(self, char: int):
+        self.ch.add_event(["@V+", uint8(self.f)])
+
+    def volume_down(self, char: int):
+        self.ch.add_event(["@V-", uint8(self.f)])
+
+    def colon_loop_start(self, char: int):
+        # Loop start (bracket-colon)
+        self.ch.add_event(["[:", uint8(self.f)])
+        # The documentation says that [::] loops can be nested, but others
+        # "output smaller objects" (uncertain translation).
+        # I assume, then, that these 2 bytes are a pointer.
+        # The question is, what exactly are they pointing to?
+        # Any why isn't the octave stack necessary here?
+        skip_bytes(self.f, 2)
+        # Fun fact: In Lua, wrapping a function call in parentheses forces it
+        # to return only one value (since functions in Lua can return multiple
+        # values). When I was first translating dump.lua to Python, I assumed
+        # the parentheses were a no-op. Gotcha! 😑
+
+    def colon_loop_end(self, char: int):
+        # Loop end (bracket-colon)
+        self.ch.add_event([":]"])
+        # 2 of these bytes are probably a pointer back to the start of the
+        # loop. What confuses me is the 3rd. What's it for?
+        skip_bytes(self.f, 3)
+
+    def sync_work(self, char: int):
+        # Sync-work value entry
+        # ...Whatever that means.
+        self.ch.add_event(["Z", uint8(self.f)])
+
+    def colon_loop_skip(self, char: int):
+        # Skip to end of loop on last iteration (bracket-colon)
+        self.ch.add_event(["|"])
+        # I can only assume that these 2 bytes are a pointer to the end of the
+        # loop.
+        skip_bytes(self.f, 2)
+
+    def macro(self, char: int):
+        # Macro ("user-defined track") playback
+        macro_num = self.song.register_macro(self.f, self.ch.id)
+        self.ch.add_event(["U", macro_num])
+
+    def sawtooth_pitch_lfo(self, char: int):
+        a, b, c, d = read_params(self.f, 4)
+        self.ch.add_event(["SP", a, b, 0, c, d])
+
+    def sawtooth_amplitude_lfo(self, char: int):
+        a, b, c, d = read_params(self.f, 4)
+        self.ch.add_event(["SA", a, b, 0, c, d])
+
+    def hardware_lfo(self, char: int):
+        # FM Hardware LFO settings (triangle only)
+        self.ch.add_event(["SH", *read_params(self.f, 4)])
+
+
 class Song:
     def __init__(self, f: FILE, filename: str):
         self.title = ""
@@ -333,6 +971,12 @@ class Song:
         self.fm: List[FMInstrument] = []
         self.ssg: List[SSGEnvelope] = []
         self.filename = filename
+        # The name used to look this song up in per-track tables. Same as the
+        # filename, unless mdt_fingerprint recognizes it as something else.
+        self.track_key = filename
+        # Where the ADPCM sample data is in the MDT, if it has any
+        self.adpcm_loc = -1
+        self.adpcm_size = 0
 
         # Perform initial setup
         channel_count = uint16(f)
@@ -352,7 +996,7 @@ class Song:
         ).macro_id
 
     def write_md2_file(self, filename: str):
-        with open(
+        with atomic_open(
             filename,
             "w",
             encoding="SHIFT-JIS",
@@ -363,11 +1007,8 @@ class Song:
             f.write(f"T={self.title}$\r\n\r\n")
 
             # Write global flags
-            f.write("A\t{} X1 OC0\r\n".format(
-                "OPM" if self.chip == 0 else (
-                    "OPN" if self.chip == 1 else "OPLL"
-                )
-            ))
+            profile = chip_profile(self.chip)
+            f.write(f"A\t{profile.name} X1 OC0\r\n")
 
             # Write all channels, then all macros
             for i, v in chain(
@@ -381,11 +1022,13 @@ class Song:
                     f.write("#{}\t${} ".format(
                         str(v.macro_id),
                         "F" if (v.id & 0x80) else (
-                            "S" if (v.id & 0x40) else "R"
+                            "S" if (v.id & 0x40) else (
+                                "M" if (v.id & 0x20) else "R"
+                            )
                         )
                     ))
                 else:
-                    f.write(CHANNEL_FLAGS[v.id] + "\t")
+                    f.write(profile.channel_flags[v.id] + "\t")
 
                 # Write all events
                 for event in v.events:
@@ -427,45 +1070,34 @@ def parse_mdt(filename: str, cut_time=False) -> Song:
 
     :param filename: A path to the MDT file.
     '''
-    f = open(filename, "rb")  # Not using "with" to keep indentation down
-    filename = remove_path(filename)
+    with open(filename, "rb") as f:
+        return read_mdt(f, remove_path(filename), cut_time)
+
+
+def read_mdt(f: FILE, filename: str, cut_time=False) -> Song:
+    '''
+    Reads MDT data from `f`, which can be a file opened in `"rb"` mode or a
+    MemoryReader, and returns it as a Song instance. Locations inside MDT data
+    are absolute, so the MDT must start at position 0 of `f`. (For MDTs
+    embedded in something else, use a MemoryReader over a slice.)
+    NOTE: This function can raise BaseExceptions.
 
+    :param f: The file (or file-like object) to read from.
+    :param filename: The name to give the Song.
+    '''
     # First 2 bytes are always(?) 02,03
     # I wondered at first if they were X and OC, but changing X and OC doesn't
     # change these bytes. 🤔
     skip_bytes(f, 2)
 
     song = Song(f, filename)
-    if song.chip > 2:
-        f.close()
-        raise BaseException("Only OPM, OPN, and OPLL chips are supported.")
+    profile = chip_profile(song.chip)
 
     # File locations
     fm_def_loc = uint16(f)
     ssg_def_loc = uint16(f)
     title_loc = uint16(f)
 
-    # Control variables
-    octave = 0
-    oct_stack: List[int] = []
-    fm_usage: Dict[int, bool] = {}
-    ssg_usage: Dict[int, bool] = {}
-    noise_mix = 1
-
-    # One helper function, because I'm too lazy to make it global
-    def note_str(char: int) -> str:
-        nonlocal octave
-        result = NOTE_NAMES[char % 0x10]
-        shift = (char >> 4) - octave
-        octave += shift
-        if abs(shift) >= 2:
-            # Separated into its own event for easier parsing in MDTtoMIDI.py
-            ch.add_event(["O", octave])
-        else:
-            oct_mark = ">" if (shift > 0) else "<" if (shift < 0) else ""
-            result = oct_mark + result
-        return result
-
     # Parse the title
     f.seek(title_loc)
     DOLLAR_SIGN = int.from_bytes(b"$", "big")
@@ -473,6 +1105,7 @@ def parse_mdt(filename: str, cut_time=False) -> Song:
     song.title = title_bytes.decode("SHIFT-JIS", errors="replace")
 
     # Parse each channel, then each macro
+    decoder = EventDecoder(f, song, profile, cut_time)
     macro_keys: List[int]
     macro_keys_generated = False
     i = 0
@@ -490,350 +1123,47 @@ def parse_mdt(filename: str, cut_time=False) -> Song:
         else:
             ch = song.channels[i]
 
-        octave = 0xFF  # Guarantees that first note sets octave
-        loop_pos_file = -1
-        current_inst = 255
-
-        # Find the channel's infinite loop point, if there is one
-        f.seek(ch.location)
-        char = 0x00
-        while char != 0xFF:
-            char = uint8(f)
-
-            # Exit if we find it
-            if char == 0xF3:
-                loop_pos_file = int16(f) + f.tell()  # Order matters
-                break
-            # Otherwise, keep advancing based on command. If we don't, the
-            # loop might exit early. -__- (Yes, this caused me some headaches.)
-            elif (
-                char <= 0x7F
-                or char == 0x90
-                or char == 0xE0
-                or char == 0xE4
-                or char == 0xE6
-                or char == 0xE7
-                or char == 0xE9
-                or char == 0xEA
-                or char == 0xEB
-                or char == 0xEC and not ch.id & 0x10
-                or char == 0xEF
-                or char == 0xF0
-                or char == 0xF1 and not ch.id & 0x10
-                or char == 0xF4
-                or char == 0xF5
-                or char == 0xF8
-            ):
-                skip_bytes(f, 1)
-            elif (
-                char == 0xEE
-                or char == 0xF1 and ch.id & 0x10
-                or char == 0xF3
-                or char == 0xF9
-                or char == 0xFA
-            ):
-                skip_bytes(f, 2)
-            elif (
-                char == 0xF6
-                or char == 0xF7
-            ):
-                skip_bytes(f, 3)
-            elif (
-                char == 0xE8
-                or char == 0xED
-                or char == 0xF2
-                or char == 0xFB
-                or char == 0xFC
-                or char == 0xFD
-            ):
-                skip_bytes(f, 4)
-            elif char == 0xEC and ch.id & 0x10:
-                first = uint8(f)
-                skip_bytes(f, 1 if (first & 0x80) else 6)
-
-        # Parse all the events in the channel
-        f.seek(ch.location)
-        char = 0x00
-        while char != 0xFF:
-            char = uint8(f)
-
-            # Add infinite loop event if need be
-            if f.tell() == loop_pos_file:
-                ch.add_event(["\\"])
-
-            # Parse the current event
-            if char < 0x80:
-                # Note
-                # NOTE (ha): Cut time CANNOT apply to macros, since the
-                # compiler isn't smart enough to figure out whether or not cut
-                # time applies to a macro during playback (which may require
-                # compiling two of the same macro). Instead, the compiler just
-                # assumes that cut time is NEVER used when it compiles macros.
-                ch.add_event([note_str(char) + mml_length(
-                    uint8(f), cut_time and not isinstance(ch, Macro)
-                )])
-                if not ch.id & 0x10:
-                    (ssg_usage if (ch.id & 0x40) else fm_usage)[
-                        current_inst
-                    ] = True
-            # 0x80...0x8F are unused
-            # TODO: Unless they're octave 8 notes for SSG with OC set to 1?
-            elif char == 0x90:
-                # Rest
-                ch.add_event(["r" + mml_length(
-                    uint8(f), cut_time and not isinstance(ch, Macro)
-                )])
-            elif char == 0x91:
-                # Tie
-                ch.add_event(["&"])
-            # 0x92...0xDF are unused
-            elif char == 0xE0:
-                # Loop start (pipe-colon)
-                oct_stack.append(-1)
-                ch.add_event(["|:", uint8(f)])
-            elif char == 0xE1:
-                # Skip to end of loop on last iteration (pipe-colon)
-                if oct_stack[-1] == -1:
-                    oct_stack[-1] = octave
-                ch.add_event([":"])
-            elif char == 0xE2:
-                # Loop end (pipe-colon)
-                octave = oct_stack[-1] if (oct_stack[-1] >= 0) else octave
-                oct_stack.pop()
-                ch.add_event([":|"])
-            elif char == 0xE3:
-                # Force note-off
-                ch.add_event(["/"])
-            elif char == 0xE4:
-                # Loop start (bracket)
-                # These loops can't be exited early, so the octave stack isn't
-                # necessary.
-                ch.add_event(["[", uint8(f)])
-            elif char == 0xE5:
-                # Loop end (bracket)
-                ch.add_event(["]"])
-            elif char == 0xE6:
-                # Detune
-                ch.add_event(["^", int8(f)])
-            elif char == 0xE7:
-                # Transpose
-                ch.add_event(["@^", int8(f)])
-            elif char == 0xE8:
-                # Amplitude LFO settings (triangle)
-                a, b, c, d = read_params(f, 4)
-                ch.add_event(["SA", a, 0, b, c, d])
-            elif char == 0xE9:
-                # Tempo
-                tempo = uint8(f)
-                # The @T (tempo + cut time) command seems to be a compiler
-                # flag, prompting it to double tempo and note lengths.
-                if cut_time:
-                    ch.add_event(["@T", tempo * 2])
-                else:
-                    ch.add_event(["t", tempo])
-            elif char == 0xEA:
-                # Articulation (...is what I'm calling it)
-                ch.add_event(["Q", uint8(f)])
-            elif char == 0xEB:
-                # FM instrument change,
-                # SSG noise mix and envelope change,
-                # or RHYTHM sample selection
-                inst_num = uint8(f)
-                if ch.id & 0x40:
-                    # SSG noise mix and envelope
-                    # MDRV2 appears to combine the tone/noise mix (2 bits) with
-                    # the envelope number (6 bits). The Lua script assumes that
-                    # N is always set to 1, thus producing negative envelope
-                    # numbers for anything else. Whoops! 😜
-                    # This actually took me a REALLY long time to fix, and I
-                    # only figured it out thanks to the documentation, which
-                    # states that the N command "[takes] effect at the point
-                    # where the envelope settings are changed."
-                    tone = not inst_num & 0x40
-                    noise = not inst_num & 0x80
-                    inst_num %= 0x40
-                    # Booleans in Python are also integers:
-                    new_noise_mix = noise * 2 + tone
-                    if new_noise_mix != noise_mix:
-                        noise_mix = new_noise_mix
-                        ch.add_event(["N", noise_mix])
-                ch.add_event(["@", inst_num])
-                if not ch.id & 0x10:
-                    current_inst = inst_num
-                    (ssg_usage if (ch.id & 0x40) else fm_usage).setdefault(
-                        inst_num,
-                        False
-                    )
-            elif char == 0xEC:
-                # Volume
-                if ch.id & 0x10:
-                    # RHYTHM
-                    first = uint8(f)
-                    if first & 0x80:
-                        # One RHYTHM sample
-                        ch.add_event(["@V", first % 0x80, uint8(f)])
-                    else:
-                        # All RHYTHM samples
-                        ch.add_event(["V", first, *read_params(f, 6)])
-                elif ch.id & 0x40:
-                    # SSG
-                    # The Lua script (incorrectly) uses @V in SSG channels,
-                    # so I added this elif to fix that.
-                    # Hooray for translated docs! ✊
-                    ch.add_event(["V", uint8(f)])
-                else:
-                    # FM (or ADPCM, I guess, but 🤷‍♀️)
-                    ch.add_event(["@V", uint8(f)])
-            elif char == 0xED:
-                # Pitch LFO settings (triangle)
-                ch.add_event(["S", *read_params(f, 4)])
-            elif char == 0xEE:
-                # Register move/copy
-                # ...O...kay? Is this actually a useful feature?
-                ch.add_event(["Y", *read_params(f, 2)])
-            elif char == 0xEF:
-                # FM LFO delay, or SSG noise frequency
-                ch.add_event(["W", uint8(f)])
-            elif char == 0xF0:
-                # Fade in/out
-                time = uint8(f)
-                ch.add_event(["_", 0x80 - time if (time & 0x80) else time])
-            elif char == 0xF1:
-                # Pan
-                # Read 2 params for RHYTHM, 1 for others
-                params = read_params(f, 2 if (ch.id & 0x10) else 1)
-                ch.add_event(["P", *params])
-            elif char == 0xF2:
-                # Portamento
-                # Neither my nor HertzDevil's attempts at correctly calculating
-                # portamento from the MDT parameters succeeded, so I created
-                # a set of MD2 files containing every possible %1 portamento,
-                # compiled them, and extracted their parameters into a dict.
-                # There's DEFINITELY a better way to do this, but I've sunk WAY
-                # too much time into this already. 😭
-                # Portamentos in MDRV2 have 4 bytes of parameters:
-                start_note = uint8(f)  # Starting note (and octave)
-                duration = uint8(f)  # Duration, in clock cycles
-                change = int16(f)  # I have NO IDEA.
-                # Each octave up/down adds/subtracts 617 to change, and change
-                # is divided by duration during compilation. Semitones vary in
-                # size depending on the starting AND ENDING positions in their
-                # respective octaves, but the starting octave doesn't seem to
-                # matter??? IDK, dude. 😕
-                portamento_map = PORTAMENTO_MAP_SSG if (
-                    ch.id & 0x40
-                ) else PORTAMENTO_MAP_FM
-                end_note = -1
-                for k, v in portamento_map[start_note].items():
-                    # Find the note corresponding to the value of change
-                    if trunc(k / duration) == change:  # Signed int division
-                        end_note = v
-                        break
-                # NOTE for people who don't write Python: code in a for...else
-                # block runs only if the for loop doesn't break.
-                else:
-                    # If there's no direct correspondance, find whatever key
-                    # is closest (and greater in magnitude) to change
-                    # TODO: This might not work for SSG...
-                    last = 0
-                    change_abs = abs(change)
-                    itemiter = sorted(portamento_map[start_note].items())
-                    for k, v in reversed(itemiter) if change < 0 else itemiter:
-                        if (change < 0 and k > 0) or (change >= 0 and k < 0):
-                            continue
-                        last = k
-                        if abs(k) > change_abs:
-                            end_note = v
-                            break
-                    else:
-                        end_note = portamento_map[start_note][last]
-                ch.add_event(["({}{},{}{}){}".format(
-                    str(start_note >> 4),
-                    NOTE_NAMES[start_note % 0x10],
-                    str(end_note >> 4),
-                    NOTE_NAMES[end_note % 0x10],
-                    mml_length(duration, cut_time and not isinstance(
-                        ch, Macro
-                    ))
-                )])
-            elif char == 0xF3:
-                # Infinite loop - already handled
-                skip_bytes(f, 2)
-            elif char == 0xF4:
-                # Volume increase
-                ch.add_event(["@V+", uint8(f)])
-            elif char == 0xF5:
-                # Volume decrease
-                ch.add_event(["@V-", uint8(f)])
-            elif char == 0xF6:
-                # Loop start (bracket-colon)
-                ch.add_event(["[:", uint8(f)])
-                # The documentation says that [::] loops can be nested, but
-                # others "output smaller objects" (uncertain translation).
-                # I assume, then, that these 2 bytes are a pointer.
-                # The question is, what exactly are they pointing to?
-                # Any why isn't the octave stack necessary here?
-                skip_bytes(f, 2)
-                # Fun fact: In Lua, wrapping a function call in parentheses
-                # forces it to return only one value (since functions in Lua
-                # can return multiple values). When I was first translating
-                # dump.lua to Python, I assumed the parentheses were a no-op.
-                # Gotcha! 😑
-            elif char == 0xF7:
-                # Loop end (bracket-colon)
-                ch.add_event([":]"])
-                # 2 of these bytes are probably a pointer back to the start of
-                # the loop. What confuses me is the 3rd. What's it for?
-                skip_bytes(f, 3)
-            elif char == 0xF8:
-                # Sync-work value entry
-                # ...Whatever that means.
-                ch.add_event(["Z", uint8(f)])
-            elif char == 0xF9:
-                # Skip to end of loop on last iteration (bracket-colon)
-                ch.add_event(["|"])
-                # I can only assume that these 2 bytes are a pointer to the end
-                # of the loop.
-                skip_bytes(f, 2)
-            elif char == 0xFA:
-                # Macro ("user-defined track") playback
-                macro_num = song.register_macro(f, ch.id)
-                ch.add_event(["U", macro_num])
-            elif char == 0xFB:
-                # Pitch LFO settings (sawtooth up/down)
-                a, b, c, d = read_params(f, 4)
-                ch.add_event(["SP", a, b, 0, c, d])
-            elif char == 0xFC:
-                # Amplitude LFO settings (sawtooth up/down)
-                a, b, c, d = read_params(f, 4)
-                ch.add_event(["SA", a, b, 0, c, d])
-            elif char == 0xFD:
-                # FM Hardware LFO settings (triangle only)
-                ch.add_event(["SH", *read_params(f, 4)])
-            # 0xFE is unused
-            # 0xFF: End of channel/macro. Part of loop condition
+        decoder.decode(ch)
 
         # "Whenever you're manipulating indicies directly, you're probably
         # doing it wrong." -Raymond Hettinger, Python core developer, 2013
         # (I may or may not have forgotten to increment i at one point. 😝)
         i += 1
+    fm_usage = decoder.fm_usage
+    ssg_usage = decoder.ssg_usage
 
     # Parse FM instrument definitions
     f.seek(fm_def_loc)
     while f.tell() < ssg_def_loc:
-        song.fm.append(FMInstrument(read_params(f, 32)))
+        song.fm.append(FMInstrument(
+            read_params(f, profile.instrument_size),
+            profile.operator_offsets
+        ))
         n = len(song.fm) - 1
         song.fm[n].add_file(filename, [n])
         song.fm[n].plays = fm_usage.get(n, False)
 
     # Parse SSG envelope definitions
+    # The envelope number is only 6 bits wide, so there can't be more than 64
+    # of them. This matters when the MDT is embedded in something bigger.
     end_of_file = f.seek(0, 2)
+    ssg_limit = SSG_ENVELOPE_LIMIT
+    has_adpcm = any(ch.id & 0x20 for ch in song.channels)
+    if has_adpcm:
+        # MDTs with ADPCM channels have their sample data after the SSG
+        # envelopes, with nothing to say where one ends and the other begins.
+        # So, only the envelopes that are actually used are read, and
+        # everything after them is assumed to be ADPCM data.
+        ssg_limit = 1 + max(
+            (k for k in ssg_usage if k < SSG_ENVELOPE_LIMIT), default=-1
+        )
     f.seek(ssg_def_loc)
-    while f.tell() < end_of_file:
+    while f.tell() + 6 <= end_of_file and len(song.ssg) < ssg_limit:
         song.ssg.append(SSGEnvelope(read_params(f, 6)))
+    if has_adpcm:
+        song.adpcm_loc = f.tell()
+        song.adpcm_size = end_of_file - song.adpcm_loc
 
-    # Close file and return
-    f.close()
     return song
 
 
@@ -0,0 +1,341 @@
+# Contains a structural diff for MDT files, for seeing how two versions of a
+# track (e.g. ST0 and ST6, or KAMI and KAMI2) differ, event by event, instead
+# of squinting at a text diff of their MD2 files.
+
+# Channels are paired up by ID, and macros by number. Each one already has a
+# digest (see mdt_fingerprint), so identical ones are skipped after a single
+# comparison, which keeps diffing lots of files against each other cheap.
+# Everything else gets each of its events hashed, and the hashes are diffed
+# with Myers' algorithm, which takes O((N + M) * D) time for D differences.
+# A removal right next to an insertion is reported as a change.
+
+# Instrument definitions (FM and SSG) are compared by number.
+
+
+from sys import argv as CMD_ARGS, exit
+from typing import Dict, List, Optional, Tuple
+
+from mdt_decomp_rip import (
+    Channel,
+    Song,
+    chip_profile,
+    parse_mdt,
+    str_join_list
+)
+from mdt_fingerprint import Fingerprint, channel_digest, sorted_macros
+
+
+# Constants
+SAME = "="
+REMOVED = "-"
+ADDED = "+"
+CHANGED = "~"
+
+
+# Helper functions
+def event_str(event: list) -> str:
+    # Same as in MD2 files
+    return "{}{}".format(event[0], str_join_list(",", event[1:]))
+
+
+def event_hashes(ch: Channel) -> List[int]:
+    return [hash(tuple(e)) for e in ch.events]
+
+
+def myers_diff(a: List[int], b: List[int]) -> List[Tuple[str, int, int]]:
+    '''
+    Returns the shortest edit script turning `a` into `b`, as a list of
+    (operation, index in a, index in b) tuples.
+    '''
+    # Common starts and ends are the usual case, and cost nothing to strip
+    start = 0
+    while start < len(a) and start < len(b) and a[start] == b[start]:
+        start += 1
+    end = 0
+    while (
+        end < len(a) - start and end < len(b) - start
+        and a[-1 - end] == b[-1 - end]
+    ):
+        end += 1
+    n = len(a) - start - end
+    m = len(b) - start - end
+
+    # v[k] is the furthest x reached on diagonal k (where k = x - y). Only
+    # diagonals -d to d can be reached in d edits, so each step's copy of v
+    # is kept for backtracking.
+    v: Dict[int, int] = {1: 0}
+    trace: List[Dict[int, int]] = []
+    for d in range(n + m + 1):
+        trace.append(dict(v))
+        for k in range(-d, d + 1, 2):
+            if k == -d or (k != d and v[k - 1] < v[k + 1]):
+                x = v[k + 1]  # Insertion
+            else:
+                x = v[k - 1] + 1  # Removal
+            y = x - k
+            while x < n and y < m and a[start + x] == b[start + y]:
+                x += 1
+                y += 1
+            v[k] = x
+            if x >= n and y >= m:
+                break
+        else:
+            continue
+        break
+
+    # Walk back through the trace to find the edits
+    edits: List[Tuple[str, int, int]] = []
+    x, y = n, m
+    for d in range(len(trace) - 1, -1, -1):
+        v = trace[d]
+        k = x - y
+        if k == -d or (k != d and v[k - 1] < v[k + 1]):
+            prev_k = k + 1
+        else:
+            prev_k = k - 1
+        prev_x = v[prev_k]
+        prev_y = prev_x - prev_k
+        while x > prev_x and y > prev_y:
+            x -= 1
+            y -= 1
+            edits.append((SAME, start + x, start + y))
+        if d > 0:
+            if x == prev_x:
+                edits.append((ADDED, start + prev_x, start + prev_y))
+            else:
+                edits.append((REMOVED, start + prev_x, start + prev_y))
+        x, y = prev_x, prev_y
+    edits.reverse()
+    return (
+        [(SAME, i, i) for i in range(start)]
+        + edits
+        + [(SAME, len(a) - end + i, len(b) - end + i) for i in range(end)]
+    )
+
+
+def pair_changes(
+    edits: List[Tuple[str, int, int]]
+) -> List[Tuple[str, int, int]]:
+    '''
+    Turns removals followed by insertions into changes, one for one.
+    '''
+    result: List[Tuple[str, int, int]] = []
+    i = 0
+    while i < len(edits):
+        if edits[i][0] == SAME:
+            result.append(edits[i])
+            i += 1
+            continue
+        removed: List[Tuple[str, int, int]] = []
+        added: List[Tuple[str, int, int]] = []
+        while i < len(edits) and edits[i][0] != SAME:
+            (removed if edits[i][0] == REMOVED else added).append(edits[i])
+            i += 1
+        paired = min(len(removed), len(added))
+        result.extend(
+            (CHANGED, removed[j][1], added[j][2]) for j in range(paired)
+        )
+        result.extend(removed[paired:])
+        result.extend(added[paired:])
+    return result
+
+
+def pair_channels(
+    a: List[Channel],
+    b: List[Channel]
+) -> List[Tuple[Optional[Channel], Optional[Channel]]]:
+    # Channels with the same ID are paired up in order
+    by_id: Dict[int, List[Channel]] = {}
+    for ch in b:
+        by_id.setdefault(ch.id, []).append(ch)
+    result: List[Tuple[Optional[Channel], Optional[Channel]]] = []
+    for ch in a:
+        matches = by_id.get(ch.id)
+        result.append((ch, matches.pop(0) if matches else None))
+    result.extend((None, ch) for chs in by_id.values() for ch in chs)
+    return result
+
+
+# Classes
+class ChannelDiff:
+    def __init__(
+        self,
+        name: str,
+        a: Optional[Channel],
+        b: Optional[Channel]
+    ):
+        '''
+        The differences between two channels (or macros). Either one can be
+        None, if only one of the songs has it.
+        '''
+        self.name = name
+        self.a = a
+        self.b = b
+        self.edits = pair_changes(myers_diff(
+            event_hashes(a) if a else [], event_hashes(b) if b else []
+        ))
+
+    def counts(self) -> Dict[str, int]:
+        result = {REMOVED: 0, ADDED: 0, CHANGED: 0}
+        for op, _, _ in self.edits:
+            if op != SAME:
+                result[op] += 1
+        return result
+
+    def lines(self, context=2) -> List[str]:
+        '''
+        Returns the differences as text, with `context` unchanged events
+        around each group of changes.
+        '''
+        result: List[str] = []
+        near = set()
+        for pos, (op, _, _) in enumerate(self.edits):
+            if op != SAME:
+                near.update(range(pos - context, pos + context + 1))
+        last = -1
+        for pos, (op, i, j) in enumerate(self.edits):
+            if pos not in near:
+                continue
+            if pos != last + 1 or not result:
+                result.append(f"  @@ event {i} -> {j} @@")
+            last = pos
+            if op == SAME:
+                result.append("    " + event_str(self.a.events[i]))
+            elif op == REMOVED:
+                result.append("  - " + event_str(self.a.events[i]))
+            elif op == ADDED:
+                result.append("  + " + event_str(self.b.events[j]))
+            else:
+                result.append("  ~ {} -> {}".format(
+                    event_str(self.a.events[i]), event_str(self.b.events[j])
+                ))
+        return result
+
+
+class SongDiff:
+    def __init__(
+        self,
+        a: Song,
+        b: Song,
+        fingerprint_a: Optional[Fingerprint] = None,
+        fingerprint_b: Optional[Fingerprint] = None
+    ):
+        '''
+        The differences between two Songs.
+
+        :param fingerprint_a: `a`'s Fingerprint, if it's already been made
+        (e.g. when diffing one song against lots of others).
+        :param fingerprint_b: Same, but for `b`.
+        '''
+        self.a = a
+        self.b = b
+        self.header: List[str] = []
+        if a.title != b.title:
+            self.header.append(f"Title: {a.title!r} -> {b.title!r}")
+        if a.chip != b.chip:
+            self.header.append(f"Chip: {a.chip} -> {b.chip}")
+
+        fingerprint_a = fingerprint_a or Fingerprint(a)
+        fingerprint_b = fingerprint_b or Fingerprint(b)
+        self.identical_channels = 0
+        self.channels: List[ChannelDiff] = []
+        if fingerprint_a.events == fingerprint_b.events:
+            # Nothing to do for ANY channel or macro
+            self.identical_channels = len(a.channels) + len(a.macros)
+        else:
+            digests_a = dict(zip(map(id, a.channels), fingerprint_a.channels))
+            digests_b = dict(zip(map(id, b.channels), fingerprint_b.channels))
+            flags = chip_profile(a.chip).channel_flags
+            for ch_a, ch_b in pair_channels(a.channels, b.channels):
+                if ch_a and ch_b and (
+                    digests_a[id(ch_a)] == digests_b[id(ch_b)]
+                ):
+                    self.identical_channels += 1
+                    continue
+                ch_id = (ch_a or ch_b).id
+                self.add(ChannelDiff(
+                    flags.get(ch_id, f"0x{ch_id:02X}"), ch_a, ch_b
+                ))
+            self.diff_macros(sorted_macros(a), sorted_macros(b))
+
+        self.instruments: List[str] = []
+        for name, insts_a, insts_b in (
+            ("FM", a.fm, b.fm),
+            ("SSG", a.ssg, b.ssg)
+        ):
+            for i in range(max(len(insts_a), len(insts_b))):
+                params_a = insts_a[i].params if i < len(insts_a) else None
+                params_b = insts_b[i].params if i < len(insts_b) else None
+                if params_a == params_b:
+                    continue
+                self.instruments.append(
+                    f"{name} instrument {i}: " + (
+                        "added" if params_a is None
+                        else "removed" if params_b is None
+                        else "changed"
+                    )
+                )
+
+    def diff_macros(self, a: List[Channel], b: List[Channel]):
+        for i in range(max(len(a), len(b))):
+            m_a = a[i] if i < len(a) else None
+            m_b = b[i] if i < len(b) else None
+            if m_a and m_b and channel_digest(m_a) == channel_digest(m_b):
+                self.identical_channels += 1
+                continue
+            self.add(ChannelDiff(f"#{i}", m_a, m_b))
+
+    def add(self, diff: ChannelDiff):
+        # Macros are also digested with the ID of the channel that called
+        # them first, so ones that only differ there end up here
+        if diff.a and diff.b and not any(diff.counts().values()):
+            self.identical_channels += 1
+        else:
+            self.channels.append(diff)
+
+    def is_identical(self) -> bool:
+        return not (self.header or self.channels or self.instruments)
+
+    def lines(self, context=2) -> List[str]:
+        '''
+        Returns a readable summary of every difference.
+        '''
+        result = list(self.header)
+        for ch in self.channels:
+            if ch.a is None or ch.b is None:
+                result.append("{}: only in {}".format(
+                    ch.name, self.a.filename if ch.a else self.b.filename
+                ))
+                continue
+            counts = ch.counts()
+            result.append("{}: {} removed, {} added, {} changed".format(
+                ch.name, counts[REMOVED], counts[ADDED], counts[CHANGED]
+            ))
+            result.extend(ch.lines(context))
+        result.extend(self.instruments)
+        result.append(f"{self.identical_channels} identical channels/macros")
+        return result
+
+
+# API functions
+def diff_files(a: str, b: str, cut_time=False) -> SongDiff:
+    '''
+    Reads two MDT files, and returns the differences between them.
+    NOTE: This function can raise BaseExceptions.
+
+    :param a: A path to the first MDT file.
+    :param b: A path to the second MDT file.
+    '''
+    return SongDiff(parse_mdt(a, cut_time), parse_mdt(b, cut_time))
+
+
+if __name__ == "__main__":
+    if len(CMD_ARGS) < 3:
+        print("Please specify two MDT files to compare.")
+        exit()
+
+    diff = diff_files(CMD_ARGS[1], CMD_ARGS[2])
+    if diff.is_identical():
+        print("No differences.")
+    else:
+        print("\n".join(diff.lines()))
@@ -0,0 +1,237 @@
+# Contains functions for identifying known tracks by their contents, rather
+# than by their filenames. All of the per-track tables (TRACK_NUMBER_MAP,
+# SUGGESTED_INST_NUMS, etc.) are keyed on HRtP's original filenames, so a file
+# that's been renamed (or extracted from a disk image) silently loses them.
+# With a fingerprint index, the Song gets its original filename back as its
+# `track_key`, and everything keyed on it works again.
+
+# Each fingerprint has three parts:
+# - A content hash, covering everything the decoder produced. Exact matches.
+# - An event hash, covering only the channels and macros. Matches tracks whose
+#   title and/or instrument definitions were changed.
+# - One hash per channel. Matches tracks where only SOME channels changed.
+# The first two are plain dict lookups, and the third is one lookup per
+# channel, so identifying a Song doesn't depend on the size of the index.
+
+# Events are hashed as decoded, and cut time changes their lengths (and
+# tempos), so a Song can only be identified by an index built with the same
+# cut time setting. Building one makes both: fingerprints.json, and
+# fingerprints_cut_time.json for Songs parsed with cut time.
+
+# Since I can't exactly distribute HRtP's music, the index has to be built
+# from your own copy of the game, e.g.:
+# python mdt_fingerprint.py <HRtP folder> fingerprints.json
+
+
+from collections import Counter
+from glob import glob
+from hashlib import blake2b
+from json import dump, load
+from os.path import isfile, splitext
+from sys import argv as CMD_ARGS, exit
+from typing import List, Dict, Optional
+
+from mdt_decomp_rip import Channel, Song, parse_mdt, remove_path
+
+
+# Constants
+FINGERPRINT_FILE = "fingerprints.json"
+
+
+# Helper functions
+def cut_time_filename(filename: str) -> str:
+    # Where the cut time version of an index is saved, e.g.
+    # fingerprints.json -> fingerprints_cut_time.json
+    root, ext = splitext(filename)
+    return root + "_cut_time" + ext
+
+
+def digest(*parts) -> str:
+    h = blake2b(digest_size=16)
+    for p in parts:
+        h.update(repr(p).encode("utf-8"))
+    return h.hexdigest()
+
+
+def channel_digest(ch: Channel) -> str:
+    return digest(ch.id, ch.events)
+
+
+def sorted_macros(song: Song) -> List[Channel]:
+    return list(v for _, v in sorted(
+        song.macros.items(), key=lambda m: m[1].macro_id
+    ))
+
+
+# Classes
+class Fingerprint:
+    def __init__(self, song: Song):
+        self.channels: List[str] = [
+            channel_digest(ch) for ch in song.channels
+        ]
+        self.events = digest(
+            self.channels,
+            [channel_digest(m) for m in sorted_macros(song)]
+        )
+        self.content = digest(
+            song.title,
+            song.chip,
+            self.events,
+            [v.params for v in song.fm],
+            [v.params for v in song.ssg]
+        )
+
+
+class FingerprintIndex:
+    def __init__(self, cut_time=False):
+        self.cut_time = cut_time  # What the indexed Songs were parsed with
+        self.by_content: Dict[str, str] = {}
+        self.by_events: Dict[str, str] = {}
+        self.by_channel: Dict[str, List[str]] = {}
+        self.channel_counts: Dict[str, int] = {}
+
+    def add(self, name: str, fingerprint: Fingerprint):
+        '''
+        Adds a fingerprint to the index under the given track key.
+        If two tracks have the same fingerprint, the first one wins.
+        '''
+        self.by_content.setdefault(fingerprint.content, name)
+        self.by_events.setdefault(fingerprint.events, name)
+        for c in set(fingerprint.channels):
+            self.by_channel.setdefault(c, []).append(name)
+        self.channel_counts[name] = len(set(fingerprint.channels))
+
+    def identify(self, song: Song, near_threshold=0.5) -> Optional[str]:
+        '''
+        Returns the key of the indexed track that `song` matches, or None.
+        Exact matches are preferred, then matches that ignore the title and
+        instruments, then the track sharing the most identical channels.
+
+        :param song: The Song to identify.
+        :param near_threshold: The minimum fraction of channels that must be
+        identical for a partial match. Set to more than 1 to disable.
+        '''
+        fingerprint = Fingerprint(song)
+        name = self.by_content.get(fingerprint.content)
+        if name is None:
+            name = self.by_events.get(fingerprint.events)
+        if name is not None or not fingerprint.channels:
+            return name
+
+        votes: Counter = Counter()
+        for c in set(fingerprint.channels):
+            votes.update(self.by_channel.get(c, []))
+        if not votes:
+            return None
+        name, count = votes.most_common(1)[0]
+        total = max(len(set(fingerprint.channels)), self.channel_counts[name])
+        return name if (count / total >= near_threshold) else None
+
+    def save(self, filename: str):
+        tracks: Dict[str, dict] = {}
+        for content, name in self.by_content.items():
+            tracks.setdefault(name, {})["content"] = content
+        for events, name in self.by_events.items():
+            tracks.setdefault(name, {})["events"] = events
+        for c, names in self.by_channel.items():
+            for name in names:
+                track = tracks.setdefault(name, {})
+                track.setdefault("channels", []).append(c)
+        with open(filename, "w") as f:
+            dump(
+                {"cut_time": self.cut_time, "tracks": tracks},
+                f,
+                indent=1,
+                sort_keys=True
+            )
+
+    @staticmethod
+    def load(filename: str):
+        with open(filename, "r") as f:
+            data = load(f)
+        index = FingerprintIndex(data.get("cut_time", False))
+        tracks: Dict[str, dict] = data["tracks"]
+        for name, v in tracks.items():
+            if "content" in v:
+                index.by_content.setdefault(v["content"], name)
+            if "events" in v:
+                index.by_events.setdefault(v["events"], name)
+            for c in v.get("channels", []):
+                index.by_channel.setdefault(c, []).append(name)
+            index.channel_counts[name] = len(v.get("channels", []))
+        return index
+
+
+# API functions
+def build_index(path: str, cut_time=False) -> FingerprintIndex:
+    '''
+    Builds a FingerprintIndex from every MDT file in a folder, keyed on their
+    current filenames. (So make sure they're named correctly!)
+
+    :param path: A path to a folder containing MDT files.
+    :param cut_time: Must match what the Songs to identify are parsed with.
+    '''
+    index = FingerprintIndex(cut_time)
+    for f in sorted(glob(f"{path}/*.MDT")):
+        try:
+            index.add(remove_path(f), Fingerprint(parse_mdt(f, cut_time)))
+        except BaseException as err:
+            print("Skipping file", remove_path(f), "due to error:", err)
+    return index
+
+
+def load_default_index(cut_time=False) -> Optional[FingerprintIndex]:
+    '''
+    Loads `fingerprints.json` (or `fingerprints_cut_time.json`) from the
+    working directory, if it exists and was built with `cut_time`.
+
+    :param cut_time: What the Songs to identify were parsed with.
+    '''
+    filename = FINGERPRINT_FILE
+    if cut_time:
+        filename = cut_time_filename(filename)
+    if not isfile(filename):
+        return None
+    try:
+        index = FingerprintIndex.load(filename)
+    except (OSError, ValueError, KeyError):
+        return None
+    return index if (index.cut_time == cut_time) else None
+
+
+def identify_songs(song_list: List[Song], index: FingerprintIndex) -> int:
+    '''
+    Sets the `track_key` of every recognized Song to the filename it's known
+    by in `index`, and re-keys its FM instruments to match, so that instrument
+    maps and track numbers are found no matter what the file is called.
+    Must be called before `process_insts_in_songs()`.
+    Returns the number of Songs that were recognized.
+
+    :param song_list: A list of Song instances.
+    :param index: The FingerprintIndex to identify them with. Must have been
+    built with the same cut time setting the Songs were parsed with.
+    '''
+    recognized = 0
+    for song in song_list:
+        name = index.identify(song)
+        if name is None:
+            continue
+        recognized += 1
+        old_key, song.track_key = song.track_key, name
+        if old_key == name:
+            continue
+        for inst in song.fm:
+            if old_key in inst.mml_names:
+                inst.add_file(name, inst.mml_names.pop(old_key))
+            inst.files_str = ""
+    return recognized
+
+
+if __name__ == "__main__":
+    if len(CMD_ARGS) < 2:
+        print("Please specify an input folder, and optionally an output file.")
+        exit()
+
+    output = CMD_ARGS[2] if len(CMD_ARGS) >= 3 else FINGERPRINT_FILE
+    build_index(CMD_ARGS[1]).save(output)
+    build_index(CMD_ARGS[1], True).save(cut_time_filename(output))
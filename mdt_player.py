@@ -0,0 +1,312 @@
+# Contains a real-time player for MDT files, which sends the MIDI events from
+# md2mml_midi.iter_song_events() out as raw MIDI bytes (or to any other sink)
+# at the moment they're supposed to play, so songs can be auditioned without
+# writing a MIDI file first.
+
+# Events are pulled from the generator into a small look-ahead buffer, and
+# released on a monotonic clock. Every release is timed against when it SHOULD
+# have happened, so the player can report how steady its timing actually was.
+
+# The clock and sleep functions can be swapped out (see FakeClock), so the
+# scheduling can be run and checked without waiting for the song to play, or
+# having any MIDI hardware at all.
+
+
+from collections import deque
+from heapq import heappush, heappop
+from math import sqrt
+from sys import argv as CMD_ARGS, exit, stderr, stdout
+from time import monotonic, sleep
+from typing import Callable, Iterator, List, Tuple
+
+from md2mml_midi import (
+    SUGGESTED_INST_NUMS,
+    SUGGESTED_SSG_NUMS,
+    ControlEvent,
+    NoteEvent,
+    PitchBendEvent,
+    ProgramEvent,
+    SongEvent,
+    TempoEvent,
+    iter_song_events
+)
+from mdt_decomp_rip import Song, parse_mdt
+
+
+# Constants
+DEFAULT_TEMPO = 120  # Until the song sets one
+LOOKAHEAD = 0.1  # Seconds of events to keep buffered
+BUFFER_LIMIT = 256  # Events, no matter how close together they are
+LATE_THRESHOLD = 0.005  # Seconds late an event can be before it counts
+MIDI_CHANNELS = 16
+
+NOTE_OFF = 0x80
+NOTE_ON = 0x90
+CONTROL_CHANGE = 0xB0
+PROGRAM_CHANGE = 0xC0
+PITCH_BEND = 0xE0
+ALL_NOTES_OFF = 123
+
+
+# Helper functions
+def midi_byte(value) -> int:
+    return min(max(int(value), 0), 0x7F)
+
+
+def iter_messages(
+    events: Iterator[SongEvent]
+) -> Iterator[Tuple[float, bytes]]:
+    '''
+    Turns SongEvents into raw MIDI messages, timed in seconds. Tempo changes
+    are applied as they come, and aren't sent. Note-offs are kept in a heap
+    until it's their turn, and go before anything else at the same time.
+    '''
+    note_offs: List[Tuple[float, int, bytes]] = []
+    order = 0  # Keeps note-offs at the same time in the order they were added
+    # Where (in quarter notes and seconds) the current tempo started
+    tempo_time = 0.0
+    tempo_seconds = 0.0
+    seconds_per_beat = 60 / DEFAULT_TEMPO
+
+    def seconds(time: float) -> float:
+        return tempo_seconds + (time - tempo_time) * seconds_per_beat
+
+    for event in events:
+        # Note-offs are converted to seconds only once everything before them
+        # has been seen, so tempo changes in the middle of a note still count
+        while note_offs and note_offs[0][0] <= event.time:
+            time, _, message = heappop(note_offs)
+            yield (seconds(time), message)
+
+        if isinstance(event, NoteEvent):
+            channel = event.channel & 0x0F
+            pitch = midi_byte(event.pitch)
+            yield (seconds(event.time), bytes([
+                NOTE_ON | channel, pitch, midi_byte(event.velocity)
+            ]))
+            heappush(note_offs, (
+                event.time + event.duration,
+                order,
+                bytes([NOTE_OFF | channel, pitch, 0])
+            ))
+            order += 1
+        elif isinstance(event, ControlEvent):
+            yield (seconds(event.time), bytes([
+                CONTROL_CHANGE | (event.channel & 0x0F),
+                midi_byte(event.controller_number),
+                midi_byte(event.parameter)
+            ]))
+        elif isinstance(event, ProgramEvent):
+            yield (seconds(event.time), bytes([
+                PROGRAM_CHANGE | (event.channel & 0x0F),
+                midi_byte(event.program)
+            ]))
+        elif isinstance(event, PitchBendEvent):
+            # 14 bits, centered on 8192, low 7 bits first
+            value = min(max(event.value + 8192, 0), 0x3FFF)
+            yield (seconds(event.time), bytes([
+                PITCH_BEND | (event.channel & 0x0F),
+                value & 0x7F,
+                value >> 7
+            ]))
+        elif isinstance(event, TempoEvent) and event.tempo > 0:
+            tempo_seconds = seconds(event.time)
+            tempo_time = event.time
+            seconds_per_beat = 60 / event.tempo
+
+    while note_offs:
+        time, _, message = heappop(note_offs)
+        yield (seconds(time), message)
+
+
+# Classes
+class FakeClock:
+    '''
+    A stand-in for `time.monotonic()` and `time.sleep()`, where sleeping just
+    moves the clock forward. Every sleep can also overshoot by a fixed amount,
+    to see how the scheduler copes with a sluggish OS.
+    '''
+
+    def __init__(self, oversleep=0.0):
+        self.now = 0.0
+        self.oversleep = oversleep
+
+    def time(self) -> float:
+        return self.now
+
+    def sleep(self, seconds: float):
+        self.now += max(seconds, 0) + self.oversleep
+
+
+class RawMIDISink:
+    '''
+    Writes raw MIDI messages to a binary file (e.g. stdout's buffer, or a FIFO
+    that a synth reads from), flushing after every message.
+    '''
+
+    def __init__(self, f):
+        self.f = f
+
+    def __call__(self, message: bytes):
+        self.f.write(message)
+        self.f.flush()
+
+
+class LatencyStats:
+    '''
+    Keeps track of how late each event was released, as running totals, so
+    it takes the same memory no matter how many events there are.
+    '''
+
+    def __init__(self, late_threshold=LATE_THRESHOLD):
+        self.late_threshold = late_threshold
+        self.count = 0
+        self.late = 0
+        self.max = 0.0
+        # For the mean and standard deviation (Welford's algorithm)
+        self.mean = 0.0
+        self.m2 = 0.0
+
+    def record(self, lateness: float):
+        self.count += 1
+        if lateness > self.late_threshold:
+            self.late += 1
+        self.max = max(self.max, lateness)
+        delta = lateness - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (lateness - self.mean)
+
+    @property
+    def jitter(self) -> float:
+        # Standard deviation of lateness
+        return sqrt(self.m2 / self.count) if self.count else 0.0
+
+    def __str__(self) -> str:
+        return (
+            "{} events, {} late (> {:.1f} ms). Lateness: mean {:.3f} ms, "
+            "max {:.3f} ms, jitter {:.3f} ms"
+        ).format(
+            self.count,
+            self.late,
+            self.late_threshold * 1000,
+            self.mean * 1000,
+            self.max * 1000,
+            self.jitter * 1000
+        )
+
+
+class Scheduler:
+    def __init__(
+        self,
+        messages: Iterator[Tuple[float, bytes]],
+        sink: Callable[[bytes], None],
+        lookahead=LOOKAHEAD,
+        buffer_limit=BUFFER_LIMIT,
+        late_threshold=LATE_THRESHOLD,
+        clock: Callable[[], float] = monotonic,
+        wait: Callable[[float], None] = sleep
+    ):
+        '''
+        Releases timed messages to a sink in real time.
+
+        :param messages: Timed messages, e.g. from `iter_messages()`.
+        :param sink: Called with each message when it's due. Anything callable
+        works, e.g. a RawMIDISink.
+        :param lookahead: How far ahead (in seconds) to pull messages into the
+        buffer. Pulling is what runs the converter, so this is how much time
+        it gets to stay ahead of playback.
+        :param buffer_limit: The most messages the buffer can hold at once.
+        :param clock: Returns the current time in seconds. Must never go back.
+        :param wait: Sleeps for a number of seconds.
+        '''
+        self.messages = messages
+        self.sink = sink
+        self.lookahead = lookahead
+        self.buffer_limit = buffer_limit
+        self.clock = clock
+        self.wait = wait
+        self.buffer: deque = deque()
+        self.stats = LatencyStats(late_threshold)
+        self.exhausted = False
+
+    def fill(self, now: float):
+        while not self.exhausted and len(self.buffer) < self.buffer_limit and (
+            not self.buffer or self.buffer[-1][0] < now + self.lookahead
+        ):
+            try:
+                self.buffer.append(next(self.messages))
+            except StopIteration:
+                self.exhausted = True
+
+    def run(self) -> LatencyStats:
+        '''
+        Plays every message, then returns the timing statistics. If playback
+        is interrupted, every channel gets an all-notes-off first.
+        '''
+        start = self.clock()
+        try:
+            while True:
+                self.fill(self.clock() - start)
+                if not self.buffer:
+                    break
+                due, message = self.buffer[0]
+                early = due - (self.clock() - start)
+                if early > 0:
+                    # Sleep in look-ahead sized steps, so the buffer keeps
+                    # getting topped up during long rests
+                    self.wait(min(early, self.lookahead))
+                    continue
+                self.buffer.popleft()
+                self.sink(message)
+                self.stats.record(-early)
+        except BaseException:
+            self.panic()
+            raise
+        return self.stats
+
+    def panic(self):
+        for channel in range(MIDI_CHANNELS):
+            self.sink(bytes([CONTROL_CHANGE | channel, ALL_NOTES_OFF, 0]))
+
+
+# API functions
+def play_song(
+    song: Song,
+    sink: Callable[[bytes], None],
+    cut_time=False,
+    **kwargs
+) -> LatencyStats:
+    '''
+    Plays a Song in real time, and returns how steady the timing was.
+    NOTE: This function can raise BaseExceptions.
+
+    :param song: A Song instance returned from `parse_mdt()`.
+    :param sink: Called with each raw MIDI message when it's due.
+    :param kwargs: Passed on to Scheduler, e.g. `clock` and `wait`.
+    '''
+    events = iter_song_events(
+        song,
+        fm_inst_map=SUGGESTED_INST_NUMS,
+        ssg_inst_map=SUGGESTED_SSG_NUMS,
+        cut_time=cut_time
+    )
+    return Scheduler(iter_messages(events), sink, **kwargs).run()
+
+
+if __name__ == "__main__":
+    if len(CMD_ARGS) < 2:
+        print(
+            "Please specify an input MDT file, and optionally an output file",
+            "(e.g. a FIFO) for the raw MIDI bytes. The default is stdout."
+        )
+        exit()
+
+    cut_time = len(CMD_ARGS) >= 4 and CMD_ARGS[3].lower() == "true"
+    song = parse_mdt(CMD_ARGS[1], cut_time)
+    if len(CMD_ARGS) >= 3 and CMD_ARGS[2] != "-":
+        with open(CMD_ARGS[2], "wb") as f:
+            stats = play_song(song, RawMIDISink(f), cut_time)
+    else:
+        stats = play_song(song, RawMIDISink(stdout.buffer), cut_time)
+    # The MIDI bytes might be going to stdout, so the stats can't
+    print(stats, file=stderr)
@@ -0,0 +1,204 @@
+# Contains functions for finding MDT files embedded in other files, like
+# PC-98 disk images (HDI/FDI/D88) or raw memory dumps. The input is mmapped,
+# so nothing gets read into memory that doesn't need to be, and candidates are
+# parsed in place through a MemoryReader rather than copied out first.
+
+# Finding candidates works in two stages:
+# 1. mmap.find() looks for the 02,03 prefix. This runs at C speed, so it's
+#    basically bound by how fast the disk can read.
+# 2. The header after each prefix is sanity-checked (channel count, chip,
+#    channel IDs, pointers). Random data almost never survives this.
+# Whatever's left is then run through the actual (bounded) decoder.
+
+
+from itertools import chain
+from mmap import mmap, ACCESS_READ
+from os.path import isdir
+from sys import argv as CMD_ARGS, exit
+from typing import Iterator, List, Tuple
+
+from mdt_decomp_rip import (
+    CHIP_PROFILES,
+    MemoryReader,
+    Song,
+    read_mdt,
+    remove_path
+)
+
+
+# Constants
+MDT_SIGNATURE = b"\x02\x03"
+# Every pointer in an MDT is 16 bits, so an MDT can't be bigger than this
+MDT_SIZE_LIMIT = 0x10000
+# No MDRV2 song can have more channels than there are channel flags, but
+# unused channels (ID 0) are still listed in the header
+CHANNEL_COUNT_LIMIT = 0x20
+FM_INSTRUMENT_SIZE = 32
+
+
+# Helper functions
+def le16(data, i: int) -> int:
+    return data[i] + (data[i + 1] * 0x100)
+
+
+def check_header(data, start: int, end: int) -> bool:
+    '''
+    Returns True if the bytes at `start` look like the header of an MDT that
+    fits before `end`. This only checks the header, so it's very cheap.
+
+    :param data: The bytes-like object being scanned.
+    :param start: The position of the 02,03 prefix.
+    :param end: The first position that can't be part of the MDT.
+    '''
+    if start + 6 > end:
+        return False
+    channel_count = le16(data, start + 2)
+    chip = le16(data, start + 4)
+    if not 0 < channel_count <= CHANNEL_COUNT_LIMIT or chip > 2:
+        return False
+    channel_flags = CHIP_PROFILES[chip].channel_flags
+
+    header_size = 6 + (channel_count * 4) + 6
+    size = min(end - start, MDT_SIZE_LIMIT)
+    if header_size > size:
+        return False
+
+    # Check the channel table
+    any_channels = False
+    for i in range(start + 6, start + header_size - 6, 4):
+        location, channel_id = le16(data, i), le16(data, i + 2)
+        if channel_id == 0:
+            continue
+        if channel_id not in channel_flags:
+            return False
+        if not header_size <= location < size:
+            return False
+        any_channels = True
+    if not any_channels:
+        return False
+
+    # Check the pointers after the channel table
+    i = start + header_size - 6
+    fm_def_loc, ssg_def_loc, title_loc = (
+        le16(data, i), le16(data, i + 2), le16(data, i + 4)
+    )
+    return (
+        header_size <= fm_def_loc <= ssg_def_loc <= size
+        and (ssg_def_loc - fm_def_loc) % FM_INSTRUMENT_SIZE == 0
+        and header_size <= title_loc < size
+    )
+
+
+def find_headers(data, start=0, end=-1) -> Iterator[int]:
+    '''
+    Yields the position of every plausible MDT header in `data`.
+
+    :param data: A bytes-like object (or mmap) to scan.
+    :param start: Where to start scanning.
+    :param end: Where to stop scanning. Defaults to the end of `data`.
+    '''
+    if end < 0:
+        end = len(data)
+    find = data.find
+    pos = find(MDT_SIGNATURE, start, end)
+    while pos >= 0:
+        if check_header(data, pos, end):
+            yield pos
+        pos = find(MDT_SIGNATURE, pos + 1, end)
+
+
+def trim_ssg_envelopes(song: Song, data, start: int) -> int:
+    '''
+    Embedded MDTs don't have a known end, so the decoder happily reads
+    whatever comes after the SSG envelope definitions as more envelopes.
+    This trims `song.ssg` down to the highest envelope that's actually used,
+    and returns the resulting size of the MDT.
+    '''
+    highest = -1
+    for ch in chain(song.channels, song.macros.values()):
+        if ch.id & 0x40:
+            for event in ch.events:
+                if event[0] == "@":
+                    highest = max(highest, event[1])
+    del song.ssg[highest + 1:]
+
+    channel_count = le16(data, start + 2)
+    ssg_def_loc = le16(data, start + 6 + (channel_count * 4) + 2)
+    return ssg_def_loc + (len(song.ssg) * 6)
+
+
+# API functions
+def scan_blob(
+    filename: str,
+    cut_time=False
+) -> Iterator[Tuple[int, int, Song]]:
+    '''
+    Scans an arbitrary file for embedded MDTs, and yields an
+    `(offset, size, song)` tuple for every one that decodes successfully.
+    `size` is the best guess available for how long the MDT is. Unused SSG
+    envelopes at the end of an embedded MDT can't be told apart from whatever
+    data follows it, so they're left out.
+    Songs are named after the input file and their offset.
+
+    :param filename: A path to the file to scan.
+    '''
+    name = remove_path(filename)
+    with open(filename, "rb") as f, mmap(
+        f.fileno(), 0, access=ACCESS_READ
+    ) as data:
+        blob_end = len(data)
+        # Candidates can't be cut off at the next header, since that might
+        # be a false positive in the middle of this one. Instead, headers
+        # inside an MDT that already decoded are skipped.
+        decoded_end = 0
+        for pos in find_headers(data):
+            if pos < decoded_end:
+                continue
+            end = min(blob_end, pos + MDT_SIZE_LIMIT)
+            reader = MemoryReader(memoryview(data)[pos:end])
+            try:
+                song = read_mdt(reader, f"{name}@{pos:08X}.MDT", cut_time)
+            except BaseException:
+                # Oh well. It was probably just random data.
+                song = None
+            finally:
+                # The memoryview HAS to be released before the mmap is
+                # closed, or Python raises a BufferError
+                reader.close()
+            if song is not None:
+                size = trim_ssg_envelopes(song, data, pos)
+                decoded_end = pos + size
+                yield (pos, size, song)
+
+
+def extract_blob(filename: str, folder: str) -> List[str]:
+    '''
+    Scans an arbitrary file for embedded MDTs and writes each one that decodes
+    successfully to its own file in `folder`. Returns the paths written.
+
+    :param filename: A path to the file to scan.
+    :param folder: A path to an existing folder to write the MDTs to.
+    '''
+    written: List[str] = []
+    with open(filename, "rb") as f:
+        for pos, size, song in scan_blob(filename):
+            f.seek(pos)
+            path = folder + "/" + song.filename.replace("@", "_")
+            with open(path, "wb") as out:
+                out.write(f.read(size))
+            written.append(path)
+    return written
+
+
+if __name__ == "__main__":
+    if len(CMD_ARGS) < 2:
+        print("Please specify an input file, and optionally an output folder.")
+        exit()
+
+    if len(CMD_ARGS) >= 3 and isdir(CMD_ARGS[2]):
+        for path in extract_blob(CMD_ARGS[1], CMD_ARGS[2]):
+            print("Extracted", path)
+    else:
+        for pos, size, song in scan_blob(CMD_ARGS[1]):
+            print(f"{pos:08X}: {size} bytes, {len(song.channels)} channels,",
+                  f"title \"{song.title}\"")
@@ -0,0 +1,211 @@
+# Contains an index of which notes are playing when, for answering "what's
+# sounding on each channel at time t?" without regenerating (and scanning) the
+# whole MIDI output every time.
+
+# Each MIDI channel gets a centered interval tree over its notes: every node
+# holds the notes that span its center point, sorted by start AND by end, and
+# everything else goes to the left or right of it. Finding the notes at a
+# point only has to scan the notes it actually returns, plus one walk down the
+# tree, so queries take O(log n + k). Notes overlapping a range are the ones
+# playing at its start, plus the ones starting inside it, which are found by
+# bisecting a list of start times.
+
+# Times are in quarter notes, same as md2mml_midi. A note sounds from its
+# start up to (but not including) its end. RHYTHM hits are indexed as the
+# separate drum notes they turn into on MIDI channel 10 (9).
+
+# The index can be saved as JSON, next to whatever else is cached for a song,
+# and loading it just rebuilds the trees.
+
+
+from bisect import bisect_left, bisect_right
+from json import dump, load
+from sys import argv as CMD_ARGS, exit
+from typing import List, Dict
+
+from md2mml_midi import NoteEvent, PercussionEvent, iter_song_events
+from mdt_decomp_rip import Song, atomic_open, parse_mdt
+
+
+# Helper functions
+def note_end(note: NoteEvent) -> float:
+    return note.time + note.duration
+
+
+def note_start(note: NoteEvent) -> float:
+    return note.time
+
+
+# Classes
+class IntervalNode:
+    def __init__(self, notes: List[NoteEvent]):
+        # The median START is used as the center, so that at least one note
+        # (the one starting there) always stays in this node. Otherwise, a
+        # bunch of identical notes could keep getting passed down forever.
+        starts = sorted(n.time for n in notes)
+        self.center = starts[len(starts) // 2]
+        here: List[NoteEvent] = []
+        left: List[NoteEvent] = []
+        right: List[NoteEvent] = []
+        for n in notes:
+            if note_end(n) <= self.center:
+                left.append(n)
+            elif n.time > self.center:
+                right.append(n)
+            else:
+                here.append(n)
+        self.by_start = sorted(here, key=note_start)
+        self.by_end = sorted(here, key=note_end, reverse=True)
+        self.left = IntervalNode(left) if left else None
+        self.right = IntervalNode(right) if right else None
+
+
+class IntervalTree:
+    def __init__(self, notes: List[NoteEvent]):
+        # Notes with no length never actually sound
+        self.notes = sorted(
+            (n for n in notes if n.duration > 0), key=note_start
+        )
+        self.starts = [n.time for n in self.notes]
+        self.root = IntervalNode(self.notes) if self.notes else None
+
+    def at(self, time: float) -> List[NoteEvent]:
+        '''
+        Returns the notes sounding at `time`.
+        '''
+        result: List[NoteEvent] = []
+        node = self.root
+        while node is not None:
+            if time < node.center:
+                # Every note here ends after `time`, so only the start matters
+                for n in node.by_start:
+                    if n.time > time:
+                        break
+                    result.append(n)
+                node = node.left
+            else:
+                # Every note here starts at or before `time`
+                for n in node.by_end:
+                    if note_end(n) <= time:
+                        break
+                    result.append(n)
+                node = node.right
+        return result
+
+    def overlapping(self, start: float, end: float) -> List[NoteEvent]:
+        '''
+        Returns the notes sounding at any point from `start` up to `end`.
+        '''
+        if end <= start:
+            return []
+        result = self.at(start)
+        result.extend(self.notes[
+            bisect_right(self.starts, start):bisect_left(self.starts, end)
+        ])
+        return result
+
+
+class NoteIndex:
+    def __init__(self, channels: Dict[int, List[NoteEvent]]):
+        '''
+        :param channels: Each MIDI channel's notes, in any order.
+        '''
+        self.trees: Dict[int, IntervalTree] = {
+            k: IntervalTree(v) for k, v in channels.items()
+        }
+
+    def at(self, time: float) -> Dict[int, List[NoteEvent]]:
+        '''
+        Returns the notes sounding at `time`, for each MIDI channel.
+        '''
+        return {k: v.at(time) for k, v in self.trees.items()}
+
+    def overlapping(
+        self,
+        start: float,
+        end: float
+    ) -> Dict[int, List[NoteEvent]]:
+        '''
+        Returns the notes sounding at any point from `start` up to `end`, for
+        each MIDI channel.
+        '''
+        return {k: v.overlapping(start, end) for k, v in self.trees.items()}
+
+    def save(self, filename: str):
+        channels = {
+            str(k): [
+                [n.time, n.duration, n.pitch, n.velocity] for n in v.notes
+            ]
+            for k, v in self.trees.items()
+        }
+        with atomic_open(filename, "w") as f:
+            dump({"channels": channels}, f)
+
+    @staticmethod
+    def load(filename: str):
+        with open(filename, "r") as f:
+            channels: Dict[str, list] = load(f)["channels"]
+        return NoteIndex({
+            int(k): [NoteEvent(int(k), p, t, d, vel) for t, d, p, vel in v]
+            for k, v in channels.items()
+        })
+
+
+# API functions
+def build_note_index(
+    song: Song,
+    portamento_rate=55,
+    cut_time=False
+) -> NoteIndex:
+    '''
+    Converts the specified MDT `Song` to MIDI events, and indexes its notes.
+    NOTE: This function can raise BaseExceptions.
+
+    :param song: A Song instance returned from `parse_mdt()`.
+    :param cut_time: If True, all note lengths in macros will be doubled.
+    '''
+    channels: Dict[int, List[NoteEvent]] = {}
+    for event in iter_song_events(
+        song,
+        portamento_rate=portamento_rate,
+        cut_time=cut_time
+    ):
+        if isinstance(event, (NoteEvent, PercussionEvent)):
+            for n in event.notes():
+                channels.setdefault(n.channel, []).append(n)
+    return NoteIndex(channels)
+
+
+def load_or_build_note_index(
+    filename: str,
+    song: Song,
+    cut_time=False
+) -> NoteIndex:
+    '''
+    Loads a saved NoteIndex if `filename` exists, or builds one for `song`
+    and saves it there if it doesn't.
+    NOTE: This function can raise BaseExceptions.
+    '''
+    try:
+        return NoteIndex.load(filename)
+    except (OSError, ValueError, KeyError):
+        index = build_note_index(song, cut_time=cut_time)
+        index.save(filename)
+        return index
+
+
+if __name__ == "__main__":
+    if len(CMD_ARGS) < 3:
+        print(
+            "Please specify an input MDT file and a time (in quarter notes),",
+            "and optionally an output file to save the index to."
+        )
+        exit()
+
+    index = build_note_index(parse_mdt(CMD_ARGS[1]))
+    if len(CMD_ARGS) >= 4:
+        index.save(CMD_ARGS[3])
+    for channel, notes in sorted(index.at(float(CMD_ARGS[2])).items()):
+        print(f"Channel {channel + 1}:", ", ".join(
+            f"{n.pitch} ({n.time}-{note_end(n)})" for n in notes
+        ) or "-")
@@ -0,0 +1,784 @@
+# Contains an offline renderer for the YM2608's FM, SSG and RHYTHM parts, for
+# turning MDTs straight into WAV files without needing a real PC-98 (or an
+# emulator, or a synth plugin). It's driven by the register writes from
+# mdrv2_emu, so it plays the instruments, volumes and pitches exactly the way
+# the driver sets them.
+
+# Everything is rendered a block at a time with NumPy, where a block is all of
+# the samples between two register writes. Nothing changes within a block
+# except phases and envelopes, and both of those have closed forms, so there's
+# no per-sample Python code anywhere.
+
+# The one thing that doesn't have a closed form is operator 1's feedback, since
+# each sample depends on the last two. But at a constant feedback level and
+# output level, the feedback operator's waveform only depends on its phase, so
+# those waveforms are simulated ahead of time (at a tiny phase increment) and
+# looked up during rendering.
+
+# The SSG side is much simpler: square waves and noise are just phases
+# compared against thresholds. MDRV2's SSG envelopes are done in software, so
+# they arrive as plain volume writes, courtesy of mdrv2_emu.
+
+# The RHYTHM part plays samples from the chip's ROM, which obviously can't be
+# included here. Instead, each drum is synthesized once (the first time it's
+# needed), and every hit is mixed in as a slice of that waveform.
+
+# This is NOT a cycle-accurate emulation of the chip. Envelope rates, detune
+# and the LFO are modeled after the datasheet's numbers, and the rest is
+# standard FM math, so it sounds right without matching a real YM2608
+# bit-for-bit.
+
+
+from concurrent.futures import ProcessPoolExecutor
+from math import ceil, log, pi
+from os import cpu_count
+from sys import argv as CMD_ARGS, exit
+from typing import Iterator, List, Optional, Set
+from wave import open as open_wave
+
+import numpy as np
+
+from mdt_decomp_rip import CHANNEL_FLAGS, Song, atomic_open
+from mdrv2_emu import OPNA_CLOCK, SSG_CLOCK, Emulator
+
+
+# Constants
+SAMPLE_RATE = 44100
+CHUNK_SIZE = 0x8000  # Samples buffered before being written to the WAV
+TAIL_TIME = 1.0  # Seconds rendered after the song ends, for release tails
+HEADROOM = 0.25  # Output scale, so 6 loud channels don't clip
+
+TWO_PI = 2 * pi
+FM_CHANNELS = 6
+FM_KEY_CODES = [0, 1, 2, 4, 5, 6]
+# Register slots (+0, +4, +8, +12) to operators
+SLOT_OPERATORS = [0, 2, 1, 3]
+# Frequency of F-number 1 at block 0, in Hz
+FNUM_FREQUENCY = OPNA_CLOCK / (144 * 2 ** 21)
+
+# A modulator at full output shifts its carrier's phase by this many cycles
+MODULATION_DEPTH = 4.0
+# Feedback levels 1-7 are pi/16 through 4pi radians, applied to the average of
+# the last 2 outputs. The feedback tables cover up to the highest level.
+FEEDBACK_MAX = 4 * pi
+FEEDBACK_LEVELS = 64
+FEEDBACK_TABLE_SIZE = 1024
+
+# Which operators modulate operators 2, 3 and 4, and which are carriers
+ALGORITHMS = [
+    (((0,), (1,), (2,)), (3,)),
+    (((), (0, 1), (2,)), (3,)),
+    (((), (1,), (0, 2)), (3,)),
+    (((0,), (), (1, 2)), (3,)),
+    (((0,), (), (2,)), (1, 3)),
+    (((0,), (0,), (0,)), (1, 2, 3)),
+    (((0,), (), ()), (1, 2, 3)),
+    (((), (), ()), (0, 1, 2, 3))
+]
+
+# Envelopes, all in dB of attenuation
+MAX_ATTENUATION = 96.0
+TL_STEP = 0.75
+SL_STEP = 3.0
+# Time for a full 96 dB decay at rates 60-63. Every 4 rates below that
+# doubles it.
+FASTEST_DECAY = 0.0069
+# GUESS: The attack is exponential, and takes 1/8 of the decay time at the
+# same rate. The offset keeps it from taking forever to reach 0 dB.
+ATTACK_SPEEDUP = 8
+ATTACK_OFFSET = 4.0
+ATTACK, DECAY, SUSTAIN, RELEASE, OFF = range(5)
+
+# Hardware LFO
+LFO_FREQUENCIES = [3.98, 5.56, 6.02, 6.37, 6.88, 9.63, 48.1, 72.2]  # Hz
+PMS_CENTS = [0, 3.4, 6.7, 10, 14, 20, 40, 80]
+AMS_DB = [0, 1.4, 5.9, 11.8]
+# GUESS: The real detune amount depends on the key code. This is close enough
+# in the middle of the keyboard.
+DETUNE_CENTS = [0, 1.0, 2.0, 3.0]
+
+
+# SSG
+SSG_CHANNELS = 3
+SSG_LEVEL = 1.0  # Relative to a single FM carrier at full volume
+NOISE_LENGTH = 2 ** 17 - 1  # Period of the noise generator's LFSR
+
+# RHYTHM
+RHYTHM_INSTRUMENTS = 6  # Bass drum, snare, top cymbal, hi-hat, tom, rim shot
+RHYTHM_LEVEL = 0.75  # Relative to a single FM carrier at full volume
+RHYTHM_STEP = 0.75  # dB per total/instrument level step
+RHYTHM_SEED = 0x2608
+
+
+# Helper functions
+feedback_table_cache: List[np.ndarray] = []
+noise_table_cache: List[np.ndarray] = []
+rhythm_sample_cache: List[List[np.ndarray]] = []
+
+
+def feedback_table() -> np.ndarray:
+    '''
+    Returns the (FEEDBACK_LEVELS, FEEDBACK_TABLE_SIZE) table of feedback
+    operator waveforms, simulating it the first time it's needed.
+    Row i is the waveform at an effective feedback level (feedback level times
+    output level) of `FEEDBACK_MAX * i / (FEEDBACK_LEVELS - 1)` radians.
+    '''
+    if not feedback_table_cache:
+        levels = np.linspace(0, FEEDBACK_MAX, FEEDBACK_LEVELS)
+        table = np.empty((FEEDBACK_LEVELS, FEEDBACK_TABLE_SIZE))
+        last = np.zeros(FEEDBACK_LEVELS)
+        second_last = np.zeros(FEEDBACK_LEVELS)
+        # Run through 2 cycles, so the first one can settle
+        for _ in range(2):
+            for i in range(FEEDBACK_TABLE_SIZE):
+                out = np.sin(
+                    TWO_PI * i / FEEDBACK_TABLE_SIZE
+                    + levels * (last + second_last) / 2
+                )
+                second_last, last = last, out
+                table[:, i] = out
+        feedback_table_cache.append(table)
+    return feedback_table_cache[0]
+
+
+def noise_table() -> np.ndarray:
+    '''
+    Returns one full period of the SSG noise generator's output (0 or 1), as
+    produced by a 17-bit LFSR with taps at bits 0 and 3, generating it the
+    first time it's needed.
+    '''
+    if not noise_table_cache:
+        bits = bytearray(NOISE_LENGTH)
+        lfsr = 1
+        for i in range(NOISE_LENGTH):
+            bit = lfsr & 1
+            bits[i] = bit
+            lfsr = (lfsr >> 1) | ((bit ^ ((lfsr >> 3) & 1)) << 16)
+        noise_table_cache.append(np.frombuffer(bytes(bits), dtype=np.uint8))
+    return noise_table_cache[0]
+
+
+def rhythm_samples() -> List[np.ndarray]:
+    '''
+    Returns a synthesized waveform for each RHYTHM instrument, in key-on bit
+    order, generating them the first time they're needed.
+    These are stand-ins for the samples in the YM2608's ROM, which sound
+    similar enough (they're all 808-style electronic drums).
+    '''
+    if not rhythm_sample_cache:
+        rng = np.random.default_rng(RHYTHM_SEED)
+
+        def time(seconds: float) -> np.ndarray:
+            return np.arange(round(seconds * SAMPLE_RATE)) / SAMPLE_RATE
+
+        def sweep(t: np.ndarray, start: float, end: float, decay: float):
+            # Sine wave with an exponential pitch drop
+            frequency = end + (start - end) * np.exp(-t / decay)
+            return np.sin(TWO_PI * np.cumsum(frequency) / SAMPLE_RATE)
+
+        def noise(t: np.ndarray) -> np.ndarray:
+            return rng.uniform(-1, 1, len(t))
+
+        t = time(0.35)
+        bass_drum = sweep(t, 170, 50, 0.03) * np.exp(-t / 0.12)
+        t = time(0.25)
+        snare = (
+            0.5 * np.sin(TWO_PI * 185 * t) * np.exp(-t / 0.05)
+            + 0.7 * noise(t) * np.exp(-t / 0.08)
+        )
+        t = time(0.8)
+        # Detuned square waves, like an 808's cymbal, plus some noise
+        metal = sum(
+            np.sign(np.sin(TWO_PI * f * t))
+            for f in (410.6, 608.8, 739.2, 1045.4, 1080.0, 1600.0)
+        ) / 6 + 0.5 * noise(t)
+        top_cymbal = np.diff(metal, prepend=0) * np.exp(-t / 0.3)
+        t = time(0.12)
+        hi_hat = np.diff(noise(t), prepend=0) * np.exp(-t / 0.03)
+        t = time(0.4)
+        tom = sweep(t, 200, 120, 0.05) * np.exp(-t / 0.15)
+        t = time(0.06)
+        rim_shot = (
+            np.sin(TWO_PI * 1700 * t) + 0.5 * np.sin(TWO_PI * 500 * t)
+        ) * np.exp(-t / 0.008)
+
+        samples = [bass_drum, snare, top_cymbal, hi_hat, tom, rim_shot]
+        rhythm_sample_cache.append([
+            v * (RHYTHM_LEVEL / np.abs(v).max()) for v in samples
+        ])
+    return rhythm_sample_cache[0]
+
+
+def decay_time(rate: int) -> float:
+    # Seconds for a full 96 dB decay at the given (0-63) rate
+    return FASTEST_DECAY * 2 ** ((60 - min(rate, 60)) / 4)
+
+
+def to_pcm(block: np.ndarray) -> bytes:
+    return (np.clip(block, -1, 1) * 32767).astype("<i2").tobytes()
+
+
+# Classes
+class FMOperator:
+    def __init__(self):
+        self.phase = 0.0  # In cycles
+        self.state = OFF
+        self.level = MAX_ATTENUATION
+
+        self.dt = 0
+        self.ml = 0
+        self.tl = 0
+        self.ks = 0
+        self.ar = 0
+        self.am = False
+        self.dr = 0
+        self.sr = 0
+        self.sl = 0
+        self.rr = 0
+
+    def write(self, register: int, value: int):
+        if register == 0x30:
+            self.dt = (value >> 4) & 7
+            self.ml = value & 0x0F
+        elif register == 0x40:
+            self.tl = value & 0x7F
+        elif register == 0x50:
+            self.ks = value >> 6
+            self.ar = value & 0x1F
+        elif register == 0x60:
+            self.am = not not value & 0x80
+            self.dr = value & 0x1F
+        elif register == 0x70:
+            self.sr = value & 0x1F
+        elif register == 0x80:
+            self.sl = value >> 4
+            self.rr = value & 0x0F
+
+    def key_on(self):
+        if self.state in (RELEASE, OFF):
+            self.state = ATTACK
+            self.phase = 0.0
+
+    def key_off(self):
+        if self.state != OFF:
+            self.state = RELEASE
+
+    def rate(self, rate: int, key_code: int) -> int:
+        if rate == 0:
+            return 0
+        return min(63, rate + (key_code >> (3 - self.ks)))
+
+    def envelope(self, n: int, key_code: int) -> np.ndarray:
+        '''
+        Returns the envelope's attenuation (in dB) for the next `n` samples.
+        Each envelope phase is either exponential (attack) or linear (in dB),
+        so every phase the block passes through is filled in one go.
+        '''
+        out = np.empty(n)
+        pos = 0
+        while pos < n:
+            remaining = n - pos
+            if self.state == OFF:
+                out[pos:] = MAX_ATTENUATION
+                break
+
+            if self.state == ATTACK:
+                rate = self.rate(self.ar * 2, key_code)
+                if rate >= 62:
+                    self.level = 0.0
+                    self.state = DECAY
+                    continue
+                if rate == 0:
+                    out[pos:] = self.level
+                    break
+                # level(t) = (level + offset) * e^(-kt) - offset
+                k = ATTACK_SPEEDUP * log(
+                    (MAX_ATTENUATION + ATTACK_OFFSET) / ATTACK_OFFSET
+                ) / (decay_time(rate) * SAMPLE_RATE)
+                needed = max(1, ceil(
+                    log((self.level + ATTACK_OFFSET) / ATTACK_OFFSET) / k
+                ))
+                m = min(remaining, needed)
+                segment = (self.level + ATTACK_OFFSET) * np.exp(
+                    -k * np.arange(1, m + 1)
+                ) - ATTACK_OFFSET
+                np.maximum(segment, 0, out=segment)
+                out[pos:pos + m] = segment
+                self.level = float(segment[-1])
+                if m == needed:
+                    self.level = 0.0
+                    self.state = DECAY
+                pos += m
+                continue
+
+            if self.state == DECAY:
+                rate = self.rate(self.dr * 2, key_code)
+                target = self.sl * SL_STEP if (self.sl < 15) else 93.0
+            elif self.state == SUSTAIN:
+                rate = self.rate(self.sr * 2, key_code)
+                target = MAX_ATTENUATION
+            else:
+                rate = self.rate(self.rr * 4 + 2, key_code)
+                target = MAX_ATTENUATION
+            if self.level >= target:
+                self.state += 1
+                if self.state == OFF:
+                    self.level = MAX_ATTENUATION
+                continue
+            if rate == 0:
+                out[pos:] = self.level
+                break
+            slope = MAX_ATTENUATION / (decay_time(rate) * SAMPLE_RATE)
+            needed = max(1, ceil((target - self.level) / slope))
+            m = min(remaining, needed)
+            segment = self.level + slope * np.arange(1, m + 1)
+            np.minimum(segment, target, out=segment)
+            out[pos:pos + m] = segment
+            self.level = float(segment[-1])
+            pos += m
+        return out
+
+
+class FMChannel:
+    def __init__(self):
+        self.ops = [FMOperator() for _ in range(4)]
+        self.fnum = 0
+        self.block = 0
+        self.fnum_latch = 0
+        self.feedback = 0
+        self.algorithm = 0
+        self.left = True
+        self.right = True
+        self.ams = 0
+        self.pms = 0
+
+    def write(self, register: int, value: int):
+        if register < 0xA0:
+            self.ops[SLOT_OPERATORS[(register >> 2) & 3]].write(
+                register & 0xF0, value
+            )
+        elif register < 0xA4:
+            self.fnum = (self.fnum_latch & 0x07) << 8 | value
+            self.block = self.fnum_latch >> 3
+        elif register < 0xA8:
+            self.fnum_latch = value & 0x3F
+        elif 0xB0 <= register < 0xB4:
+            self.feedback = (value >> 3) & 7
+            self.algorithm = value & 7
+        elif 0xB4 <= register < 0xB8:
+            self.left = not not value & 0x80
+            self.right = not not value & 0x40
+            self.ams = (value >> 4) & 3
+            self.pms = value & 7
+
+    def key(self, slots: int):
+        for i, op in enumerate(self.ops):
+            if slots & (1 << i):
+                op.key_on()
+            else:
+                op.key_off()
+
+    def silent(self) -> bool:
+        return all(op.state == OFF for op in self.ops)
+
+    def render(
+        self,
+        n: int,
+        lfo: Optional[np.ndarray]
+    ) -> Optional[np.ndarray]:
+        '''
+        Renders the next `n` samples of this channel (in mono), or returns
+        None if it's silent.
+
+        :param lfo: The hardware LFO's triangle wave (-1 to 1) for these
+        samples, or None if it's off.
+        '''
+        if self.silent():
+            return None
+        frequency = self.fnum * (2 ** self.block) * FNUM_FREQUENCY
+        key_code = (self.block << 2) | (self.fnum >> 9)
+        steps = np.arange(1, n + 1)
+        pitch = None
+        if lfo is not None and self.pms:
+            pitch = np.exp2(lfo * (PMS_CENTS[self.pms] / 1200))
+        tremolo = None
+        if lfo is not None and self.ams:
+            tremolo = (1 - lfo) * (AMS_DB[self.ams] / 2)
+
+        phases = []
+        amplitudes = []
+        for op in self.ops:
+            detune = DETUNE_CENTS[op.dt & 3] * (-1 if (op.dt & 4) else 1)
+            increment = frequency * (op.ml or 0.5) * (
+                2 ** (detune / 1200)
+            ) / SAMPLE_RATE
+            if pitch is None:
+                phase = op.phase + increment * steps
+            else:
+                phase = op.phase + np.cumsum(increment * pitch)
+            op.phase = float(phase[-1]) % 1
+            phases.append(phase)
+
+            attenuation = op.envelope(n, key_code) + op.tl * TL_STEP
+            if tremolo is not None and op.am:
+                attenuation += tremolo
+            amplitude = np.power(10.0, attenuation / -20)
+            amplitude[attenuation >= MAX_ATTENUATION] = 0
+            amplitudes.append(amplitude)
+
+        # Operator 1, with feedback
+        if self.feedback:
+            level = amplitudes[0] * (FEEDBACK_MAX / 2 ** (7 - self.feedback))
+            rows = np.rint(
+                level * ((FEEDBACK_LEVELS - 1) / FEEDBACK_MAX)
+            ).astype(np.intp)
+            columns = (phases[0] * FEEDBACK_TABLE_SIZE).astype(np.intp)
+            columns &= FEEDBACK_TABLE_SIZE - 1
+            outputs = [amplitudes[0] * feedback_table()[rows, columns]]
+        else:
+            outputs = [amplitudes[0] * np.sin(TWO_PI * phases[0])]
+
+        # Operators 2-4
+        modulators, carriers = ALGORITHMS[self.algorithm]
+        for i in range(1, 4):
+            phase = phases[i]
+            if modulators[i - 1]:
+                phase = phase + MODULATION_DEPTH * sum(
+                    outputs[j] for j in modulators[i - 1]
+                )
+            outputs.append(amplitudes[i] * np.sin(TWO_PI * phase))
+
+        return sum(outputs[i] for i in carriers)
+
+
+class SSGChannel:
+    def __init__(self):
+        self.period = 0
+        self.volume = 0
+        self.tone = False
+        self.noise = False
+        self.phase = 0.0  # In cycles
+
+    def render(
+        self,
+        n: int,
+        noise: Optional[np.ndarray]
+    ) -> Optional[np.ndarray]:
+        '''
+        Renders the next `n` samples of this channel, or returns None if it's
+        silent. Like on the real chip, the output is high when both the tone
+        and the noise (or whichever of them is enabled) are high.
+
+        :param noise: The noise generator's output (0 or 1) for these
+        samples.
+        '''
+        if self.volume == 0 or not (self.tone or self.noise):
+            return None
+        # Each volume step is 3 dB
+        amplitude = SSG_LEVEL * 2 ** ((self.volume - 15) / 2)
+        out = None
+        if self.tone:
+            increment = SSG_CLOCK / (16 * max(self.period, 1)) / SAMPLE_RATE
+            phase = self.phase + increment * np.arange(1, n + 1)
+            self.phase = float(phase[-1]) % 1
+            # Tones above the Nyquist frequency would only alias, and sound
+            # like a DC offset on real hardware anyway
+            if increment < 0.5:
+                out = (phase % 1) < 0.5
+        if self.noise:
+            out = noise if (out is None) else (out & noise.view(bool))
+        if out is None:
+            return None
+        return amplitude * (out - 0.5)
+
+
+class RhythmSection:
+    def __init__(self):
+        self.total_level = 0
+        self.levels = [0] * RHYTHM_INSTRUMENTS
+        self.left = [False] * RHYTHM_INSTRUMENTS
+        self.right = [False] * RHYTHM_INSTRUMENTS
+        # Position in each instrument's sample, or -1 if it isn't playing
+        self.positions = [-1] * RHYTHM_INSTRUMENTS
+
+    def write(self, register: int, value: int):
+        if register == 0x10:
+            for i in range(RHYTHM_INSTRUMENTS):
+                if value & (1 << i):
+                    # Bit 7 stops instruments instead of starting them
+                    self.positions[i] = -1 if (value & 0x80) else 0
+        elif register == 0x11:
+            self.total_level = value & 0x3F
+        elif 0x18 <= register < 0x18 + RHYTHM_INSTRUMENTS:
+            i = register - 0x18
+            self.left[i] = not not value & 0x80
+            self.right[i] = not not value & 0x40
+            self.levels[i] = value & 0x1F
+
+    def render(self, out: np.ndarray):
+        '''
+        Mixes the next `len(out)` samples of every playing instrument into
+        `out`, an (n, 2) array.
+        '''
+        n = len(out)
+        samples = None
+        for i, pos in enumerate(self.positions):
+            if pos < 0:
+                continue
+            if samples is None:
+                samples = rhythm_samples()
+            segment = samples[i][pos:pos + n]
+            self.positions[i] = -1 if (pos + n >= len(samples[i])) else (
+                pos + n
+            )
+            attenuation = (
+                (63 - self.total_level) + (31 - self.levels[i])
+            ) * RHYTHM_STEP
+            gain = 10 ** (attenuation / -20)
+            m = len(segment)
+            if self.left[i]:
+                out[:m, 0] += gain * segment
+            if self.right[i]:
+                out[:m, 1] += gain * segment
+
+
+class OPNSynth:
+    def __init__(
+        self,
+        enabled_fm: Optional[Set[int]] = None,
+        enabled_ssg: Optional[Set[int]] = None,
+        enable_rhythm=True
+    ):
+        '''
+        :param enabled_fm: Which FM channels (0-5) to render. Defaults to all.
+        :param enabled_ssg: Which SSG channels (0-2) to render. Defaults to
+        all.
+        :param enable_rhythm: Whether to render the RHYTHM part.
+        '''
+        self.rhythm = RhythmSection()
+        self.enable_rhythm = enable_rhythm
+        self.fm = [FMChannel() for _ in range(FM_CHANNELS)]
+        self.ssg = [SSGChannel() for _ in range(SSG_CHANNELS)]
+        self.enabled_fm = set(range(FM_CHANNELS)) if (
+            enabled_fm is None
+        ) else enabled_fm
+        self.enabled_ssg = set(range(SSG_CHANNELS)) if (
+            enabled_ssg is None
+        ) else enabled_ssg
+        self.noise_period = 0
+        self.noise_position = 0.0
+        self.lfo_on = False
+        self.lfo_frequency = 0.0
+        self.lfo_phase = 0.0
+
+    def write(self, port: int, register: int, value: int):
+        if port == 0 and register < 0x06:
+            ch = self.ssg[register >> 1]
+            if register & 1:
+                ch.period = (ch.period & 0xFF) | ((value & 0x0F) << 8)
+            else:
+                ch.period = (ch.period & 0xF00) | value
+        elif port == 0 and register == 0x06:
+            self.noise_period = value & 0x1F
+        elif port == 0 and register == 0x07:
+            for i, ch in enumerate(self.ssg):
+                ch.tone = not value & (1 << i)
+                ch.noise = not value & (8 << i)
+        elif port == 0 and 0x08 <= register < 0x0B:
+            # The hardware envelope (bit 4) isn't supported, since MDRV2
+            # does its envelopes in software
+            self.ssg[register - 0x08].volume = value & 0x0F
+        elif port == 0 and 0x10 <= register < 0x1E:
+            self.rhythm.write(register, value)
+        elif port == 0 and register == 0x28:
+            key_code = value & 7
+            if key_code in FM_KEY_CODES:
+                self.fm[FM_KEY_CODES.index(key_code)].key(value >> 4)
+        elif port == 0 and register == 0x22:
+            self.lfo_on = not not value & 0x08
+            self.lfo_frequency = LFO_FREQUENCIES[value & 7]
+        elif 0x30 <= register < 0xB8 and (register & 3) != 3:
+            self.fm[(register & 3) + (port * 3)].write(register, value)
+
+    def lfo(self, n: int) -> Optional[np.ndarray]:
+        if not self.lfo_on:
+            return None
+        phase = self.lfo_phase + (
+            np.arange(n) * (self.lfo_frequency / SAMPLE_RATE)
+        )
+        self.lfo_phase = float(
+            phase[-1] + self.lfo_frequency / SAMPLE_RATE
+        ) % 1
+        # Triangle wave from -1 to 1, starting at 0
+        return 1 - np.abs(((phase * 4 + 1) % 4) - 2)
+
+    def noise(self, n: int) -> np.ndarray:
+        increment = SSG_CLOCK / (16 * max(self.noise_period, 1)) / (
+            SAMPLE_RATE
+        )
+        positions = self.noise_position + increment * np.arange(n)
+        self.noise_position = float(
+            positions[-1] + increment
+        ) % NOISE_LENGTH
+        return noise_table()[positions.astype(np.intp) % NOISE_LENGTH]
+
+    def render(self, n: int) -> np.ndarray:
+        '''
+        Renders the next `n` samples, as an (n, 2) array of floats.
+        '''
+        out = np.zeros((n, 2))
+        lfo = self.lfo(n)
+        for i in self.enabled_fm:
+            ch = self.fm[i]
+            mono = ch.render(n, lfo)
+            if mono is None:
+                continue
+            if ch.left:
+                out[:, 0] += mono
+            if ch.right:
+                out[:, 1] += mono
+
+        noise = None
+        if any(self.ssg[i].noise for i in self.enabled_ssg):
+            noise = self.noise(n)
+        for i in self.enabled_ssg:
+            mono = self.ssg[i].render(n, noise)
+            if mono is not None:
+                out += mono[:, None]
+
+        if self.enable_rhythm:
+            self.rhythm.render(out)
+        out *= HEADROOM
+        return out
+
+
+# API functions
+def render_song(
+    song: Song,
+    cut_time=False,
+    channel_ids: Optional[Set[int]] = None
+) -> Iterator[np.ndarray]:
+    '''
+    Emulates MDRV2 playing the specified Song, renders the result, and yields
+    it as (n, 2) arrays of floats at SAMPLE_RATE, one block at a time.
+    NOTE: This function can raise BaseExceptions.
+
+    :param song: A Song instance returned from `parse_mdt()`.
+    :param cut_time: Must match the value the Song was parsed with.
+    :param channel_ids: IDs of the channels to render. Defaults to all.
+    '''
+    if song.chip != 1:
+        raise BaseException("Provided Song is not for OPN/OPNA.")
+    emu = Emulator(song, cut_time)
+    if channel_ids is None:
+        synth = OPNSynth()
+    else:
+        synth = OPNSynth(
+            set(ch.index for ch in emu.channels
+                if ch.FM and ch.id in channel_ids),
+            set(ch.index for ch in emu.channels
+                if ch.SSG and ch.id in channel_ids),
+            any(ch.RHYTHM and ch.id in channel_ids for ch in emu.channels)
+        )
+
+    sample = 0
+    for writes in emu.iter_writes():
+        target = round(writes[0][1] * SAMPLE_RATE)
+        while sample < target:
+            n = min(target - sample, CHUNK_SIZE)
+            yield synth.render(n)
+            sample += n
+        for _, _, port, register, value in writes:
+            synth.write(port, register, value)
+
+    target = round((emu.log.end_time + TAIL_TIME) * SAMPLE_RATE)
+    while sample < target:
+        n = min(target - sample, CHUNK_SIZE)
+        yield synth.render(n)
+        sample += n
+
+
+def write_wav_file(
+    filename: str,
+    song: Song,
+    cut_time=False,
+    channel_ids: Optional[Set[int]] = None
+):
+    '''
+    Renders the specified Song to a 16-bit stereo WAV file.
+    NOTE: This function can raise BaseExceptions.
+
+    :param filename: A path to where the WAV file will be written.
+    :param song: A Song instance returned from `parse_mdt()`.
+    :param cut_time: Must match the value the Song was parsed with.
+    :param channel_ids: IDs of the channels to render. Defaults to all.
+    '''
+    with atomic_open(filename, "wb") as f:
+        with open_wave(f, "wb") as wav:
+            wav.setnchannels(2)
+            wav.setsampwidth(2)
+            wav.setframerate(SAMPLE_RATE)
+            buffered: List[np.ndarray] = []
+            buffered_size = 0
+            for block in render_song(song, cut_time, channel_ids):
+                buffered.append(block)
+                buffered_size += len(block)
+                if buffered_size >= CHUNK_SIZE:
+                    wav.writeframes(to_pcm(np.concatenate(buffered)))
+                    buffered.clear()
+                    buffered_size = 0
+            if buffered:
+                wav.writeframes(to_pcm(np.concatenate(buffered)))
+
+
+def write_stem_files(
+    prefix: str,
+    song: Song,
+    cut_time=False,
+    workers=0
+) -> List[str]:
+    '''
+    Renders every FM, SSG and RHYTHM channel of the specified Song to its own
+    WAV file, named `<prefix>_<channel letter>.wav`, with one process per
+    channel.
+    Returns the paths written.
+    NOTE: This function can raise BaseExceptions.
+
+    :param prefix: A path (without extension) to write the stems to.
+    :param song: A Song instance returned from `parse_mdt()`.
+    :param cut_time: Must match the value the Song was parsed with.
+    :param workers: The number of processes to use. 0 uses one per CPU core.
+    '''
+    ids = [ch.id for ch in song.channels if ch.id & 0xD0]
+    filenames = [f"{prefix}_{CHANNEL_FLAGS[v]}.wav" for v in ids]
+    with ProcessPoolExecutor(
+        max_workers=min(workers or cpu_count() or 1, max(len(ids), 1))
+    ) as pool:
+        # list() makes sure any errors get raised here
+        list(pool.map(
+            write_wav_file,
+            filenames,
+            [song] * len(ids),
+            [cut_time] * len(ids),
+            [{v} for v in ids]
+        ))
+    return filenames
+
+
+if __name__ == "__main__":
+    if len(CMD_ARGS) < 3:
+        print(
+            "Please specify an input MDT file and an output WAV file,",
+            "and optionally \"stems\" to render each channel separately."
+        )
+        exit()
+
+    from multiprocessing import freeze_support
+    from mdt_decomp_rip import parse_mdt
+    freeze_support()
+    song = parse_mdt(CMD_ARGS[1])
+    if len(CMD_ARGS) >= 4 and CMD_ARGS[3].lower() == "stems":
+        for path in write_stem_files(CMD_ARGS[2].rsplit(".", 1)[0], song):
+            print("Wrote", path)
+    else:
+        write_wav_file(CMD_ARGS[2], song)
@@ -0,0 +1,319 @@
+# Contains a search index for finding where a melodic phrase shows up across
+# lots of MDT files, without converting every file again for every search.
+
+# Each melodic channel is converted once (macros resolved, loops unrolled,
+# ties joined) with md2mml_midi's converter, and its notes are turned into a
+# sequence of (interval, time until the next note) pairs. That way, a phrase
+# is found no matter what key it's in or which octave it's played in. Every
+# run of N pairs (an n-gram) is hashed into a 64-bit key, and the index is
+# just every key, sorted, alongside which channel and note it came from.
+
+# Finding a phrase means looking up a few of its n-grams (enough to cover the
+# whole phrase) with binary searches, and keeping the places where they all
+# line up. The index is saved as a folder of .npy files, which are memory-
+# mapped when loaded, so a search only ever reads the few pages it needs,
+# and opening even a HUGE index is instant.
+
+# Phrases are written like MML notes, separated by spaces, e.g.
+# "o4 c8 d8 e8 f8 g4". "o" sets the octave, "<" and ">" change it, and rests
+# ("r8") count towards the time after the note before them.
+
+
+from glob import glob
+from json import dump, load
+from os import makedirs
+from os.path import join
+from sys import argv as CMD_ARGS, exit
+from typing import List, Tuple
+
+import numpy as np
+
+from md2mml_midi import (
+    CLOCKS_PER_QUARTER,
+    NOTE_NAME_CHARS,
+    NoteEvent,
+    channel_assignments,
+    iter_song_events,
+    parse_length
+)
+from mdt_decomp_rip import NOTE_NAMES, Song, atomic_open, parse_mdt
+
+
+# Constants
+DEFAULT_N = 4  # Pairs per n-gram, i.e. 5 notes
+INTERVAL_OFFSET = 128  # Keeps intervals positive
+TIME_BITS = 20  # Clocks until the next note, which is capped to fit
+HASH_MULTIPLIER = 0x9E3779B97F4A7C15  # Odd, so no bits get thrown away
+DOCS_FILE = "channels.json"
+ARRAY_NAMES = ["keys", "docs", "positions", "times"]
+
+
+# Helper functions
+def to_clocks(times: np.ndarray) -> np.ndarray:
+    # Times from md2mml_midi are in quarter notes
+    return np.rint(times * CLOCKS_PER_QUARTER).astype(np.int64)
+
+
+def tokens(pitches: np.ndarray, times: np.ndarray) -> np.ndarray:
+    '''
+    Returns the (interval, time until the next note) pair between each note
+    and the next, packed into one integer each.
+    '''
+    intervals = np.diff(pitches) + INTERVAL_OFFSET
+    gaps = np.minimum(np.diff(times), (1 << TIME_BITS) - 1)
+    return ((intervals << TIME_BITS) | gaps).astype(np.uint64)
+
+
+def ngram_keys(pairs: np.ndarray, n: int) -> np.ndarray:
+    '''
+    Returns the hash of every run of `n` pairs. (Arithmetic on uint64 arrays
+    wraps around, which is exactly what's wanted here.)
+    '''
+    count = len(pairs) - n + 1
+    if count <= 0:
+        return np.empty(0, dtype=np.uint64)
+    keys = np.zeros(count, dtype=np.uint64)
+    multiplier = np.array([HASH_MULTIPLIER], dtype=np.uint64)
+    for j in range(n):
+        keys = keys * multiplier + pairs[j:j + count]
+    return keys
+
+
+def parse_phrase(phrase: str) -> Tuple[np.ndarray, np.ndarray]:
+    '''
+    Returns the pitches and start times (in clocks) of the notes in a phrase.
+    NOTE: This function can raise BaseExceptions.
+    '''
+    octave = 4
+    time = 0
+    pitches: List[int] = []
+    times: List[int] = []
+    for word in phrase.lower().split():
+        try:
+            if word[0] == "o":
+                octave = int(word[1:])
+                continue
+            while word[:1] in ("<", ">"):
+                octave += 1 if word[0] == ">" else -1
+                word = word[1:]
+            if not word:
+                continue
+            name_end = 1
+            while name_end < len(word) and word[name_end] in NOTE_NAME_CHARS:
+                name_end += 1
+            length = word[name_end:] or "4"
+            clocks = round(parse_length(length) * CLOCKS_PER_QUARTER)
+            if word[0] != "r":
+                pitches.append(
+                    NOTE_NAMES.index(word[:name_end]) + (octave + 1) * 12
+                )
+                times.append(time)
+            time += clocks
+        except (ValueError, IndexError, ZeroDivisionError):
+            raise BaseException(f"Couldn't understand \"{word}\" in phrase.")
+    return np.array(pitches, dtype=np.int64), np.array(times, dtype=np.int64)
+
+
+def song_channels(
+    song: Song,
+    cut_time=False
+) -> List[Tuple[int, np.ndarray, np.ndarray]]:
+    '''
+    Converts a Song, and returns the channel ID, pitches and start times (in
+    clocks) of every melodic channel that has notes.
+    '''
+    channel_ids = {
+        midi_ch: ch.id for ch, midi_ch, _ in channel_assignments(song, {}, {})
+        if not ch.id & 0x10
+    }
+    notes = {k: [] for k in channel_ids}
+    for event in iter_song_events(song, cut_time=cut_time):
+        if isinstance(event, NoteEvent) and event.channel in notes:
+            notes[event.channel].append((event.pitch, event.time))
+    return [
+        (
+            channel_ids[k],
+            np.array([p for p, _ in v], dtype=np.int64),
+            to_clocks(np.array([t for _, t in v], dtype=np.float64))
+        )
+        for k, v in notes.items() if v
+    ]
+
+
+# Classes
+class PhraseIndex:
+    def __init__(
+        self,
+        n: int,
+        channels: List[Tuple[str, int]],
+        keys: np.ndarray,
+        docs: np.ndarray,
+        positions: np.ndarray,
+        times: np.ndarray
+    ):
+        '''
+        :param n: How many pairs each n-gram is.
+        :param channels: The filename and channel ID of each indexed channel.
+        :param keys: The hash of every n-gram, sorted.
+        :param docs: Which channel each n-gram came from.
+        :param positions: Which note (in its channel) each n-gram starts on.
+        :param times: When (in clocks) each n-gram starts.
+        '''
+        self.n = n
+        self.channels = channels
+        self.keys = keys
+        self.docs = docs
+        self.positions = positions
+        self.times = times
+
+    def lookup(self, key: np.uint64) -> slice:
+        return slice(
+            int(np.searchsorted(self.keys, key, side="left")),
+            int(np.searchsorted(self.keys, key, side="right"))
+        )
+
+    def find(self, phrase: str) -> List[Tuple[str, int, int, int]]:
+        '''
+        Returns every place the phrase occurs, as (filename, channel ID, note
+        index, time in clocks) tuples.
+        NOTE: This function can raise BaseExceptions.
+
+        :param phrase: The notes to look for (see the top of this file).
+        '''
+        pitches, times = parse_phrase(phrase)
+        keys = ngram_keys(tokens(pitches, times), self.n)
+        if not len(keys):
+            raise BaseException(
+                f"Phrases need at least {self.n + 1} notes to search for."
+            )
+
+        # Enough n-grams to cover the whole phrase, and the last one
+        offsets = list(range(0, len(keys), self.n))
+        if offsets[-1] != len(keys) - 1:
+            offsets.append(len(keys) - 1)
+        # The first n-gram (offset 0) decides which places are candidates,
+        # and the rest only narrow them down
+        found = np.empty(0, dtype=np.int64)
+        found_times = np.empty(0, dtype=np.int64)
+        for offset in offsets:
+            s = self.lookup(keys[offset])
+            # Where the phrase would start, if this n-gram is part of it
+            positions = self.positions[s].astype(np.int64) - offset
+            valid = positions >= 0
+            starts = (
+                self.docs[s][valid].astype(np.int64) << 32
+            ) | positions[valid]
+            if offset == 0:
+                found, unique = np.unique(starts, return_index=True)
+                found_times = np.asarray(self.times[s])[unique]
+            else:
+                keep = np.isin(found, starts)
+                found, found_times = found[keep], found_times[keep]
+            if not len(found):
+                return []
+        return [
+            (*self.channels[v >> 32], v & 0xFFFFFFFF, t)
+            for v, t in zip(found.tolist(), found_times.tolist())
+        ]
+
+    def save(self, path: str):
+        '''
+        Saves this index to a folder (which is created if need be).
+        '''
+        makedirs(path, exist_ok=True)
+        for name in ARRAY_NAMES:
+            with atomic_open(join(path, name + ".npy"), "wb") as f:
+                np.save(f, getattr(self, name))
+        with atomic_open(join(path, DOCS_FILE), "w") as f:
+            dump({"n": self.n, "channels": self.channels}, f)
+
+    @staticmethod
+    def load(path: str):
+        with open(join(path, DOCS_FILE), "r") as f:
+            docs = load(f)
+        return PhraseIndex(
+            docs["n"],
+            [tuple(c) for c in docs["channels"]],
+            *(
+                np.load(join(path, name + ".npy"), mmap_mode="r")
+                for name in ARRAY_NAMES
+            )
+        )
+
+
+# API functions
+def build_phrase_index(
+    filenames: List[str],
+    n=DEFAULT_N,
+    cut_time=False
+) -> PhraseIndex:
+    '''
+    Builds a PhraseIndex from the melodic channels of every file. Files that
+    can't be read or converted are skipped.
+
+    :param filenames: Paths to the MDT files.
+    :param n: How many (interval, time) pairs each n-gram is. Phrases have to
+    be at least one note longer than this to be searched for.
+    '''
+    channels: List[Tuple[str, int]] = []
+    keys: List[np.ndarray] = []
+    docs: List[np.ndarray] = []
+    positions: List[np.ndarray] = []
+    times: List[np.ndarray] = []
+    for filename in filenames:
+        try:
+            song = parse_mdt(filename, cut_time)
+            song_chs = song_channels(song, cut_time)
+        except BaseException as err:
+            print("Skipping file", filename, "due to error:", err)
+            continue
+        for channel_id, pitches, starts in song_chs:
+            k = ngram_keys(tokens(pitches, starts), n)
+            keys.append(k)
+            docs.append(np.full(len(k), len(channels), dtype=np.uint32))
+            positions.append(np.arange(len(k), dtype=np.uint32))
+            times.append(starts[:len(k)])
+            channels.append((song.filename, channel_id))
+
+    if not keys:
+        return PhraseIndex(
+            n,
+            channels,
+            np.empty(0, dtype=np.uint64),
+            np.empty(0, dtype=np.uint32),
+            np.empty(0, dtype=np.uint32),
+            np.empty(0, dtype=np.int64)
+        )
+    all_keys = np.concatenate(keys)
+    order = np.argsort(all_keys, kind="stable")
+    return PhraseIndex(
+        n,
+        channels,
+        all_keys[order],
+        np.concatenate(docs)[order],
+        np.concatenate(positions)[order],
+        np.concatenate(times)[order]
+    )
+
+
+if __name__ == "__main__":
+    if len(CMD_ARGS) < 4 or CMD_ARGS[1] not in ("build", "find"):
+        print(
+            "Please specify either \"build\", an input folder and an index",
+            "folder, or \"find\", an index folder and a phrase (e.g.",
+            "\"o4 c8 d8 e8 f8 g4\")."
+        )
+        exit()
+
+    if CMD_ARGS[1] == "build":
+        build_phrase_index(sorted(glob(f"{CMD_ARGS[2]}/*.MDT"))).save(
+            CMD_ARGS[3]
+        )
+    else:
+        results = PhraseIndex.load(CMD_ARGS[2]).find(CMD_ARGS[3])
+        for filename, channel_id, index, time in results:
+            print(
+                f"{filename}, channel 0x{channel_id:02X}: note {index}",
+                f"(clock {time})"
+            )
+        print(len(results), "found.")
@@ -0,0 +1,278 @@
+# Contains an exporter that turns MDT songs into piano rolls, i.e. NumPy
+# arrays of which pitches are sounding (and how loud) at each point in time,
+# for plotting songs or feeding them to something that wants arrays.
+
+# A dense piano roll has the shape (channels, 128 pitches, frames), where each
+# frame is a fixed number of clocks (48 per quarter note), and each value is
+# the velocity of the note sounding there (0 for silence). The notes come from
+# md2mml_midi's converter, so macros, loops, ties and RHYTHM hits (as drum
+# notes on MIDI channel 10) are all accounted for.
+
+# Long songs at a fine resolution make for BIG dense arrays, most of which are
+# zeros. So the notes are collected as a sparse piano roll first: one row per
+# note, with its channel, pitch, onset frame, offset frame and velocity. That
+# can be saved as-is, or turned into a dense one, where every note is a single
+# slice assignment instead of a loop over frames.
+
+# Both are saved as compressed .npz files, with the MIDI channel numbers and
+# the resolution stored alongside, so the arrays can be interpreted later.
+
+
+from sys import argv as CMD_ARGS, exit
+from typing import Dict, List
+
+import numpy as np
+
+from md2mml_midi import (
+    CLOCKS_PER_QUARTER,
+    NoteEvent,
+    PercussionEvent,
+    iter_song_events
+)
+from mdt_decomp_rip import Song, atomic_open, parse_mdt
+
+
+# Constants
+DEFAULT_RESOLUTION = 6  # Clocks per frame, i.e. 32nd notes
+PITCHES = 128
+VELOCITY_MAX = 127
+
+
+# Helper functions
+def to_frames(times: np.ndarray, resolution: int) -> np.ndarray:
+    # Times are in quarter notes
+    return np.rint(times * (CLOCKS_PER_QUARTER / resolution)).astype(np.int64)
+
+
+# Classes
+class SparsePianoRoll:
+    def __init__(
+        self,
+        channels: np.ndarray,
+        channel: np.ndarray,
+        pitch: np.ndarray,
+        onset: np.ndarray,
+        offset: np.ndarray,
+        velocity: np.ndarray,
+        n_frames: int,
+        resolution: int
+    ):
+        '''
+        A piano roll stored as one row per note (COO-style), sorted by onset.
+
+        :param channels: The MIDI channel number of each channel index.
+        :param channel: Each note's channel, as an index into `channels`.
+        :param pitch: Each note's MIDI pitch.
+        :param onset: The frame each note starts on.
+        :param offset: The frame after each note's last one.
+        :param velocity: Each note's velocity.
+        :param n_frames: The length of the song, in frames.
+        :param resolution: How many clocks each frame is.
+        '''
+        self.channels = channels
+        self.channel = channel
+        self.pitch = pitch
+        self.onset = onset
+        self.offset = offset
+        self.velocity = velocity
+        self.n_frames = n_frames
+        self.resolution = resolution
+
+    def to_dense(self) -> np.ndarray:
+        '''
+        Returns this piano roll as a (channels, 128, frames) uint8 array of
+        velocities. Where notes on the same channel and pitch overlap, the
+        later one wins.
+        '''
+        roll = np.zeros(
+            (len(self.channels), PITCHES, self.n_frames), dtype=np.uint8
+        )
+        for c, p, on, off, v in zip(
+            self.channel.tolist(),
+            self.pitch.tolist(),
+            self.onset.tolist(),
+            self.offset.tolist(),
+            self.velocity.tolist()
+        ):
+            roll[c, p, on:off] = v
+        return roll
+
+    def save(self, filename: str, dense=False):
+        '''
+        Saves this piano roll as a compressed .npz file.
+
+        :param filename: A path to where the file will be written.
+        :param dense: If True, the dense array from `to_dense()` is saved (as
+        "roll") instead of the per-note arrays.
+        '''
+        arrays: Dict[str, np.ndarray] = {
+            "channels": self.channels,
+            "n_frames": np.array(self.n_frames),
+            "resolution": np.array(self.resolution)
+        }
+        if dense:
+            arrays["roll"] = self.to_dense()
+        else:
+            arrays.update(
+                channel=self.channel,
+                pitch=self.pitch,
+                onset=self.onset,
+                offset=self.offset,
+                velocity=self.velocity
+            )
+        with atomic_open(filename, "wb") as f:
+            np.savez_compressed(f, **arrays)
+
+    @staticmethod
+    def load(filename: str):
+        '''
+        Loads a piano roll saved by `save()`. Dense ones are loaded back into
+        per-note form, with each run of the same velocity counted as a note.
+        '''
+        with np.load(filename) as data:
+            channels = data["channels"]
+            n_frames = int(data["n_frames"])
+            resolution = int(data["resolution"])
+            if "roll" not in data:
+                return SparsePianoRoll(
+                    channels,
+                    data["channel"],
+                    data["pitch"],
+                    data["onset"],
+                    data["offset"],
+                    data["velocity"],
+                    n_frames,
+                    resolution
+                )
+            roll = data["roll"]
+
+        # A note starts wherever the velocity changes to something nonzero,
+        # and ends wherever it changes at all
+        padded = np.zeros(roll.shape[:2] + (n_frames + 2,), dtype=np.int16)
+        padded[:, :, 1:-1] = roll
+        changes = np.diff(padded, axis=2) != 0
+        c, p, on = np.nonzero(changes[:, :, :-1] & (padded[:, :, 1:-1] > 0))
+        ends = np.flatnonzero(changes)
+        # The first change after each onset (there's always one, since the
+        # padding is 0) is its offset
+        flat_on = np.ravel_multi_index((c, p, on), changes.shape)
+        off = ends[np.searchsorted(ends, flat_on, side="right")] % (
+            n_frames + 1
+        )
+        order = np.argsort(on, kind="stable")
+        return SparsePianoRoll(
+            channels,
+            c[order].astype(np.uint8),
+            p[order].astype(np.uint8),
+            on[order],
+            off[order],
+            roll[c, p, on][order],
+            n_frames,
+            resolution
+        )
+
+
+# API functions
+def build_piano_roll(
+    song: Song,
+    resolution=DEFAULT_RESOLUTION,
+    portamento_rate=55,
+    cut_time=False
+) -> SparsePianoRoll:
+    '''
+    Converts the specified MDT `Song` to MIDI events, and collects its notes
+    into a (sparse) piano roll.
+    NOTE: This function can raise BaseExceptions.
+
+    :param song: A Song instance returned from `parse_mdt()`.
+    :param resolution: How many clocks (48 per quarter note) each frame is.
+    :param cut_time: If True, all note lengths in macros will be doubled.
+    '''
+    if resolution < 1:
+        raise BaseException("Resolution must be at least 1 clock per frame.")
+
+    notes: List[NoteEvent] = []
+    end_time = 0.0
+    for event in iter_song_events(
+        song,
+        portamento_rate=portamento_rate,
+        cut_time=cut_time
+    ):
+        end_time = max(end_time, event.time)
+        if isinstance(event, (NoteEvent, PercussionEvent)):
+            notes.extend(n for n in event.notes() if n.duration > 0)
+
+    channels = np.array(sorted({n.channel for n in notes}), dtype=np.uint8)
+    channel = np.searchsorted(
+        channels, np.array([n.channel for n in notes], dtype=np.uint8)
+    ).astype(np.uint8)
+    pitch = np.array([n.pitch for n in notes], dtype=np.int64)
+    times = np.array([n.time for n in notes], dtype=np.float64)
+    onset = to_frames(times, resolution)
+    # Notes shorter than a frame still get one
+    offset = np.maximum(
+        to_frames(times + [n.duration for n in notes], resolution), onset + 1
+    )
+    velocity = np.clip(
+        [n.velocity for n in notes], 0, VELOCITY_MAX
+    ).astype(np.uint8)
+
+    # Anything the converter couldn't fit in MIDI's pitch range has nowhere
+    # to go in the roll either
+    keep = (pitch >= 0) & (pitch < PITCHES)
+    n_frames = int(max(
+        offset.max(initial=0), to_frames(np.array(end_time), resolution)
+    ))
+    return SparsePianoRoll(
+        channels,
+        channel[keep],
+        pitch[keep].astype(np.uint8),
+        onset[keep],
+        offset[keep],
+        velocity[keep],
+        n_frames,
+        resolution
+    )
+
+
+def write_piano_roll(
+    filename: str,
+    song: Song,
+    resolution=DEFAULT_RESOLUTION,
+    sparse=False,
+    cut_time=False
+):
+    '''
+    Writes the piano roll of a Song to a compressed .npz file.
+    NOTE: This function can raise BaseExceptions.
+
+    :param filename: A path to where the .npz file will be written.
+    :param song: A Song instance returned from `parse_mdt()`.
+    :param resolution: How many clocks (48 per quarter note) each frame is.
+    :param sparse: If True, the notes are saved as onset/offset arrays
+    instead of a dense (channels, 128, frames) array.
+    :param cut_time: If True, all note lengths in macros will be doubled.
+    '''
+    build_piano_roll(song, resolution, cut_time=cut_time).save(
+        filename, dense=not sparse
+    )
+
+
+if __name__ == "__main__":
+    if len(CMD_ARGS) < 3:
+        print(
+            "Please specify an input MDT file and an output .npz file, and",
+            "optionally the clocks per frame (default: {})".format(
+                DEFAULT_RESOLUTION
+            ),
+            "and \"sparse\" to save onset/offset arrays instead."
+        )
+        exit()
+
+    resolution = DEFAULT_RESOLUTION
+    if len(CMD_ARGS) >= 4:
+        resolution = int(CMD_ARGS[3])
+    sparse = len(CMD_ARGS) >= 5 and CMD_ARGS[4].lower() == "sparse"
+    write_piano_roll(
+        CMD_ARGS[2], parse_mdt(CMD_ARGS[1]), resolution, sparse
+    )
@@ -0,0 +1,5 @@
+# The modules being tested live in the folder above this one
+from os.path import dirname, abspath
+import sys
+
+sys.path.insert(0, dirname(dirname(abspath(__file__))))
@@ -0,0 +1,140 @@
+# Helpers for building small MDTs by hand, so tests don't depend on real songs,
+# and for comparing what they play.
+
+# Channel (and macro) data is given as a list of items, which are either raw
+# command bytes, ("U", n) to call macro n, or "\\" to mark the infinite loop
+# point (the jump back to it is added at the end of the channel).
+
+
+from struct import pack
+from typing import List, Sequence, Tuple, Union
+
+from md2mml_midi import iter_song_events
+from mdt_decomp_rip import MemoryReader, Song, read_mdt
+
+
+# Constants
+HEADER_SIZE = 6  # 02,03, channel count, chip
+POINTERS_SIZE = 6  # FM instruments, SSG envelopes, title
+FM_INSTRUMENT_SIZE = 32
+
+Item = Union[bytes, Tuple[str, int], str]
+
+
+# Helper functions
+def note(octave: int, note_index: int, clocks: int) -> bytes:
+    return bytes([(octave << 4) | note_index, clocks])
+
+
+def rest(clocks: int) -> bytes:
+    return bytes([0x90, clocks])
+
+
+def fm_instrument(
+    algorithm=7,
+    feedback=0,
+    total_levels=(0, 0, 0, 0),
+    slots=0x0F
+) -> bytes:
+    '''
+    Returns the raw bytes of an FM instrument. `total_levels` are in operator
+    order (1-4), and everything not given here is 0.
+    '''
+    params = bytearray(FM_INSTRUMENT_SIZE)
+    params[3] = slots << 3
+    params[4] = (feedback << 3) | algorithm
+    # Operators are stored in register order (1, 3, 2, 4)
+    for i, j in enumerate([0, 2, 1, 3]):
+        params[j + 10] = total_levels[i]
+    return bytes(params)
+
+
+def assemble(
+    items: Sequence[Item],
+    start: int,
+    macro_locs: List[int]
+) -> bytes:
+    data = bytearray()
+    loop_pos = -1
+    for item in items:
+        if item == "\\":
+            loop_pos = start + len(data)
+        elif isinstance(item, tuple):
+            data += b"\xFA" + pack("<H", macro_locs[item[1]])
+        else:
+            data += item
+    if loop_pos >= 0:
+        # The jump is relative to the end of the command, and lands one byte
+        # into the event it loops back to
+        here = start + len(data) + 3
+        data += b"\xF3" + pack("<h", loop_pos + 1 - here)
+    return bytes(data + b"\xFF")
+
+
+def measure(items: Sequence[Item]) -> int:
+    return len(assemble(items, 0, [0] * 0x100))
+
+
+def build_mdt(
+    channels: Sequence[Tuple[int, Sequence[Item]]],
+    macros: Sequence[Sequence[Item]] = (),
+    fm: Sequence[bytes] = (),
+    ssg: Sequence[Sequence[int]] = (),
+    title="Test",
+    chip=1
+) -> bytes:
+    '''
+    Returns the bytes of an MDT with the given channels (as (channel ID,
+    items) tuples), macros, FM instruments and SSG envelopes.
+    '''
+    pos = HEADER_SIZE + len(channels) * 4 + POINTERS_SIZE
+    channel_locs = []
+    for _, items in channels:
+        channel_locs.append(pos)
+        pos += measure(items)
+    macro_locs = []
+    for items in macros:
+        macro_locs.append(pos)
+        pos += measure(items)
+    title_bytes = title.encode("SHIFT-JIS") + b"$"
+    title_loc = pos
+    fm_loc = title_loc + len(title_bytes)
+    ssg_loc = fm_loc + len(fm) * FM_INSTRUMENT_SIZE
+
+    data = bytearray(b"\x02\x03" + pack("<HH", len(channels), chip))
+    for (channel_id, _), loc in zip(channels, channel_locs):
+        data += pack("<HH", loc, channel_id)
+    data += pack("<HHH", fm_loc, ssg_loc, title_loc)
+    for (_, items), loc in zip(channels, channel_locs):
+        data += assemble(items, loc, macro_locs)
+    for items, loc in zip(macros, macro_locs):
+        data += assemble(items, loc, macro_locs)
+    data += title_bytes
+    for inst in fm:
+        data += inst
+    for envelope in ssg:
+        data += bytes(envelope)
+    return bytes(data)
+
+
+def load_mdt(data: bytes, cut_time=False, filename="TEST.MDT") -> Song:
+    return read_mdt(MemoryReader(data), filename, cut_time)
+
+
+def event_key(event) -> tuple:
+    # Events don't compare equal on their own, so compare their attributes
+    attributes = dict(vars(event))
+    for k, v in attributes.items():
+        if isinstance(v, float):
+            attributes[k] = round(v, 9)
+        elif isinstance(v, list):
+            attributes[k] = tuple(v)
+    return (type(event).__name__, tuple(sorted(attributes.items())))
+
+
+def played(song: Song, **kwargs) -> list:
+    '''
+    Returns everything `iter_song_events()` yields for `song` (with the given
+    arguments), sorted, in a form that can be compared.
+    '''
+    return sorted(event_key(e) for e in iter_song_events(song, **kwargs))
@@ -0,0 +1,38 @@
+# Tests for inst_similarity's nearest-neighbour search.
+
+import random
+
+from inst_similarity import InstrumentIndex
+from mdt_decomp_rip import FMInstrument
+
+
+# Helper functions
+def random_bank(count: int, seed=1) -> list:
+    rng = random.Random(seed)
+    return [
+        FMInstrument([rng.randrange(256) for _ in range(32)])
+        for _ in range(count)
+    ]
+
+
+# Tests
+def test_exact_matches_are_exactly_zero():
+    bank = random_bank(300)
+    index = InstrumentIndex(bank)
+    for inst in bank:
+        match, distance = index.nearest(inst, k=1)[0]
+        assert match.params == inst.params
+        assert distance == 0
+
+
+def test_exact_matches_can_be_left_out():
+    bank = random_bank(300)
+    # Duplicates of the same instrument all get left out together
+    bank.append(FMInstrument(list(range(32))))
+    bank.append(FMInstrument(list(range(32))))
+    index = InstrumentIndex(bank)
+    for inst in bank:
+        result = index.nearest(inst, k=5, include_exact=False)
+        assert len(result) == 5
+        assert all(match.params != inst.params for match, _ in result)
+        assert all(distance > 0 for _, distance in result)
@@ -0,0 +1,63 @@
+# Tests for macro_compress, checking that moving repeated phrases into macros
+# doesn't change what the song actually plays.
+
+import pytest
+
+from helpers import (
+    build_mdt,
+    fm_instrument,
+    load_mdt,
+    note,
+    played,
+    rest
+)
+from macro_compress import compress_song
+
+
+# Constants
+PHRASE = [note(4, 0, 12), note(4, 4, 12), note(4, 7, 24), rest(12)]
+OTHER_PHRASE = [b"\xEC\x60", note(5, 2, 6), note(5, 0, 6), note(4, 11, 36)]
+
+
+# Helper functions
+def repetitive_song() -> bytes:
+    return build_mdt(
+        [
+            (0x80, [
+                b"\xE9\x78", b"\xEB\x00",
+                *PHRASE, *OTHER_PHRASE, *PHRASE,
+                "\\",
+                *PHRASE, b"\xE0\x02", *OTHER_PHRASE, b"\xE2", *PHRASE
+            ]),
+            (0x81, [b"\xEB\x00", *OTHER_PHRASE, rest(48), *OTHER_PHRASE]),
+            (0x40, [b"\xEC\x0C", *PHRASE, *PHRASE, ("U", 0), *PHRASE])
+        ],
+        macros=[[note(3, 9, 24), *PHRASE]],
+        fm=[fm_instrument()]
+    )
+
+
+# Tests
+@pytest.mark.parametrize("cut_time", [False, True])
+def test_compressed_song_plays_the_same(cut_time):
+    song = load_mdt(repetitive_song(), cut_time)
+    compressed = compress_song(song, cut_time)
+    assert len(compressed.macros) > len(song.macros)
+    assert sum(len(ch.events) for ch in compressed.channels) < sum(
+        len(ch.events) for ch in song.channels
+    )
+    assert played(compressed, cut_time=cut_time) == played(
+        song, cut_time=cut_time
+    )
+    assert played(compressed, cut_time=cut_time, loop_count=2) == played(
+        song, cut_time=cut_time, loop_count=2
+    )
+
+
+def test_original_song_is_unchanged():
+    song = load_mdt(repetitive_song())
+    events = [list(ch.events) for ch in song.channels]
+    macros = dict(song.macros)
+    compress_song(song)
+    assert [ch.events for ch in song.channels] == events
+    assert song.macros == macros
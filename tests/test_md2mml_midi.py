@@ -0,0 +1,36 @@
+# Tests for md2mml_midi's MIDI event stream.
+
+import pytest
+
+from helpers import build_mdt, fm_instrument, load_mdt, note
+from md2mml_midi import NoteEvent, iter_song_events
+
+
+# Tests
+@pytest.mark.parametrize("rhythm_first", [True, False])
+def test_macro_shared_with_rhythm_channel(rhythm_first):
+    # Both channels call the same macro, then play a note of their own, which
+    # has to cope with whatever kind of note the macro left behind
+    channels = [
+        (0x10, [b"\xEB\x01", ("U", 0), note(4, 0, 24)]),  # Bass drum
+        (0x80, [b"\xEB\x00", ("U", 0), note(4, 0, 24)])
+    ]
+    if not rhythm_first:
+        channels.reverse()
+    song = load_mdt(build_mdt(
+        channels,
+        macros=[[note(4, 2, 24), note(4, 4, 24)]],
+        fm=[fm_instrument()]
+    ))
+    events = list(iter_song_events(song))
+    # Macros are interpreted as whichever kind of channel called them first,
+    # so only the note after the macro is certain to be on the FM channel
+    fm_notes = [
+        (e.time, e.pitch) for e in events
+        if isinstance(e, NoteEvent) and e.channel == 0
+    ]
+    assert fm_notes[-1] == (1.0, 60)
+    # The RHYTHM channel's hits come out on MIDI channel 10
+    assert any(
+        isinstance(e, NoteEvent) and e.channel == 9 for e in events
+    )
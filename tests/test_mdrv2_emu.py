@@ -0,0 +1,251 @@
+# Tests for mdrv2_emu, comparing the register writes for small hand-built MDTs
+# against sequences worked out by hand from the YM2608 register layout.
+
+from helpers import build_mdt, fm_instrument, load_mdt, note, rest
+from mdrv2_emu import emulate_song
+
+
+# Constants
+SETUP = [(0, 0, 0x29, 0x80), (0, 0, 0x07, 0x3F), (0, 0, 0x11, 0x3F)]
+INSTRUMENT = b"\xEB\x00"  # @0
+KEY = (0, 0x28)
+
+
+# Helper functions
+def writes(data: bytes, registers=None) -> list:
+    '''
+    Returns `(clock, port, register, value)` for every write made while
+    playing `data`, optionally only for the given (port, register) pairs.
+    '''
+    log = emulate_song(load_mdt(data))
+    return [
+        (clock, port, register, value)
+        for clock, _, port, register, value in log.writes
+        if registers is None or (port, register) in registers
+    ]
+
+
+def chip_state(writes) -> dict:
+    # What every register (but the key-on one) holds after `writes`
+    registers = {}
+    for _, _, port, register, value in writes:
+        if (port, register) != KEY:
+            registers[(port, register)] = value
+    return registers
+
+
+def fm_song(*items, channel_id=0x80, **kwargs) -> bytes:
+    return build_mdt(
+        [(channel_id, [INSTRUMENT, *items])],
+        fm=[kwargs.get("instrument", fm_instrument())]
+    )
+
+
+# Tests
+def test_setup_comes_first():
+    assert writes(fm_song(note(4, 0, 48)))[:3] == SETUP
+
+
+def test_note_on_and_off():
+    # o4 c4: F-number 617 (0x269) at block 4, key on all slots, then key off
+    # once the note's 48 clocks are up
+    assert writes(fm_song(note(4, 0, 48)), {(0, 0xA0), (0, 0xA4), KEY}) == [
+        (0, 0, 0xA4, 0x22),
+        (0, 0, 0xA0, 0x69),
+        (0, 0, 0x28, 0xF0),
+        (48, 0, 0x28, 0x00)
+    ]
+
+
+def test_fnum_and_block():
+    # c, a and b at different octaves. Block is bits 3-5 of 0xA4, and the
+    # top 3 bits of the F-number are bits 0-2.
+    data = fm_song(note(2, 0, 12), note(4, 9, 12), note(7, 11, 12))
+    assert writes(data, {(0, 0xA0), (0, 0xA4)}) == [
+        (0, 0, 0xA4, 0x12),  # Block 2, 617
+        (0, 0, 0xA0, 0x69),
+        (12, 0, 0xA4, 0x24),  # Block 4, 1038
+        (12, 0, 0xA0, 0x0E),
+        (24, 0, 0xA4, 0x3C),  # Block 7, 1165
+        (24, 0, 0xA0, 0x8D)
+    ]
+
+
+def test_instrument_writes_total_levels():
+    # Operators are written in register order (1, 3, 2, 4)
+    data = fm_song(
+        note(4, 0, 12), instrument=fm_instrument(4, 5, (10, 20, 30, 40))
+    )
+    tl = {(0, r) for r in (0x40, 0x44, 0x48, 0x4C)}
+    assert writes(data, tl) == [
+        (0, 0, 0x40, 10),
+        (0, 0, 0x48, 20),
+        (0, 0, 0x44, 30),
+        (0, 0, 0x4C, 40)
+    ]
+    assert writes(data, {(0, 0xB0)}) == [(0, 0, 0xB0, 0x2C)]
+
+
+def test_volume_only_changes_carriers():
+    # Algorithm 4's carriers are operators 2 and 4, and @V100 attenuates
+    # them by 127 - 100 = 27
+    data = fm_song(
+        b"\xEC\x64",
+        note(4, 0, 12),
+        instrument=fm_instrument(4, 0, (10, 20, 30, 40))
+    )
+    tl = {(0, r) for r in (0x40, 0x44, 0x48, 0x4C)}
+    assert writes(data, tl)[4:] == [(0, 0, 0x48, 47), (0, 0, 0x4C, 67)]
+
+
+def test_pan():
+    # P1 sets bit 7 of 0xB4, and P2 sets bit 6
+    data = fm_song(b"\xF1\x01", note(4, 0, 12), b"\xF1\x02", note(4, 0, 12))
+    assert writes(data, {(0, 0xB4)}) == [
+        (0, 0, 0xB4, 0xC0),
+        (0, 0, 0xB4, 0x80),
+        (12, 0, 0xB4, 0x40)
+    ]
+
+
+def test_channels_on_port_1():
+    # Channel D is the first channel on port 1, but keys on through port 0
+    # with key code 4
+    data = fm_song(note(4, 0, 24), channel_id=0x83)
+    assert writes(data, {(1, 0xA0), (1, 0xA4), KEY}) == [
+        (0, 1, 0xA4, 0x22),
+        (0, 1, 0xA0, 0x69),
+        (0, 0, 0x28, 0xF4),
+        (24, 0, 0x28, 0x04)
+    ]
+
+
+def test_articulation():
+    # Q4 keys off halfway through each note
+    data = fm_song(b"\xEA\x04", note(4, 0, 48), rest(48))
+    assert writes(data, {KEY}) == [(0, 0, 0x28, 0xF0), (24, 0, 0x28, 0x00)]
+
+
+def test_tie_doesnt_key_on_again():
+    data = fm_song(note(4, 0, 24), b"\x91", note(4, 2, 24))
+    assert writes(data, {KEY, (0, 0xA0)}) == [
+        (0, 0, 0xA0, 0x69),
+        (0, 0, 0x28, 0xF0),
+        (24, 0, 0xA0, 0xB5),  # d: 693
+        (48, 0, 0x28, 0x00)
+    ]
+
+
+def test_loop():
+    # |:3 c16 :| keys on 3 times, 12 clocks apart
+    data = fm_song(b"\xE0\x03", note(4, 0, 12), b"\xE2")
+    assert writes(data, {KEY}) == [
+        (0, 0, 0x28, 0xF0),
+        (12, 0, 0x28, 0x00),
+        (12, 0, 0x28, 0xF0),
+        (24, 0, 0x28, 0x00),
+        (24, 0, 0x28, 0xF0),
+        (36, 0, 0x28, 0x00)
+    ]
+
+
+def test_loop_exit():
+    # |:2 c16 : d16 :| skips the d on the last time through
+    data = fm_song(
+        b"\xE0\x02", note(4, 0, 12), b"\xE1", note(4, 2, 12), b"\xE2"
+    )
+    assert writes(data, {(0, 0xA0)}) == [
+        (0, 0, 0xA0, 0x69),
+        (12, 0, 0xA0, 0xB5),
+        (24, 0, 0xA0, 0x69)
+    ]
+    assert emulate_song(load_mdt(data)).end_clock == 36
+
+
+def test_macro():
+    data = build_mdt(
+        [(0x80, [INSTRUMENT, ("U", 0), note(4, 0, 12)])],
+        macros=[[note(4, 9, 12)]],
+        fm=[fm_instrument()]
+    )
+    assert writes(data, {(0, 0xA0)}) == [
+        (0, 0, 0xA0, 0x0E),
+        (12, 0, 0xA0, 0x69)
+    ]
+
+
+def test_infinite_loop_point():
+    # The loop starts at the \, 24 clocks in
+    data = fm_song(note(4, 0, 24), "\\", note(4, 2, 24))
+    log = emulate_song(load_mdt(data))
+    assert log.loop_clock == 24
+    assert log.writes[log.loop_index][0] == 24
+    assert all(w[0] < 24 for w in log.writes[:log.loop_index])
+
+
+def test_ssg_note():
+    # o4 a plays an octave up on SSG (880 Hz), so the period is
+    # 1996800 / (16 * 880) = 142. The mixer turns tone A on, and the volume
+    # is only up while the note is.
+    data = build_mdt([(0x40, [b"\xEC\x0C", note(4, 9, 24), rest(24)])])
+    assert writes(data)[3:] == [
+        (0, 0, 0x08, 0),
+        (0, 0, 0x00, 0x8E),
+        (0, 0, 0x01, 0x00),
+        (0, 0, 0x07, 0x3E),
+        (0, 0, 0x08, 12),
+        (24, 0, 0x08, 0)
+    ]
+
+
+def test_ssg_channel_registers():
+    # Channel K (the 3rd SSG channel) uses registers 4-5, 0x0A and bit 2
+    data = build_mdt([(0x42, [b"\xEC\x0F", note(4, 9, 24)])])
+    assert writes(data)[3:7] == [
+        (0, 0, 0x0A, 0),
+        (0, 0, 0x04, 0x8E),
+        (0, 0, 0x05, 0x00),
+        (0, 0, 0x07, 0x3B)
+    ]
+
+
+def test_loops_line_up():
+    # A loops 24 clocks from 24 on, and B loops 36 clocks from 0 on, so the
+    # loop starts at 24 and needs to be 72 clocks long for both to line up
+    data = build_mdt(
+        [
+            (0x80, [INSTRUMENT, note(4, 0, 24), "\\", note(4, 2, 24)]),
+            (0x81, [INSTRUMENT, "\\", note(4, 4, 36)])
+        ],
+        fm=[fm_instrument()]
+    )
+    assert emulate_song(load_mdt(data)).end_clock == 48
+    log = emulate_song(load_mdt(data), align_loops=True)
+    assert (log.loop_clock, log.end_clock) == (24, 96)
+    key_ons = [
+        (clock, value & 0x07)
+        for clock, _, port, register, value in log.writes
+        if (port, register) == KEY and value & 0xF0
+    ]
+    # Nothing's keyed on at 96, since that's where the loop starts over
+    assert key_ons == [
+        (0, 0), (0, 1), (24, 0), (36, 1), (48, 0), (72, 0), (72, 1)
+    ]
+
+
+def test_loop_restores_register_state():
+    # The volume drops after the loop point, so going back around has to put
+    # it back up, even though the first time through nothing changed there
+    data = fm_song(
+        b"\xEC\x64", note(4, 0, 24),
+        "\\",
+        note(4, 0, 24), b"\xEC\x50", note(4, 2, 24)
+    )
+    log = emulate_song(load_mdt(data), align_loops=True)
+    loop = [w for w in log.writes[log.loop_index:] if w[0] == log.loop_clock]
+
+    first_time = chip_state(log.writes[:log.loop_index] + loop)
+    second_time = chip_state(log.writes + loop)
+    assert first_time[(0, 0x4C)] == 27
+    assert chip_state(log.writes)[(0, 0x4C)] == 47
+    assert second_time == first_time
@@ -0,0 +1,134 @@
+# Tests for mdt_player's scheduling, run against a FakeClock so nothing
+# actually has to wait.
+
+import pytest
+
+from helpers import build_mdt, fm_instrument, load_mdt, note
+from md2mml_midi import NoteEvent, TempoEvent
+from mdt_player import (
+    ALL_NOTES_OFF,
+    CONTROL_CHANGE,
+    MIDI_CHANNELS,
+    NOTE_OFF,
+    NOTE_ON,
+    FakeClock,
+    Scheduler,
+    iter_messages,
+    play_song
+)
+
+
+# Helper functions
+class Recorder:
+    # A sink that remembers when (on the fake clock) each message arrived
+    def __init__(self, clock: FakeClock):
+        self.clock = clock
+        self.received = []
+
+    def __call__(self, message: bytes):
+        self.received.append((self.clock.now, message))
+
+
+def schedule(messages, oversleep=0.0, **kwargs):
+    clock = FakeClock(oversleep)
+    sink = Recorder(clock)
+    stats = Scheduler(
+        iter(messages), sink, clock=clock.time, wait=clock.sleep, **kwargs
+    ).run()
+    return sink.received, stats
+
+
+# Tests
+def test_messages_released_in_order_and_on_time():
+    messages = [(0.0, b"a"), (0.25, b"b"), (0.25, b"c"), (1.5, b"d")]
+    received, stats = schedule(messages)
+    assert [t for t, _ in received] == pytest.approx([0.0, 0.25, 0.25, 1.5])
+    assert [m for _, m in received] == [b"a", b"b", b"c", b"d"]
+    assert stats.count == 4
+    assert stats.late == 0
+
+
+def test_buffer_limit_doesnt_change_order():
+    messages = [(i * 0.01, bytes([i])) for i in range(50)]
+    received, _ = schedule(messages, buffer_limit=3)
+    assert [m for _, m in received] == [m for _, m in messages]
+
+
+def test_note_off_before_note_on_at_same_time():
+    # At 120 BPM, a quarter note is half a second
+    events = [
+        NoteEvent(channel=0, pitch=60, time=0, duration=1, velocity=100),
+        NoteEvent(channel=0, pitch=60, time=1, duration=1, velocity=100)
+    ]
+    assert list(iter_messages(iter(events))) == [
+        (0.0, bytes([NOTE_ON, 60, 100])),
+        (0.5, bytes([NOTE_OFF, 60, 0])),
+        (0.5, bytes([NOTE_ON, 60, 100])),
+        (1.0, bytes([NOTE_OFF, 60, 0]))
+    ]
+
+
+def test_tempo_change_in_the_middle_of_a_note():
+    # One quarter note at 120 BPM (0.5 s), then one at 60 BPM (1 s)
+    events = [
+        NoteEvent(channel=2, pitch=64, time=0, duration=2, velocity=90),
+        TempoEvent(time=1, tempo=60)
+    ]
+    assert list(iter_messages(iter(events))) == [
+        (0.0, bytes([NOTE_ON | 2, 64, 90])),
+        (1.5, bytes([NOTE_OFF | 2, 64, 0]))
+    ]
+
+
+def test_oversleeping_makes_events_late():
+    # Every sleep overshoots by 2 ms, so everything after the first message
+    # comes out 2 ms late
+    messages = [(0.0, b"a"), (0.5, b"b"), (1.0, b"c")]
+    received, stats = schedule(messages, oversleep=0.002)
+    assert [t for t, _ in received] == pytest.approx([0.0, 0.502, 1.002])
+    assert stats.count == 3
+    assert stats.late == 0  # Under the 5 ms threshold
+    assert stats.max == pytest.approx(0.002)
+    assert stats.mean == pytest.approx(0.004 / 3)
+    assert stats.jitter == pytest.approx(0.002 * (2 ** 0.5) / 3)
+
+    _, stats = schedule(messages, oversleep=0.002, late_threshold=0.001)
+    assert stats.late == 2
+
+
+def test_panic_on_exception():
+    # The converter fails (or the user hits Ctrl+C) while "b" is waiting
+    def messages():
+        yield (0.0, b"a")
+        yield (1.0, b"b")
+        raise KeyboardInterrupt
+
+    clock = FakeClock()
+    sink = Recorder(clock)
+    with pytest.raises(KeyboardInterrupt):
+        Scheduler(messages(), sink, clock=clock.time, wait=clock.sleep).run()
+    assert [m for _, m in sink.received] == [b"a"] + [
+        bytes([CONTROL_CHANGE | channel, ALL_NOTES_OFF, 0])
+        for channel in range(MIDI_CHANNELS)
+    ]
+
+
+def test_play_song():
+    # Two quarter notes at 120 BPM, on the first FM channel
+    song = load_mdt(build_mdt(
+        [(0x80, [b"\xE9\x78", b"\xEB\x00", note(4, 0, 48), note(4, 2, 48)])],
+        fm=[fm_instrument()]
+    ))
+    clock = FakeClock()
+    sink = Recorder(clock)
+    stats = play_song(song, sink, clock=clock.time, wait=clock.sleep)
+    notes = [
+        (t, m) for t, m in sink.received
+        if m[0] & 0xF0 in (NOTE_ON, NOTE_OFF)
+    ]
+    assert [t for t, _ in notes] == pytest.approx([0.0, 0.5, 0.5, 1.0])
+    assert [(m[0] & 0xF0, m[1]) for _, m in notes] == [
+        (NOTE_ON, 60), (NOTE_OFF, 60), (NOTE_ON, 62), (NOTE_OFF, 62)
+    ]
+    assert stats.count == len(sink.received)
+    assert stats.late == 0
@@ -0,0 +1,63 @@
+# Tests for seeking with index_song(), checking that starting from a snapshot
+# gives exactly what replaying everything before `start_time` would.
+
+import pytest
+
+from helpers import (
+    build_mdt,
+    fm_instrument,
+    load_mdt,
+    note,
+    played,
+    rest
+)
+from md2mml_midi import index_song, iter_song_events
+
+
+# Constants
+# In quarter notes: the macro plays from 1 to 3 (on A) and 0 to 2 (on G), the
+# |:3 loop from 3 to 6 (at a slower tempo), and the infinite loop from 6 to 8
+START_TIMES = [0.0, 0.5, 1.0, 1.25, 2.1, 3.0, 3.5, 4.75, 5.9, 6.0, 6.5, 7.99]
+
+
+# Helper functions
+def song_with_macros_and_loops():
+    return load_mdt(build_mdt(
+        [
+            (0x80, [
+                b"\xE9\x78", b"\xEB\x00", note(4, 0, 48),
+                ("U", 0),
+                b"\xE9\x5A",
+                b"\xE0\x03", note(5, 0, 24), b"\xEC\x50", note(4, 9, 24),
+                b"\xE2",
+                "\\",
+                note(4, 2, 48), note(4, 5, 48)
+            ]),
+            (0x40, [
+                b"\xEC\x0C", ("U", 0), rest(24), note(5, 0, 72),
+                b"\xEC\x08", note(4, 7, 96), note(4, 4, 96)
+            ])
+        ],
+        macros=[[b"\xE0\x04", note(4, 4, 12), note(4, 7, 12), b"\xE2"]],
+        fm=[fm_instrument()]
+    ))
+
+
+# Tests
+@pytest.mark.parametrize("interval", [12, 48 * 16])
+def test_seeking_with_index_matches_replaying(interval):
+    song = song_with_macros_and_loops()
+    index = index_song(song, interval=interval)
+    for t in START_TIMES:
+        expected = played(song, start_time=t)
+        assert played(song, start_time=t, index=index) == expected, t
+
+
+def test_seeking_skips_what_came_before():
+    song = song_with_macros_and_loops()
+    index = index_song(song, interval=12)
+    for t in START_TIMES:
+        assert all(
+            e.time >= t
+            for e in iter_song_events(song, start_time=t, index=index)
+        )